@@ -1,16 +1,13 @@
 #!/usr/bin/env python
 # from onmt.online_translator import RecognizerParameter, ASROnlineTranslator
 from onmt.online_translator import TranslatorParameter, OnlineTranslator
+from onmt.inference.batch_scheduler import RequestBatchScheduler
 from flask import Flask, request
 import torch
 import numpy as np
 import math
 import sys
 import json
-import threading
-import queue
-import uuid
-import traceback
 import subprocess
 
 host = sys.argv[1]  # 192.168.0.72
@@ -37,19 +34,6 @@ conf_data = "\n".join(conf_data)
 
 app = Flask(__name__)
 
-def create_unique_list(my_list):
-    """
-    This function is used in checking if the prefixes and languages are the same or not
-    Args:
-        my_list:
-
-    Returns:
-
-    """
-    my_list = list(set(my_list))
-    return my_list
-
-
 def initialize_model():
     """
     Build the translator
@@ -61,101 +45,44 @@ def initialize_model():
 
     return model, max_batch_size
 
+
+def get_batch_key(data):
+    """
+    Requests with the same language pair are translated in the same batch (the prefixes can differ)
+    """
+    input_text, prefix, input_language, output_language = data
+    return input_language, output_language
+
+
 def use_model(reqs):
+    """
+    Translate a batch of requests. The requests can have different language pairs if the model supports it,
+    otherwise the scheduler only batches requests with the same language pair (get_batch_key).
+    Every request is answered as soon as its sentence is finished.
+    """
+    input_texts = list()
+    prefixes = list()
+    languages = list()
 
-    if len(reqs) == 1:
-        req = reqs[0]
+    for req in reqs:
         input_text, prefix, input_language, output_language = req.get_data()
-        model.set_language(input_language, output_language)
-        hypo = model.translate(input_text, [prefix])
-        result = {"hypo": hypo}
-        req.publish(result)
-
-    else:
-        input_texts = list()
-        prefixes = list()
-        input_languages = list()
-        output_languages = list()
-
-        batch_runnable = False
-
-        for req in reqs:
-            input_text, prefix, input_language, output_language = req.get_data()
-            model.set_language(input_language, output_language)
-            input_texts.append(input_text)
-            prefixes.append(prefix)
-
-            input_languages.append(input_language)
-            output_languages.append(output_language)
-
-        unique_prefix_list = create_unique_list(prefixes)
-        unique_input_languages = create_unique_list(input_languages)
-        unique_output_languages = create_unique_list(output_languages)
-
-        if len(unique_prefix_list) == 1 and len(unique_input_languages) == 1 and len(unique_output_languages) == 1:
-            batch_runnable = True
-
-        if batch_runnable:
-            model.set_language(input_languages[0], output_languages[0])
-            hypos = model.translate_batch(input_texts, prefixes)
-
-            for req, hypo in zip(reqs, hypos):
-                result = {"hypo": hypo}
-                req.publish(result)
-        else:
-            for req, input_text, prefix, input_language, output_language \
-                    in zip(reqs, input_texts, prefixes, input_languages, output_languages):
-                model.set_language(input_language, output_language)
-
-                hypo = model.translate(input_text, [prefix])
-                result = {"hypo": hypo}
-                req.publish(result)
-
-def run_decoding():
-    while True:
-        reqs = [queue_in.get()]
-        while not queue_in.empty() and len(reqs) < max_batch_size:
-            req = queue_in.get()
-            reqs.append(req)
-            if req.priority >= 1:
-                break
-
-        print("Batch size:",len(reqs),"Queue size:",queue_in.qsize())
-
-        try:
-            use_model(reqs)
-        except Exception as e:
-            print("An error occured during model inference")
-            traceback.print_exc()
-            for req in reqs:
-                req.publish({"hypo":"", "status":400})
-
-class Priority:
-    next_index = 0
-
-    def __init__(self, priority, id, condition, data):
-        self.index = Priority.next_index
-
-        Priority.next_index += 1
-
-        self.priority = priority
-        self.id = id
-        self.condition = condition
-        self.data = data
-
-    def __lt__(self, other):
-        return (-self.priority, self.index) < (-other.priority, other.index)
-
-    def get_data(self):
-        return self.data
-
-    def publish(self, result):
-        dict_out[self.id] = result
-        try:
-            with self.condition:
-                self.condition.notify()
-        except:
-            print("ERROR: Count not publish result")
+        input_texts.append(input_text)
+        prefixes.append(prefix)
+        languages.append((input_language, output_language))
+
+    # the default languages of the translator, each sentence is translated with its own language pair
+    # only if the batch mixes several language pairs
+    model.set_language(*languages[0])
+    if len(set(languages)) == 1:
+        languages = None
+
+    def publish(i, hypo):
+        reqs[i].publish({"hypo": hypo})
+
+    hypos = model.translate_batch(input_texts, prefixes, on_finished=publish, languages=languages)
+
+    for req, hypo in zip(reqs, hypos):
+        req.publish({"hypo": hypo})
 
 
 # corresponds to an asr_server "http://$host:$port/asr/infer/en,en" in StreamASR.py
@@ -187,21 +114,13 @@ def inference(input_language, output_language):
     except:
         priority = 0
 
-    condition = threading.Condition()
-    with condition:
-        id = str(uuid.uuid4())
-
-        # the same with SLT
-        data = (input_text, prefix, input_language, output_language)
-
-        queue_in.put(Priority( priority, id, condition, data))
+    # the same with SLT
+    data = (input_text, prefix, input_language, output_language)
 
-        condition.wait()
-
-    result = dict_out.pop(id)
+    result = dict(scheduler.submit(data, priority))
     status = 200
-    if status in result:
-        status = result.pop(status)
+    if "status" in result:
+        status = result.pop("status")
 
     # result has to contain a key "hypo" with a string as value (other optional keys are possible)
     return json.dumps(result), status
@@ -215,11 +134,9 @@ def version(input_language, output_language):
 
 model, max_batch_size = initialize_model()
 
-queue_in = queue.PriorityQueue()
-dict_out = {}
-
-decoding = threading.Thread(target=run_decoding)
-decoding.daemon = True
-decoding.start()
+# the models with adapters or factorized layers that take one language per batch are served by language pair
+scheduler = RequestBatchScheduler(use_model, max_batch_size=max_batch_size,
+                                  batch_key=None if model.translator.mixed_languages else get_batch_key)
+scheduler.start()
 
 app.run(host=host, port=port)
@@ -1,15 +1,12 @@
 #!/usr/bin/env python
 from onmt.online_translator import RecognizerParameter, ASROnlineTranslator
+from onmt.inference.batch_scheduler import RequestBatchScheduler
 from flask import Flask, request
 import torch
 import numpy as np
 import math
 import sys
 import json
-import threading
-import queue
-import uuid
-import traceback
 import subprocess
 
 host = sys.argv[1]  # 192.168.0.72
@@ -31,10 +28,6 @@ conf_data = "\n".join(conf_data)
 
 app = Flask(__name__)
 
-def create_unique_list(my_list):
-    my_list = list(set(my_list))
-    return my_list
-
 def initialize_model():
     model = ASROnlineTranslator(filename)
     print("ASR initialized")
@@ -43,104 +36,38 @@ def initialize_model():
 
     return model, max_batch_size
 
-def use_model(reqs):
 
-    if len(reqs) == 1:
-        req = reqs[0]
+def get_batch_key(data):
+    """
+    Requests with the same language pair and memory are recognized in the same batch (the prefixes can differ)
+    """
+    audio_tensor, prefix, input_language, output_language, memory = data
+    return input_language, output_language, json.dumps(memory)
+
+
+def use_model(reqs):
+    """
+    Recognize a batch of requests with the same language pair and memory.
+    Every request is answered as soon as its segment is finished.
+    """
+    audio_tensors = list()
+    prefixes = list()
+
+    for req in reqs:
         audio_tensor, prefix, input_language, output_language, memory = req.get_data()
-        model.set_language(input_language, output_language)
-        hypo = model.translate(audio_tensor, [prefix], memory)
-        result = {"hypo": hypo}
-        req.publish(result)
-
-    else:
-        audio_tensors = list()
-        prefixes = list()
-        input_languages = list()
-        output_languages = list()
-        memories = list()
-
-        batch_runnable = False
-
-        for req in reqs:
-            audio_tensor, prefix, input_language, output_language, memory = req.get_data()
-            model.set_language(input_language, output_language)
-            audio_tensors.append(audio_tensor)
-            prefixes.append(prefix)
-
-            input_languages.append(input_language)
-            output_languages.append(output_language)
-            memories.append(memory)
-
-        unique_prefix_list = create_unique_list(prefixes)
-        unique_input_languages = create_unique_list(input_languages)
-        unique_output_languages = create_unique_list(output_languages)
-        memories = create_unique_list(memories)
-
-        if len(unique_prefix_list) == 1 and len(unique_input_languages) == 1 and len(unique_output_languages) == 1 and len(memories) == 1:
-            batch_runnable = True
-
-        if batch_runnable:
-            model.set_language(input_languages[0], output_languages[0])
-            hypos = model.translate_batch(audio_tensors, prefixes, memories[0])
-
-            for req, hypo in zip(reqs, hypos):
-                result = {"hypo": hypo}
-                req.publish(result)
-        else:
-            for req, audio_tensor, prefix, input_language, output_language, memory \
-                    in zip(reqs, audio_tensors, prefixes, input_languages, output_languages, memories):
-                model.set_language(input_language, output_language)
-
-                hypo = model.translate(audio_tensor, [prefix], memory)
-                result = {"hypo": hypo}
-                req.publish(result)
-
-def run_decoding():
-    while True:
-        reqs = [queue_in.get()]
-        while not queue_in.empty() and len(reqs) < max_batch_size:
-            req = queue_in.get()
-            reqs.append(req)
-            if req.priority >= 1:
-                break
-
-        print("Batch size:",len(reqs),"Queue size:",queue_in.qsize())
-
-        try:
-            use_model(reqs)
-        except Exception as e:
-            print("An error occured during model inference")
-            traceback.print_exc()
-            for req in reqs:
-                req.publish({"hypo":"", "status":400})
-
-class Priority:
-    next_index = 0
-
-    def __init__(self, priority, id, condition, data):
-        self.index = Priority.next_index
-
-        Priority.next_index += 1
-
-        self.priority = priority
-        self.id = id
-        self.condition = condition
-        self.data = data
-
-    def __lt__(self, other):
-        return (-self.priority, self.index) < (-other.priority, other.index)
-
-    def get_data(self):
-        return self.data
-
-    def publish(self, result):
-        dict_out[self.id] = result
-        try:
-            with self.condition:
-                self.condition.notify()
-        except:
-            print("ERROR: Count not publish result")
+        audio_tensors.append(audio_tensor)
+        prefixes.append(prefix)
+
+    model.set_language(input_language, output_language)
+
+    def publish(i, hypo):
+        reqs[i].publish({"hypo": hypo})
+
+    hypos = model.translate_batch(audio_tensors, prefixes, memory, on_finished=publish)
+
+    for req, hypo in zip(reqs, hypos):
+        req.publish({"hypo": hypo})
+
 
 def pcm_s16le_to_tensor(pcm_s16le):
     audio_tensor = np.frombuffer(pcm_s16le, dtype=np.int16)
@@ -170,19 +97,12 @@ def inference(input_language, output_language):
     except:
         priority = 0
 
-    condition = threading.Condition()
-    with condition:
-        id = str(uuid.uuid4())
-        data = (audio_tensor,prefix,input_language,output_language,memory)
+    data = (audio_tensor,prefix,input_language,output_language,memory)
 
-        queue_in.put(Priority(priority,id,condition,data))
-
-        condition.wait()
-
-    result = dict_out.pop(id)
+    result = dict(scheduler.submit(data, priority))
     status = 200
-    if status in result:
-        status = result.pop(status)
+    if "status" in result:
+        status = result.pop("status")
 
     # result has to contain a key "hypo" with a string as value (other optional keys are possible)
     return json.dumps(result), status
@@ -195,11 +115,7 @@ def version():
 
 model, max_batch_size = initialize_model()
 
-queue_in = queue.PriorityQueue()
-dict_out = {}
-
-decoding = threading.Thread(target=run_decoding)
-decoding.daemon = True
-decoding.start()
+scheduler = RequestBatchScheduler(use_model, max_batch_size=max_batch_size, batch_key=get_batch_key)
+scheduler.start()
 
 app.run(host=host, port=port)
@@ -1,4 +1,5 @@
 import numpy as np
+from collections import OrderedDict, namedtuple
 from contextlib import contextmanager
 import io
 from io import TextIOBase
@@ -6,7 +7,7 @@ import os
 import subprocess
 import sys
 import warnings
-from functools import partial
+from functools import partial, lru_cache
 from io import BytesIO
 from io import StringIO
 import re
@@ -386,15 +387,110 @@ def safe_readaudio_from_cache(file_, start=0.0, end=0.0, sample_rate=16000):
     tensor = tensor[:, 0].unsqueeze(1)
     return tensor
 
+@lru_cache(maxsize=1024)
+def _read_audio_header(wav_path):
+    info = soundfile.info(wav_path)
+    return info.frames, info.samplerate
+
+
+def audio_segment_length(wav_path, start=0.0, end=-1.0):
+    """
+    Number of frames of a segment of an audio file, computed from the header only (the audio is not decoded).
+    This is the length of the tensor of safe_readaudio_from_cache with the sample rate of the file.
+    :param wav_path: path of the audio file
+    :param start: start of the segment in seconds
+    :param end: end of the segment in seconds (until the end of the file if end <= start)
+    :return: length, sample rate of the file
+    """
+    frames, sample_rate = _read_audio_header(wav_path)
+
+    offset = min(math.floor(sample_rate * start), frames)
+    length = frames - offset
+    if end > start:
+        length = min(length, math.ceil(sample_rate * (end - start)))
+
+    return length, sample_rate
+
+
+_CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+def _open_audio(path):
+    return soundfile.SoundFile(path, 'r')
+
+
+class FileHandleCache(object):
+    """
+    Bounded LRU cache of open audio files (many utterances are segments of the same file).
+    Lookups, insertions and evictions are O(1). The least recently used file is closed when the cache is full.
+    """
+
+    def __init__(self, cache_size=512, opener=None):
+        """
+        :param cache_size: maximum number of open files
+        :param opener: function opening a path (default: soundfile.SoundFile for reading)
+        """
+        self.cache_size = cache_size
+        self.opener = opener if opener is not None else _open_audio
+        self.files = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """
+        :param path: path of the file
+        :return: the open file (it stays open until it is evicted)
+        """
+        file_ = self.files.get(path)
+        if file_ is not None:
+            self.hits += 1
+            self.files.move_to_end(path)
+            return file_
+
+        self.misses += 1
+        file_ = self.opener(path)
+        self.files[path] = file_
+
+        # the new file is the most recently used one, it is never evicted here
+        while len(self.files) > self.cache_size:
+            _, evicted = self.files.popitem(last=False)
+            evicted.close()
+
+        return file_
+
+    def __getstate__(self):
+        # the open files are not copied to the other processes
+        state = self.__dict__.copy()
+        state['files'] = OrderedDict()
+        return state
+
+    def cache_info(self):
+        """
+        The counters are those of this process: each data loader worker has its own copy of the cache
+        :return: hits, misses, maxsize, currsize (same as functools.lru_cache)
+        """
+        return _CacheInfo(self.hits, self.misses, self.cache_size, len(self.files))
+
+    def close(self):
+        for file_ in self.files.values():
+            file_.close()
+        self.files.clear()
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, path):
+        return path in self.files
+
+
 class WavLoader(object):
 
     def __init__(self, cache_size=512):
         """
-        :param scp_path_list: list of path to the ark matrices
+        :param cache_size: maximum number of open wav files
         """
         if cache_size > 0:
-            self.cache = dict()
-            self.usage = dict()
+            self.cache = FileHandleCache(cache_size)
         else:
             self.cache = None
         self.cache_size = cache_size
@@ -402,30 +498,22 @@ class WavLoader(object):
     def load_wav(self, wav_path, start, end, sample_rate=16000):
 
         # take the object in cache if exists
-        if wav_path in self.cache:
-            file_ = self.cache[wav_path]
-            self.usage[wav_path] = self.usage[wav_path] + 1
+        if self.cache is not None:
+            file_ = self.cache.get(wav_path)
+            data = safe_readaudio_from_cache(file_, start, end, sample_rate)
         else:
-            # read the audio file
-            # print(os.path.exists(wav_path), wav_path)
-            file_ = soundfile.SoundFile(wav_path, 'r')
-            if len(self.cache) > self.cache_size:
-                # remove 1 file from cache based on lowest usage, maybe?
-                min_key = min(self.usage, key=self.usage.get)
-                if min_key != wav_path:  # don't close the current file
-                    self.cache[min_key].close()
-                    self.cache.pop(min_key, None)
-                    self.usage.pop(min_key, None)
-
-            # add the object to the cache
-            self.cache[wav_path] = file_
-            self.usage[wav_path] = 1
-
-        data = safe_readaudio_from_cache(file_, start, end, sample_rate)
+            with soundfile.SoundFile(wav_path, 'r') as file_:
+                data = safe_readaudio_from_cache(file_, start, end, sample_rate)
 
         return data
 
+    def cache_info(self):
+        """
+        :return: hits, misses, maxsize, currsize of the file cache (of this process) or None
+        """
+        return self.cache.cache_info() if self.cache is not None else None
+
     def close(self):
 
-        for wav_path in self.cache:
-            self.cache[wav_path].close()
\ No newline at end of file
+        if self.cache is not None:
+            self.cache.close()
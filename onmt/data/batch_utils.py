@@ -1,7 +1,13 @@
-import numpy as np
+import hashlib
+import os
+import time
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-# from .fast_extensions import
+import numpy as np
 
 
 def _is_oversized(cur_batch, new_sent_size, cur_batch_sizes, batch_size_words, batch_size_sents):
@@ -156,40 +162,238 @@ def allocate_batch_unbalanced_slow(indices, lengths,
     return batches
 
 
+class BatchList(object):
+    """
+    Mini-batches stored as one flat array of sample indices and the offsets of the batches in it
+    (batch i is flat[offsets[i]:offsets[i+1]]). Indexing returns the sample indices of one batch as a list,
+    so it can be used like the list of batches.
+    """
+
+    def __init__(self, flat, offsets):
+        self.flat = np.asarray(flat, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.select(np.arange(len(self))[i])
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("batch index out of range")
+
+        return self.flat[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.flat[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+    def sizes(self):
+        """
+        :return: number of samples of each batch
+        """
+        return np.diff(self.offsets)
+
+    def select(self, batch_ids):
+        """
+        :param batch_ids: ids of the batches to keep, in the new order (can be repeated)
+        :return: BatchList
+        """
+        batch_ids = np.asarray(batch_ids, dtype=np.int64)
+        sizes = self.sizes()[batch_ids]
+        offsets = np.zeros(len(batch_ids) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+
+        positions = np.arange(offsets[-1]) + np.repeat(self.offsets[:-1][batch_ids] - offsets[:-1], sizes)
+
+        return BatchList(self.flat[positions], offsets)
+
+    def repeat(self, factor):
+        """
+        :param factor: number of times each batch is repeated (consecutively)
+        :return: BatchList
+        """
+        return self.select(np.repeat(np.arange(len(self)), factor))
+
+
+def _max_batch_lengths(oversized, maxima, num_items, max_sents, chunk_size=1 << 20):
+    """
+    Length of the longest batch that can start at each position, found by binary lifting over
+    the range maxima (sparse table) of the sizes. The batch [s, s + L) is allowed if L == 1 or
+    not oversized(L, maxima of the sizes in [s, s + L)). oversized has to be monotone in L.
+
+    :param oversized: function (lengths, list of maxima) -> boolean array
+    :param maxima: list of size arrays (in the order of the batches)
+    :param num_items: number of items
+    :param max_sents: upper bound of the batch length
+    :param chunk_size: number of start positions processed at once
+    :return: generator of (chunk start, array of the maximum batch length of the positions in the chunk)
+    """
+    max_sents = max(1, min(max_sents, num_items))
+    n_levels = int(max_sents).bit_length()
+    overlap = 1 << n_levels
+    # a batch never skips a whole chunk
+    chunk_size = max(chunk_size, overlap)
+
+    for chunk_start in range(0, num_items, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, num_items)
+        n = chunk_end - chunk_start
+
+        # tables[b][k][i]: maximum of the k-th sizes in [chunk_start + i, chunk_start + i + 2^b)
+        # (zero padded after the last item, the lengths are bounded by the number of items anyway)
+        tables = []
+        for sizes in maxima:
+            level = np.zeros(n + 2 * overlap, dtype=np.int64)
+            window = sizes[chunk_start:chunk_end + overlap]
+            level[:len(window)] = window
+            levels = [level]
+            for b in range(1, n_levels):
+                step = 1 << (b - 1)
+                level = level.copy()
+                np.maximum(level[:-step], level[step:], out=level[:-step])
+                levels.append(level)
+            tables.append(levels)
+
+        positions = np.arange(n)
+        remaining = num_items - chunk_start - positions
+        lengths = np.ones(n, dtype=np.int64)
+        current = [levels[0][:n].copy() for levels in tables]
+
+        for b in reversed(range(n_levels)):
+            candidates = lengths + (1 << b)
+            candidate_max = [np.maximum(cur, levels[b][positions + lengths])
+                             for cur, levels in zip(current, tables)]
+
+            accept = (candidates <= remaining) & (candidates <= max_sents) & ~oversized(candidates, candidate_max)
+            lengths = np.where(accept, candidates, lengths)
+            current = [np.where(accept, new, cur) for cur, new in zip(current, candidate_max)]
+
+        yield chunk_start, lengths
+
+
+def _greedy_batches(chunks, num_items, batch_size_multiplier):
+    """
+    Follow the greedy allocation (one batch after the other) with the maximum batch lengths.
+    When a batch is full it is trimmed to a multiple of batch_size_multiplier and the rest is moved to the next batch,
+    together with the item that did not fit.
+
+    :return: array of the batch offsets
+    """
+    offsets = [0]
+    start = 0
+    # the items up to this position are already in the current batch
+    forced_end = 1
+
+    for chunk_start, max_lengths in chunks:
+        chunk_end = chunk_start + len(max_lengths)
+        while start < chunk_end:
+            length = max(int(max_lengths[start - chunk_start]), forced_end - start)
+
+            if start + length >= num_items:
+                start = num_items
+                break
+
+            scaled_size = max(batch_size_multiplier * (length // batch_size_multiplier),
+                              length % batch_size_multiplier)
+            forced_end = start + length + 1
+            start = start + scaled_size
+            offsets.append(start)
+
+    if start > offsets[-1]:
+        offsets.append(start)
+
+    return np.asarray(offsets, dtype=np.int64)
+
+
+def fast_batch_allocate(indices, lengths, batch_size_words, batch_size_sents, batch_size_multiplier):
+    """
+    Vectorized version of allocate_batch_slow (without the cleaning)
+
+    :param indices: array of the (cleaned) sample indices in the order of the batches
+    :param lengths: sizes used to count the number of tokens of the batch
+    :return: BatchList
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    sizes = np.asarray(lengths, dtype=np.int64)[indices]
+
+    def oversized(candidates, maxima):
+        return maxima[0] * candidates > batch_size_words
+
+    # no batch can be longer than this (fewer levels in the lifting)
+    if len(sizes) > 0 and sizes.min() > 0:
+        batch_size_sents = min(batch_size_sents, batch_size_words // int(sizes.min()) + 1)
+
+    chunks = _max_batch_lengths(oversized, [sizes], len(indices), batch_size_sents)
+
+    return BatchList(indices, _greedy_batches(chunks, len(indices), batch_size_multiplier))
+
+
+def fast_batch_allocate_unbalanced(indices, src_sizes, tgt_sizes,
+                                   batch_size_frames, batch_size_words, batch_size_sents, batch_size_multiplier,
+                                   cut_off_size, smallest_batch_size):
+    """
+    Vectorized version of allocate_batch_unbalanced_slow (without the cleaning)
+
+    :param indices: array of the (cleaned) sample indices in the order of the batches
+    :return: BatchList
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    frames = np.asarray(src_sizes, dtype=np.int64)[indices]
+    words = np.asarray(tgt_sizes, dtype=np.int64)[indices]
+
+    def oversized(candidates, maxima):
+        max_frames, max_words = maxima
+        return (((max_frames > cut_off_size) & (candidates - 1 >= smallest_batch_size))
+                | (max_frames * candidates > batch_size_frames)
+                | (max_words * candidates > batch_size_words))
+
+    # no batch can be longer than this (fewer levels in the lifting)
+    if len(frames) > 0 and frames.min() > 0:
+        batch_size_sents = min(batch_size_sents, batch_size_frames // int(frames.min()) + 1)
+    if len(words) > 0 and words.min() > 0:
+        batch_size_sents = min(batch_size_sents, batch_size_words // int(words.min()) + 1)
+
+    chunks = _max_batch_lengths(oversized, [frames, words], len(indices), batch_size_sents)
+
+    return BatchList(indices, _greedy_batches(chunks, len(indices), batch_size_multiplier))
+
+
+def _clean_indices(indices, src_sizes, tgt_sizes,
+                   max_src_len, max_tgt_len, min_src_len, min_tgt_len):
+    # the minimum lengths are exclusive here (same as the previous Cython allocation)
+    keep = np.ones(len(indices), dtype=bool)
+    if src_sizes is not None:
+        src_sizes = np.asarray(src_sizes)[indices]
+        keep &= (min_src_len < src_sizes) & (src_sizes < max_src_len)
+    if tgt_sizes is not None:
+        tgt_sizes = np.asarray(tgt_sizes)[indices]
+        keep &= (min_tgt_len < tgt_sizes) & (tgt_sizes < max_tgt_len)
+
+    return indices[keep]
+
+
 def allocate_batch(indices, lengths,
                    src_sizes, tgt_sizes,
                    batch_size_words, batch_size_sents, batch_size_multiplier,
                    max_src_len, max_tgt_len,
                    min_src_len, min_tgt_len, cleaning=1):
 
-    try:
-        import pyximport
-        cython_available = True
-    except ModuleNotFoundError as e:
-        cython_available = False
-
-    if not cython_available or (tgt_sizes is None or src_sizes is None):
+    if tgt_sizes is None or src_sizes is None:
         return allocate_batch_slow(indices, lengths, src_sizes, tgt_sizes,
                                    batch_size_words, batch_size_sents, batch_size_multiplier,
                                    max_src_len, max_tgt_len,
                                    min_src_len, min_tgt_len, cleaning)
 
-    pyximport.install(setup_args={"include_dirs": np.get_include()},
-                      inplace=True)
-    from .fast_extensions import fast_batch_allocate
+    indices = np.asarray(indices, dtype=np.int64)
 
-    cleaning = int(cleaning)
-
-    if isinstance(indices, list):
-        indices = np.asarray(indices)
-    # convert to np int64
-
-    return fast_batch_allocate(indices, lengths,
-                               src_sizes, tgt_sizes,
-                               batch_size_words, batch_size_sents, batch_size_multiplier,
-                               max_src_len, max_tgt_len,
-                               min_src_len, min_tgt_len, cleaning)
+    if int(cleaning) == 1:
+        indices = _clean_indices(indices, src_sizes, tgt_sizes,
+                                 max_src_len, max_tgt_len, min_src_len, min_tgt_len)
 
+    return fast_batch_allocate(indices, lengths, batch_size_words, batch_size_sents, batch_size_multiplier)
 
 
 def allocate_batch_unbalanced(indices, lengths,
@@ -200,13 +404,7 @@ def allocate_batch_unbalanced(indices, lengths,
                                min_src_len, min_tgt_len, cleaning=1,
                                cut_off_size=256000, smallest_batch_size=4):
 
-    try:
-        import pyximport
-        cython_available = True
-    except ModuleNotFoundError as e:
-        cython_available = False
-
-    if not cython_available or (tgt_sizes is None or src_sizes is None):
+    if tgt_sizes is None or src_sizes is None:
         return allocate_batch_unbalanced_slow(indices, lengths, src_sizes, tgt_sizes,
                                               batch_size_frames, batch_size_words,
                                               batch_size_sents, batch_size_multiplier,
@@ -214,25 +412,139 @@ def allocate_batch_unbalanced(indices, lengths,
                                               min_src_len, min_tgt_len, cleaning,
                                               cut_off_size, smallest_batch_size)
 
-    pyximport.install(setup_args={"include_dirs": np.get_include()},
-                      inplace=True)
-    from .fast_extensions import fast_batch_allocate_unbalance
+    indices = np.asarray(indices, dtype=np.int64)
+
+    if int(cleaning) == 1:
+        indices = _clean_indices(indices, src_sizes, tgt_sizes,
+                                 max_src_len, max_tgt_len, min_src_len, min_tgt_len)
+
+    return fast_batch_allocate_unbalanced(indices, src_sizes, tgt_sizes,
+                                          batch_size_frames, batch_size_words,
+                                          batch_size_sents, batch_size_multiplier,
+                                          cut_off_size, smallest_batch_size)
+
+
+_BATCH_CACHE_VERSION = 1
+
+
+def sizes_digest(sizes, *versions, **options):
+    """
+    :param sizes: list of the size arrays of the data (or None)
+    :param versions: values hashed before the sizes (format versions)
+    :param options: the options the data was processed with
+    :return: hex digest of the sizes and of the options
+    """
+    fingerprint = hashlib.sha1()
+    for version in versions:
+        fingerprint.update(str(version).encode())
+    for sizes_ in sizes:
+        if sizes_ is None:
+            fingerprint.update(b'none')
+        else:
+            sizes_ = np.ascontiguousarray(sizes_)
+            fingerprint.update(("%s %d" % (sizes_.dtype.str, len(sizes_))).encode())
+            fingerprint.update(sizes_)
+    fingerprint.update(repr(sorted(options.items())).encode())
+
+    return fingerprint.hexdigest()
+
+
+def batch_cache_path(prefix, sizes, **options):
+    """
+    :param prefix: prefix of the cache files (next to the data)
+    :param sizes: list of the size arrays of the data (or None)
+    :param options: the options of the sorting and the batch allocation
+    :return: prefix of the cache files for this data and these options
+    """
+    return "%s.batches.%s" % (prefix, sizes_digest(sizes, _BATCH_CACHE_VERSION, **options)[:16])
+
+
+def save_batch_cache(path, batches):
+    """
+    Write the batches into the cache files (atomically, the offsets are written last)
+    :param path: prefix of the cache files (from batch_cache_path)
+    :param batches: BatchList
+    """
+    for array, name in [(batches.flat, path + '.flat.npy'), (batches.offsets, path + '.offsets.npy')]:
+        tmp_name = "%s.tmp%d" % (name, os.getpid())
+        with open(tmp_name, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_name, name)
+
+
+def load_batch_cache(path):
+    """
+    :param path: prefix of the cache files (from batch_cache_path)
+    :return: BatchList (memory-mapped) or None if the cache does not exist
+    """
+    if not os.path.exists(path + '.offsets.npy'):
+        return None
 
-    cleaning = int(cleaning)
-
-    if isinstance(indices, list):
-        indices = np.asarray(indices)
-    # convert to np int64
-
-    return fast_batch_allocate_unbalance(indices,
-                                         src_sizes, tgt_sizes,
-                                         batch_size_frames, batch_size_words,
-                                         batch_size_sents, batch_size_multiplier,
-                                         max_src_len, max_tgt_len,
-                                         min_src_len, min_tgt_len, cleaning,
-                                         cut_off_size, smallest_batch_size)
+    try:
+        return BatchList(np.load(path + '.flat.npy', mmap_mode='r'),
+                         np.load(path + '.offsets.npy', mmap_mode='r'))
+    except (OSError, ValueError) as e:
+        print("[WARNING] Cannot read the batch cache %s (%s)" % (path, e))
+        return None
+
+
+def cached_allocation(path, allocate, timeout=3600):
+    """
+    Load the batches from the cache, or allocate and save them. Only one process computes the batches:
+    the others wait for its cache on a lock (flock, released by the system if the process dies).
+
+    :param path: prefix of the cache files (from batch_cache_path)
+    :param allocate: function returning the batches
+    :param timeout: maximum waiting time in seconds for another process
+    :return: batches (BatchList if it comes from the cache)
+    """
+    batches = load_batch_cache(path)
+    if batches is not None:
+        print("[INFO] Loaded %d batches from the cache %s" % (len(batches), path))
+        return batches
+
+    if fcntl is None:
+        # the cache files are written atomically, the processes only compute the batches several times
+        lock = None
+    else:
+        try:
+            lock = open(path + '.lock', 'a')
+        except OSError as e:
+            print("[WARNING] Cannot create the batch cache %s (%s)" % (path, e))
+            return allocate()
 
+    try:
+        if lock is not None:
+            start = time.time()
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.time() - start >= timeout:
+                        print("[WARNING] Timeout while waiting for the batch cache %s" % path)
+                        return allocate()
+                    time.sleep(1)
+
+            # the previous owner of the lock may have written the cache
+            batches = load_batch_cache(path)
+            if batches is not None:
+                print("[INFO] Loaded %d batches from the cache %s" % (len(batches), path))
+                return batches
+
+        batches = allocate()
+        if isinstance(batches, BatchList):
+            try:
+                save_batch_cache(path, batches)
+                print("[INFO] Saved %d batches to the cache %s" % (len(batches), path))
+            except OSError as e:
+                print("[WARNING] Cannot write the batch cache %s (%s)" % (path, e))
+    finally:
+        # the lock file stays, removing it would let another process lock a new file while one waits on the old
+        if lock is not None:
+            lock.close()
 
+    return batches
 
 
 def allocate_batch_simple(indices,
@@ -11,7 +11,7 @@ import torch.multiprocessing as mp
 import torch
 import onmt
 import numpy as np
-from .audio_utils import ArkLoader
+from .audio_utils import ArkLoader, audio_segment_length
 
 
 class SpeechBinarizer:
@@ -129,18 +129,17 @@ class SpeechBinarizer:
 
                     if verbose:
                         print("processing wav file ...", wavpath, start_time, end_time)
-                    # feature_vector = safe_readaudio(wavpath, start_time, end_time, sample_rate=sample_rate)
-                    if start_time == 0 or end_time == -1:
-                        feature_vector = ark_loader.load_wav(wavpath, start_time, end_time,sample_rate=sample_rate)
-                    else:
-                        feature_vector = None
+
+                    # the length of the segment is computed from the header of the file (without decoding)
+                    # with the sample rate of the file, which is also used to load the segment during training
+                    length, file_sample_rate = audio_segment_length(wavpath, start_time, end_time)
+                    feature_vector = None
+
                     # store a tuple of data and information to load the wav again during training
-                    data.append((wavpath, start_time, end_time, sample_rate))
+                    data.append((wavpath, start_time, end_time, file_sample_rate))
 
                 if feature_vector is not None:
                     length = feature_vector.size(0)
-                else:
-                    length = int(16000 * (end_time - start_time))
                 lengths.append(length)
                 # if verbose and length > 256000:
                 #     print('length: ', length)
@@ -180,10 +179,8 @@ class SpeechBinarizer:
         for i in range(num_workers):
             if input_format in ['scp', 'kaldi']:
                 ark_loaders[i] = ArkLoader()
-            elif input_format in ['wav']:
-                from .audio_utils import WavLoader
-                ark_loaders[i] = WavLoader()
             else:
+                # the wav files are only probed (see audio_segment_length)
                 ark_loaders[i] = None
 
         if num_workers > 1:
@@ -260,10 +257,13 @@ class Binarizer:
     @staticmethod
     def binarize_file_single_thread(filename, tokenizer, vocab, worker_id=0, bos_word=None, eos_word=None,
                                     offset=0, end=-1, data_type='int64', verbose=False,
-                                    external_tokenizer=[None, None], lang=None, target=False):
+                                    external_tokenizer=[None, None], lang=None, target=False,
+                                    out_prefix=None, out_dtype=np.int32):
         """
         This function should read in the lines, convert sentences to tensors
         And then finalize into a dataset?
+        If out_prefix is given, the sentences are written to the memory indexed dataset out_prefix (.bin/.idx)
+        instead of being returned (only the sizes are returned).
         """
 
         result = dict()
@@ -271,6 +271,14 @@ class Binarizer:
         data = list()
         sizes = list()
 
+        if out_prefix is not None:
+            from .mmap_indexed_dataset import MMapIndexedDatasetBuilder, data_file_path, index_file_path
+            builder = MMapIndexedDatasetBuilder(data_file_path(out_prefix), dtype=out_dtype)
+            add_item = builder.add_item
+        else:
+            builder = None
+            add_item = data.append
+
         count = 0
         ext_tokenizer, external_tokenizer_name = external_tokenizer
 
@@ -293,7 +301,7 @@ class Binarizer:
 
                     # move to shared_memory to transfer between threads
                     # conversion to numpy is necessary because torch.Tensor is not serializable by the mprocess
-                    data += [binarized_line.numpy()]
+                    add_item(binarized_line.numpy())
                     sizes += [len(tokenized_sent)]
 
                 else:
@@ -344,7 +352,7 @@ class Binarizer:
                     elif data_type == "int16":
                         _dtype = np.int16
 
-                    data += [np.asarray(tensor, dtype=_dtype)]
+                    add_item(np.asarray(tensor, dtype=_dtype))
 
                 line = f.readline()
 
@@ -357,6 +365,12 @@ class Binarizer:
             if n_bad_sentences > 0:
                 print("[Warning] %d empty sentence including <bos> <eos>" % n_bad_sentences)
             print("[INFO] Thread %d Done." % worker_id)
+
+        if builder is not None:
+            builder.finalize(index_file_path(out_prefix))
+            # a numpy array is much cheaper to send back to the main process than a list
+            sizes = np.asarray(sizes, dtype=np.int64)
+
         result['data'] = data
         result['sizes'] = sizes
         result['id'] = worker_id
@@ -367,7 +381,13 @@ class Binarizer:
     @staticmethod
     def binarize_file(filename, vocab, tokenizer, bos_word=None, eos_word=None,
                       data_type='int64', num_workers=1, verbose=False, external_tokenizer="",
-                      lang=None, lang_list=[], target=False):
+                      lang=None, lang_list=[], target=False, out_prefix=None, out_dtype=np.int32):
+        """
+        :param out_prefix: if given, the binarized sentences are written to the memory indexed dataset
+        out_prefix (.bin/.idx) instead of being kept in memory: each worker writes its part of the file
+        into a shard, then the shards are concatenated. The returned data is None and the sizes are a numpy array.
+        :param out_dtype: dtype of the memory indexed dataset
+        """
 
         if "mbart-large-50" in external_tokenizer.lower():
 
@@ -459,6 +479,11 @@ class Binarizer:
 
         offsets = Binarizer.find_offsets(filename, num_workers)
 
+        if out_prefix is not None:
+            shard_prefixes = ["%s.shard%d" % (out_prefix, worker_id) for worker_id in range(num_workers)]
+        else:
+            shard_prefixes = [None for _ in range(num_workers)]
+
         if num_workers > 1:
 
             pool = mp.Pool(processes=num_workers)
@@ -468,7 +493,8 @@ class Binarizer:
                 mp_results.append(pool.apply_async(
                     Binarizer.binarize_file_single_thread,
                     args=(filename, tokenizer, vocab, worker_id, bos_word, eos_word,
-                          offsets[worker_id], offsets[worker_id + 1], data_type, verbose, ext_tokenizer, lang, target),
+                          offsets[worker_id], offsets[worker_id + 1], data_type, verbose, ext_tokenizer, lang, target,
+                          shard_prefixes[worker_id], out_dtype),
                 ))
 
             pool.close()
@@ -481,9 +507,26 @@ class Binarizer:
             sp_result = Binarizer.binarize_file_single_thread(filename, tokenizer, vocab, 0, bos_word, eos_word,
                                                               offsets[0], offsets[1], data_type,
                                                               external_tokenizer=ext_tokenizer,
-                                                              lang=lang, target=target)
+                                                              lang=lang, target=target,
+                                                              out_prefix=shard_prefixes[0], out_dtype=out_dtype)
             merge_result(sp_result)
 
+        if out_prefix is not None:
+            from .mmap_indexed_dataset import MMapIndexedDatasetBuilder, data_file_path, index_file_path
+
+            # concatenate the shards in the order of the workers
+            builder = MMapIndexedDatasetBuilder(data_file_path(out_prefix), dtype=out_dtype)
+            for shard_prefix in shard_prefixes:
+                builder.merge_file_(shard_prefix)
+                os.remove(data_file_path(shard_prefix))
+                os.remove(index_file_path(shard_prefix))
+            builder.finalize(index_file_path(out_prefix))
+
+            final_result['data'] = None
+            final_result['sizes'] = np.concatenate([result[idx]['sizes'] for idx in range(num_workers)])
+
+            return final_result
+
         final_result['data'] = list()
         final_result['sizes'] = list()
 
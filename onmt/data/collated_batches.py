@@ -0,0 +1,90 @@
+import os
+
+import torch
+
+from .dataset import LightBatch
+from .batch_utils import sizes_digest
+
+
+class CollatedBatches(object):
+    """
+    The collated mini-batches of a dataset that never changes (the validation data): the data iterator
+    reads and collates them once, and every evaluation replays the same light batches.
+    They can be kept in pinned memory (asynchronous copies to the GPU), or written to a file that is
+    memory-mapped by the later runs (the audio is not decoded again).
+    """
+
+    def __init__(self, batches):
+        """
+        :param batches: list of light batches (the outputs of the collater)
+        """
+        self.batches = batches
+
+    @classmethod
+    def from_iterator(cls, data_iterator):
+        """
+        :param data_iterator: DataIterator or MultiDataIterator (one epoch without shuffling is read)
+        :return: CollatedBatches with the non-empty batches of the epoch
+        """
+        epoch_iterator = data_iterator.next_epoch_itr(False, pin_memory=False)
+        batches = list()
+
+        for samples in epoch_iterator:
+            if samples:
+                batches.append(samples[0] if isinstance(samples, list) else samples)
+
+        return cls(batches)
+
+    @staticmethod
+    def data_digest(data_iterator):
+        """
+        :param data_iterator: DataIterator or MultiDataIterator
+        :return: digest of the source and target sizes of its datasets (for the signature of save)
+        """
+        datasets = [itr.dataset for itr in getattr(data_iterator, 'data_iterators', [data_iterator])]
+
+        return sizes_digest([getattr(dataset, name, None) for dataset in datasets
+                             for name in ['src_sizes', 'tgt_sizes']])
+
+    @classmethod
+    def load(cls, file_name, signature=None):
+        """
+        :param file_name: file written by save
+        :param signature: the signature given to save (the file is ignored if it was written for other data)
+        :return: CollatedBatches with the memory-mapped tensors of the file, or None
+        """
+        if not os.path.exists(file_name):
+            return None
+
+        data = torch.load(file_name, mmap=True)
+        if data['signature'] != signature:
+            print("[WARNING] The batches of %s were collated for other data, collating them again" % file_name)
+            return None
+
+        return cls([LightBatch(tensors) for tensors in data['batches']])
+
+    def save(self, file_name, signature=None):
+        """
+        :param file_name: the batches are written to a temporary file renamed to file_name when it is complete
+        :param signature: description of the data (number of batches, shard ...) checked by load
+        """
+        tmp_name = "%s.tmp%d" % (file_name, os.getpid())
+        try:
+            torch.save({'signature': signature, 'batches': [batch.tensors for batch in self.batches]}, tmp_name)
+            os.replace(tmp_name, file_name)
+        finally:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+
+    def pin_memory(self):
+        """
+        Pin the tensors of the batches, so that their copies to the GPU are asynchronous
+        """
+        self.batches = [batch.pin_memory() for batch in self.batches]
+        return self
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
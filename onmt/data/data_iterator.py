@@ -16,6 +16,7 @@ import torch
 from onmt.data.dataset import rewrap
 
 from onmt.data import data_utils
+from onmt.data.batch_utils import BatchList
 
 _sentinel = object()
 
@@ -147,7 +148,8 @@ class DataIterator(EpochBatchIterating):
 
         self.dataset = dataset
         self.collate_fn = collate_fn
-        self.frozen_batches = tuple(batch_sampler)  # ??
+        # a BatchList is kept as it is, the batches of each epoch are gathered from it
+        self.frozen_batches = batch_sampler if isinstance(batch_sampler, BatchList) else tuple(batch_sampler)
         self.seed = seed
         self.num_workers = num_workers
         self.epoch = max(epoch, 1)
@@ -243,32 +245,41 @@ class DataIterator(EpochBatchIterating):
             itr_pos = 0
             self._next_epoch_itr = None
 
-    def _get_iterator_for_epoch(self, epoch, shuffle, offset=0, pin_memory=False):
-
-        def shuffle_batches(batches_, seed):
-            with data_utils.numpy_seed(seed):
-                np.random.shuffle(batches_)
-
-            return batches_
-
-        if self._support_prefetch:
-            raise NotImplementedError
+    def _get_batches_for_epoch(self, epoch, shuffle):
+        """
+        :return: the (shuffled) batches of this shard for the epoch, a BatchList if the batches are one
+        """
+        # shuffle and shard the batch ids, only the batches of this shard are gathered
+        batch_ids = np.arange(len(self.frozen_batches))
 
         if shuffle:
-            batches = shuffle_batches(list(self.frozen_batches), self.seed + epoch)
-        else:
-            batches = list(self.frozen_batches)
+            with data_utils.numpy_seed(self.seed + epoch):
+                np.random.shuffle(batch_ids)
 
+        batch_ids = batch_ids.tolist()
         num_shards = self.num_shards
 
         # if split even then fill the batch with random batches
         if self.split_even:
-            if len(batches) % self.num_shards != 0:
-                for _ in range(num_shards - (len(batches) % num_shards)):
-                    rand_id = random.randint(0, len(batches) - 1)
-                    batches.append(batches[rand_id])
+            if len(batch_ids) % self.num_shards != 0:
+                for _ in range(num_shards - (len(batch_ids) % num_shards)):
+                    rand_id = random.randint(0, len(batch_ids) - 1)
+                    batch_ids.append(batch_ids[rand_id])
+
+        batch_ids = list(ShardedIterator(batch_ids, num_shards, self.shard_id,
+                                         fill_value=batch_ids[0] if len(batch_ids) > 0 else None))
+
+        if isinstance(self.frozen_batches, BatchList):
+            return self.frozen_batches.select(batch_ids)
+
+        return [self.frozen_batches[i] for i in batch_ids]
+
+    def _get_iterator_for_epoch(self, epoch, shuffle, offset=0, pin_memory=False):
+
+        if self._support_prefetch:
+            raise NotImplementedError
 
-        batches = list(ShardedIterator(batches, num_shards, self.shard_id, fill_value=batches[0]))
+        batches = self._get_batches_for_epoch(epoch, shuffle)
 
         # catch the exception when the data is so small that one iterator is completely empty
         if len(batches) == 0:
@@ -8,11 +8,13 @@ import onmt
 from onmt.speech.Augmenter import Augmenter
 from onmt.modules.dropout import switchout
 import numpy as np
-from .batch_utils import allocate_batch, allocate_batch_unbalanced, allocate_batch_simple
+from .batch_utils import allocate_batch, allocate_batch_unbalanced, allocate_batch_simple, BatchList, \
+    batch_cache_path, cached_allocation
 import dill
 import random
 
 from onmt.data.indexed_file import read_data
+from onmt.data.mmap_indexed_dataset import MMapIndexedDataset, MMapColumnDataset
 
 """
 Data management for sequence-to-sequence models
@@ -118,8 +120,122 @@ def merge_concat_data(data, type="text", src_pad=0, tgt_pad=0,
     return src_tensor, tgt_tensor, src_lang_tensor, tgt_lang_tensor, src_lengths, tgt_lengths
 
 
+class MergedData(object):
+    """
+    Sequences of a mini-batch that are already padded into one tensor (see MMapIndexedDataset.get_batch)
+    """
+
+    def __init__(self, tensor, lengths, align_right=False):
+        self.tensor = tensor
+        self.lengths = lengths
+        self.align_right = align_right
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        """
+        :return: sequence i without the padding (a view of the batch tensor)
+        """
+        length = self.lengths[i]
+        offset = self.tensor.size(1) - length if self.align_right else 0
+
+        return self.tensor[i].narrow(0, offset, length)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+_fast_collate = None
+
+
+def load_fast_collate():
+    """
+    Import the Cython collation kernels, built with the package (python setup.py build_ext --inplace)
+    :return: the fast_collate module, or None if the extension is not built
+    """
+    global _fast_collate
+
+    if _fast_collate is None:
+        try:
+            from . import fast_collate
+            _fast_collate = fast_collate
+        except ImportError as e:
+            print("[WARNING] The fast collation kernels are not built (%s), using the python code" % e)
+            _fast_collate = False
+
+    return _fast_collate if _fast_collate else None
+
+
+def collate_text(data, pad, align_right=False, pin_memory=False, use_fast_collate=True):
+    """
+    :param data: list of 1D tensors
+    :param pad: padding value
+    :param align_right: pad on the left side
+    :param pin_memory: allocate the batch in pinned memory
+    :param use_fast_collate: use the Cython kernel if it is available
+    :return: tensor batch_size x max_length, list of the lengths
+    """
+    lengths = [x.size(0) for x in data]
+    max_length = max(lengths)
+
+    fast_collate = load_fast_collate() if use_fast_collate else None
+    if fast_collate is not None and data[0].dtype == torch.long:
+        # the kernel only writes the padding where it is needed
+        tensor = torch.empty(len(data), max_length, dtype=torch.long, pin_memory=pin_memory)
+        fast_collate.fast_collate_text([np.ascontiguousarray(x.numpy()) for x in data], tensor.numpy(),
+                                       pad, int(align_right))
+    else:
+        tensor = torch.full((len(data), max_length), pad, dtype=data[0].dtype, pin_memory=pin_memory)
+        for i in range(len(data)):
+            data_length = data[i].size(0)
+            offset = max_length - data_length if align_right else 0
+            tensor[i].narrow(0, offset, data_length).copy_(data[i])
+
+    return tensor, lengths
+
+
+def collate_audio(samples, align_right=False, pin_memory=False, use_fast_collate=True):
+    """
+    :param samples: list of 2D tensors (length x feature_size)
+    :param align_right: pad on the left side
+    :param pin_memory: allocate the batch in pinned memory
+    :param use_fast_collate: use the Cython kernel if it is available
+    :return: float tensor batch_size x max_length x (feature_size + 1), list of the lengths.
+    The first channel is the padding indicator: 1 is not padded, 0 is padded
+    """
+    lengths = [x.size(0) for x in samples]
+    max_length = max(lengths)
+    feature_size = samples[0].size(1)
+
+    for i, sample in enumerate(samples):
+        if sample.dim() != 2 or sample.size(1) != feature_size:
+            raise ValueError("Sample %d has shape %s, expected (length, %d)" % (i, tuple(sample.size()), feature_size))
+
+    fast_collate = load_fast_collate() if use_fast_collate else None
+    if fast_collate is not None:
+        # the kernel only zeroes the padded frames
+        tensor = torch.empty(len(samples), max_length, feature_size + 1, pin_memory=pin_memory)
+        fast_collate.fast_collate_audio([np.ascontiguousarray(x.float().numpy()) for x in samples], tensor.numpy(),
+                                        int(align_right))
+    else:
+        tensor = torch.zeros(len(samples), max_length, feature_size + 1, pin_memory=pin_memory)
+        for i in range(len(samples)):
+            sample = samples[i]
+
+            data_length = sample.size(0)
+            offset = max_length - data_length if align_right else 0
+
+            tensor[i].narrow(0, offset, data_length).narrow(1, 1, sample.size(1)).copy_(sample)
+            # in padding dimension: 1 is not padded, 0 is padded
+            tensor[i].narrow(0, offset, data_length).narrow(1, 0, 1).fill_(1)
+
+    return tensor, lengths
+
+
 def merge_data(data, align_right=False, type='text', augmenter=None, upsampling=False,
-               feature_size=40, dataname="source", src_pad=1, tgt_pad=1 ):
+               feature_size=40, dataname="source", src_pad=1, tgt_pad=1, pin_memory=False):
     """
     Assembling the individual sequences into one single tensor, included padding
     :param tgt_pad:
@@ -131,32 +247,25 @@ def merge_data(data, align_right=False, type='text', augmenter=None, upsampling=
     :param align_right: aligning the sequences w.r.t padding
     :param type: text or audio
     :param augmenter: for augmentation in audio models
+    :param pin_memory: allocate the batch in pinned memory
     :return:
     """
     # initialize with batch_size * length
-    # TODO: rewrite this function in Cython
-    if type == "text":
-        lengths = [x.size(0) for x in data]
-        # positions = [torch.arange(length_) for length_ in lengths]
-        max_length = max(lengths)
-        # if max_length > 8:
-        #     max_length = math.ceil(max_length / 8) * 8
+    if type == "text" and isinstance(data, MergedData):
+        return data.tensor, None, data.lengths
 
+    if type == "text":
         if dataname == "source":
-            tensor = data[0].new(len(data), max_length).fill_(src_pad)
+            pad = src_pad
         elif dataname == "target":
-            tensor = data[0].new(len(data), max_length).fill_(tgt_pad)
+            pad = tgt_pad
         else:
             print("Warning: check the dataname")
             raise NotImplementedError
-        pos = None
 
-        for i in range(len(data)):
-            data_length = data[i].size(0)
-            offset = max_length - data_length if align_right else 0
-            tensor[i].narrow(0, offset, data_length).copy_(data[i])
+        tensor, lengths = collate_text(data, pad, align_right=align_right, pin_memory=pin_memory)
 
-        return tensor, pos, lengths
+        return tensor, None, lengths
 
     elif type in ["audio", "scp"]:
 
@@ -176,54 +285,19 @@ def merge_data(data, align_right=False, type='text', augmenter=None, upsampling=
 
             samples.append(sample)
 
-        # compute the lengths afte on-the-fly processing
-        lengths = [x.size(0) for x in samples]
-
-        max_length = max(lengths)
-        # max_length = math.ceil(max_length / 8) * 8
-
         # allocate data for the batch speech
-        feature_size = samples[0].size(1)
-        batch_size = len(data)
-
         # feature size + 1 because the last dimension is created for padding
-        tensor = data[0].float().new(batch_size, max_length, feature_size + 1).fill_(0)
-
-        for i in range(len(samples)):
-            sample = samples[i]
-
-            data_length = sample.size(0)
-            offset = max_length - data_length if align_right else 0
-
-            tensor[i].narrow(0, offset, data_length).narrow(1, 1, sample.size(1)).copy_(sample)
-            # in padding dimension: 1 is not padded, 0 is padded
-            tensor[i].narrow(0, offset, data_length).narrow(1, 0, 1).fill_(1)
+        tensor, lengths = collate_audio(samples, align_right=align_right, pin_memory=pin_memory)
 
         return tensor, None, lengths
 
     elif type == 'wav':
-        samples = data
-        lengths = [x.size(0) for x in samples]
-        max_length = max(lengths)
-        # allocate data for the batch speech
-        feature_size = 1  # samples[0].size(1)  # most likely 1
-        assert feature_size == 1, "expecting feature size = 1 but get %2.f" % feature_size
-        batch_size = len(data)
-
         # feature size + 1 because the last dimension is created for padding
-        tensor = data[0].float().new(batch_size, max_length, feature_size + 1).fill_(0)
-
-        for i in range(len(samples)):
-            sample = samples[i]
-
-            # normalize
-            data_length = sample.size(0)
-            offset = max_length - data_length if align_right else 0
+        samples = [sample.view(sample.size(0), -1) for sample in data]
+        feature_size = samples[0].size(1)  # most likely 1
+        assert feature_size == 1, "expecting feature size = 1 but get %2.f" % feature_size
 
-            channels = 1
-            tensor[i].narrow(0, offset, data_length).narrow(1, 1, channels).copy_(sample)
-            # in padding dimension: 1 is not padded, 0 is padded
-            tensor[i].narrow(0, offset, data_length).narrow(1, 0, 1).fill_(1)
+        tensor, lengths = collate_audio(samples, align_right=align_right, pin_memory=pin_memory)
 
         return tensor, None, lengths
 
@@ -266,7 +340,7 @@ def collate_fn(src_data, tgt_data,
         tensors['target_output'] = target_full[1:]
         if target_pos is not None:
             tensors['target_pos'] = target_pos.t().contiguous()[:-1]
-        tgt_size = sum([len(x) - 1 for x in tgt_data])
+        tgt_size = sum(tgt_lengths) - len(tgt_lengths)
         tensors['tgt_lengths'] = tgt_lengths
 
     else:
@@ -463,11 +537,12 @@ class Batch(object):
         else:
             return None
 
-    def cuda(self, fp16=False, device=None):
+    def cuda(self, fp16=False, device=None, non_blocking=False):
         """
         Send the minibatch data into GPU.
         :param device: default = None (default CUDA device)
         :param fp16:
+        :param non_blocking: asynchronous copies (from pinned memory)
         :return: None
         """
         for key, tensor in self.tensors.items():
@@ -475,12 +550,12 @@ class Batch(object):
                 for k in tensor:
                     if isinstance(k, torch.Tensor):
                         v = tensor[k]
-                        tensor[k] = v.cuda(device=device)
+                        tensor[k] = v.cuda(device=device, non_blocking=non_blocking)
             elif tensor is not None:
                 if isinstance(tensor, torch.Tensor):
                     if tensor.type() == "torch.FloatTensor" and fp16:
                         self.tensors[key] = tensor.half()
-                    self.tensors[key] = self.tensors[key].cuda(device=device)
+                    self.tensors[key] = self.tensors[key].cuda(device=device, non_blocking=non_blocking)
             else:
                 continue
 
@@ -682,21 +757,6 @@ class Dataset(torch.utils.data.Dataset):
         else:
             tgt_sizes = None
 
-        # sort data to have efficient mini-batching during training
-        if self.concat:
-            sorted_order = np.random.permutation(np.arange(len(self.src)))
-
-        else:
-            if sorting:
-
-                if self._type == 'text':
-                    sorted_order = np.lexsort((src_sizes, tgt_sizes))
-                elif self._type in ['audio', 'wav']:
-                    sorted_order = np.lexsort((tgt_sizes, src_sizes))
-
-            else:
-                sorted_order = np.arange(len(self.src))
-
         self.order = None
 
         # store data length in numpy for fast query
@@ -728,6 +788,17 @@ class Dataset(torch.utils.data.Dataset):
         else:
             self.bilingual = False
 
+        # the language ids stored as columns are read for the whole batch in the collater
+        # (the concatenation of samples still needs them in the samples)
+        self.column_langs = (not self.bilingual and not self.concat
+                             and isinstance(self.src_langs, MMapColumnDataset)
+                             and isinstance(self.tgt_langs, MMapColumnDataset))
+
+        # the text sequences of a batch are gathered and padded at once in the collater
+        self.gather_batches = (self._type == 'text' and not self.concat
+                               and isinstance(self.src, MMapIndexedDataset)
+                               and isinstance(self.tgt, MMapIndexedDataset))
+
         self.full_size = len(src_sizes)
         # self.full_size = len(self.src) if self.src is not None else len(self.tgt)
 
@@ -744,6 +815,7 @@ class Dataset(torch.utils.data.Dataset):
 
         # group samples into mini-batches
         if self.concat:
+            sorted_order = np.random.permutation(np.arange(len(self.src)))
             _batch_size = math.floor(batch_size_frames / self.max_src_len)
 
             self.batches = allocate_batch_simple(sorted_order,
@@ -756,30 +828,62 @@ class Dataset(torch.utils.data.Dataset):
             self.tgt_sizes = tgt_sizes
         else:
 
-            if self._type in ['audio', 'wav']:
-                self.batches = allocate_batch_unbalanced(sorted_order, data_lengths,
-                                                         src_sizes, tgt_sizes,
-                                                         batch_size_frames, batch_size_words,
-                                                         batch_size_sents, multiplier,
-                                                         self.max_src_len, self.max_tgt_len,
-                                                         self.min_src_len, self.min_tgt_len, self.cleaning,
-                                                         cut_off_size, smallest_batch_size)
+            def sort_and_allocate():
+                # sort data to have efficient mini-batching during training
+                if sorting:
+                    if self._type == 'text':
+                        sorted_order = np.lexsort((src_sizes, tgt_sizes))
+                    elif self._type in ['audio', 'wav']:
+                        sorted_order = np.lexsort((tgt_sizes, src_sizes))
+                else:
+                    sorted_order = np.arange(len(self.src))
+
+                if self._type in ['audio', 'wav']:
+                    return allocate_batch_unbalanced(sorted_order, data_lengths,
+                                                     src_sizes, tgt_sizes,
+                                                     batch_size_frames, batch_size_words,
+                                                     batch_size_sents, multiplier,
+                                                     self.max_src_len, self.max_tgt_len,
+                                                     self.min_src_len, self.min_tgt_len, self.cleaning,
+                                                     cut_off_size, smallest_batch_size)
+                else:
+                    return allocate_batch(sorted_order, data_lengths,
+                                          src_sizes, tgt_sizes,
+                                          batch_size_words, batch_size_sents, multiplier,
+                                          self.max_src_len, self.max_tgt_len,
+                                          self.min_src_len, self.min_tgt_len, self.cleaning)
+
+            # the sorted and allocated batches can be stored next to the data
+            # the cache key depends on the sizes and on the options of the allocation
+            batch_cache = kwargs.get('batch_cache', None)
+            if batch_cache is not None:
+                batch_cache = batch_cache_path(batch_cache, [src_sizes, tgt_sizes],
+                                               data_type=self._type, sorting=sorting, cleaning=self.cleaning,
+                                               batch_size_frames=batch_size_frames,
+                                               batch_size_words=batch_size_words,
+                                               batch_size_sents=batch_size_sents, multiplier=multiplier,
+                                               max_src_len=self.max_src_len, max_tgt_len=self.max_tgt_len,
+                                               min_src_len=self.min_src_len, min_tgt_len=self.min_tgt_len,
+                                               cut_off_size=cut_off_size, smallest_batch_size=smallest_batch_size)
+                self.batches = cached_allocation(batch_cache, sort_and_allocate)
             else:
-                self.batches = allocate_batch(sorted_order, data_lengths,
-                                              src_sizes, tgt_sizes,
-                                              batch_size_words, batch_size_sents, multiplier,
-                                              self.max_src_len, self.max_tgt_len,
-                                              self.min_src_len, self.min_tgt_len, self.cleaning)
+                self.batches = sort_and_allocate()
 
         # the second to last mini-batch is likely the largest
         # (the last one can be the remnant after grouping samples which has less than max size)
         self.largest_batch_id = len(self.batches) - 3
 
         if dataset_factor is not None:
-            self.batches = [b for b in self.batches for _ in range(dataset_factor)]
+            if isinstance(self.batches, BatchList):
+                self.batches = self.batches.repeat(dataset_factor)
+            else:
+                self.batches = [b for b in self.batches for _ in range(dataset_factor)]
 
         self.num_batches = len(self.batches)
-        self.batch_sizes = [len(x) for x in self.batches]
+        if isinstance(self.batches, BatchList):
+            self.batch_sizes = self.batches.sizes().tolist()
+        else:
+            self.batch_sizes = [len(x) for x in self.batches]
 
         print("Number of sentences before cleaning and sorting: %d" % len(src_sizes) )
         print("Number of sentences after cleaning and sorting: %d" % sum(self.batch_sizes) )
@@ -789,6 +893,7 @@ class Dataset(torch.utils.data.Dataset):
         self.batchOrder = None
         self.input_size = input_size
         self.src_sizes = src_sizes
+        self.tgt_sizes = tgt_sizes
 
         if augment:
             self.augmenter = Augmenter(F=sa_f, T=sa_t, input_size=input_size)
@@ -803,12 +908,39 @@ class Dataset(torch.utils.data.Dataset):
             self.use_memory = False
         self.validation = validation
 
+        # hits and misses of the audio file cache already returned with a batch (by this process)
+        self.reported_cache_info = (0, 0)
+
         # if
 
     def flush_cache(self):
         if hasattr(self.src, 'flush_cache'):
             self.src.flush_cache()
 
+    def cache_info(self):
+        """
+        :return: hits and misses of the audio file cache of the source (in this process), or None
+        """
+        if hasattr(self.src, 'cache_info'):
+            return self.src.cache_info()
+
+        return None
+
+    def cache_delta(self):
+        """
+        The counters live in the process reading the audio (each data loader worker has its own),
+        so they are returned with the batches and summed by the trainer
+        :return: hits and misses of the audio file cache of this process since the previous call, or None
+        """
+        info = self.cache_info()
+        if info is None:
+            return None
+
+        hits, misses = self.reported_cache_info
+        self.reported_cache_info = (info.hits, info.misses)
+
+        return info.hits - hits, info.misses - misses
+
     def size(self):
         return self.full_size
 
@@ -872,7 +1004,7 @@ class Dataset(torch.utils.data.Dataset):
                 src_atb = self.src_atbs[0]
             if self.tgt_atbs is not None:
                 tgt_atb = self.tgt_atbs[0]
-        else:
+        elif not self.column_langs:
             if self.src_langs is not None:
                 src_lang = self.src_langs[index]
             if self.tgt_langs is not None:
@@ -887,14 +1019,22 @@ class Dataset(torch.utils.data.Dataset):
         else:
             past_src = None
 
+        if self.gather_batches:
+            # the sequences are read for the whole batch in the collater
+            src, tgt = None, None
+        else:
+            src = self.src[index] if self.src is not None else None
+            tgt = self.tgt[index] if self.tgt is not None else None
+
         sample = {
-            'src': self.src[index] if self.src is not None else None,
-            'tgt': self.tgt[index] if self.tgt is not None else None,
+            'src': src,
+            'tgt': tgt,
             'src_lang': src_lang,
             'tgt_lang': tgt_lang,
             'src_atb': src_atb,
             'tgt_atb': tgt_atb,
-            'past_src': past_src
+            'past_src': past_src,
+            'index': index
         }
 
         return sample
@@ -909,15 +1049,21 @@ class Dataset(torch.utils.data.Dataset):
         assert index < self.num_batches, "%d > %d" % (index, self.num_batches)
 
         batch_ids = self.batches[index]
-        if self.src:
-            src_data = [self.src[i] for i in batch_ids]
+        if self.gather_batches:
+            src_data = MergedData(*self.src.get_batch(batch_ids, self.src_pad, align_right=self.src_align_right),
+                                  align_right=self.src_align_right)
+            tgt_data = MergedData(*self.tgt.get_batch(batch_ids, self.tgt_pad, align_right=self.tgt_align_right),
+                                  align_right=self.tgt_align_right)
         else:
-            src_data = None
+            if self.src:
+                src_data = [self.src[i] for i in batch_ids]
+            else:
+                src_data = None
 
-        if self.tgt:
-            tgt_data = [self.tgt[i] for i in batch_ids]
-        else:
-            tgt_data = None
+            if self.tgt:
+                tgt_data = [self.tgt[i] for i in batch_ids]
+            else:
+                tgt_data = None
 
         src_lang_data = None
         tgt_lang_data = None
@@ -933,6 +1079,9 @@ class Dataset(torch.utils.data.Dataset):
                 src_atbs_data = [self.src_atbs[0]]
             if self.tgt_atbs is not None:
                 tgt_atbs_data = [self.tgt_atbs[0]]
+        elif self.column_langs:
+            src_lang_data = [self.src_langs.get_batch(batch_ids)]
+            tgt_lang_data = [self.tgt_langs.get_batch(batch_ids)]
         else:
             if self.src_langs is not None:
                 src_lang_data = [self.src_langs[i] for i in batch_ids]
@@ -979,11 +1128,20 @@ class Dataset(torch.utils.data.Dataset):
             src_atbs_data, tgt_atbs_data = None, None
             past_src_data = None
 
-            if self.src:
-                src_data = [sample['src'] for sample in samples]
+            if self.gather_batches:
+                batch_ids = [sample['index'] for sample in samples]
+                src_data = MergedData(*self.src.get_batch(batch_ids, self.src_pad,
+                                                          align_right=self.src_align_right),
+                                      align_right=self.src_align_right)
+                tgt_data = MergedData(*self.tgt.get_batch(batch_ids, self.tgt_pad,
+                                                          align_right=self.tgt_align_right),
+                                      align_right=self.tgt_align_right)
+            else:
+                if self.src:
+                    src_data = [sample['src'] for sample in samples]
 
-            if self.tgt:
-                tgt_data = [sample['tgt'] for sample in samples]
+                if self.tgt:
+                    tgt_data = [sample['tgt'] for sample in samples]
 
             if self.bilingual:
                 if self.src_langs is not None:
@@ -994,6 +1152,11 @@ class Dataset(torch.utils.data.Dataset):
                     src_atbs_data = [self.src_atbs[0]]
                 if self.tgt_atbs is not None:
                     tgt_atbs_data = [self.tgt_atbs[0]]
+            elif self.column_langs:
+                # one vectorized lookup for the whole batch
+                batch_ids = [sample['index'] for sample in samples]
+                src_lang_data = [self.src_langs.get_batch(batch_ids)]
+                tgt_lang_data = [self.tgt_langs.get_batch(batch_ids)]
             else:
                 if self.src_langs is not None:
                     src_lang_data = [sample['src_lang'] for sample in samples]  # should be a tensor [0]
@@ -1020,6 +1183,10 @@ class Dataset(torch.utils.data.Dataset):
 
             batches.append(batch)
 
+        cache_delta = self.cache_delta()
+        if cache_delta is not None:
+            batches[0].tensors['file_cache'] = cache_delta
+
         return batches
 
     def full_size(self):
@@ -3,29 +3,81 @@
 import numpy as np
 cimport cython
 cimport numpy as np
+from libc.string cimport memcpy, memset
 
 DTYPE=np.int64
 ctypedef np.int64_t DTYPE_t
+ctypedef np.float32_t FLOAT_t
+
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef np.ndarray[DTYPE_t, ndim=2] fast_collate(list data, int align_right, long data_size):
+cpdef fast_collate_text(list data, DTYPE_t[:, ::1] output, DTYPE_t pad, int align_right):
+    """
+    Copy the sequences into the (uninitialized) output and fill the rest with the padding value
+    :param data: list of contiguous 1D int64 arrays
+    :param output: batch_size x max_length
+    :param pad: padding value
+    :param align_right: pad on the left side
+    """
+    cdef Py_ssize_t batch_size = len(data)
+    cdef Py_ssize_t max_length = output.shape[1]
+    cdef Py_ssize_t i, j, length, offset
+    cdef const DTYPE_t[::1] sample
+
+    for i in range(batch_size):
+        sample = data[i]
+        length = sample.shape[0]
+        offset = max_length - length if align_right else 0
+
+        if length > max_length:
+            raise ValueError("Sample %d of length %d does not fit in the batch of length %d"
+                             % (i, length, max_length))
 
-    # first we need to find the
-    cdef np.ndarray[DTYPE_t, ndim=1]
+        for j in range(max_length - length):
+            output[i, j if align_right else length + j] = pad
 
-    cdef long seq_len = 0
-    for i in range(data_size):
-        if seq_len < data[i].shape[0]:
-            seq_len = data[i].shape[0]
+        if length > 0:
+            memcpy(&output[i, offset], &sample[0], length * sizeof(DTYPE_t))
 
 
-    cdef np.ndarray[DTYPE_t, ndim=1] sample
-    cdef i
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef fast_collate_audio(list data, FLOAT_t[:, :, ::1] output, int align_right):
+    """
+    Copy the feature sequences into the (uninitialized) output, after the padding channel
+    which is set to 1 for the frames that are not padded. The padded frames are set to 0
+    :param data: list of contiguous 2D float32 arrays (length x feature_size)
+    :param output: batch_size x max_length x (feature_size + 1)
+    :param align_right: pad on the left side
+    """
+    cdef Py_ssize_t batch_size = len(data)
+    cdef Py_ssize_t max_length = output.shape[1]
+    cdef Py_ssize_t i, j, length, offset, feature_size
+    cdef Py_ssize_t frame_size = output.shape[2]
+    cdef const FLOAT_t[:, ::1] sample
 
-    cdef np.ndarray output = np.zeros([batch_size, seq_len], dtype=DTYPE)
+    for i in range(batch_size):
+        sample = data[i]
+        length = sample.shape[0]
+        feature_size = sample.shape[1]
+        offset = max_length - length if align_right else 0
 
-    for i in range(data_size):
+        # the copies below are not bound checked
+        if feature_size != frame_size - 1 or length > max_length:
+            raise ValueError("Sample %d of shape (%d, %d) does not fit in the batch of shape (%d, %d)"
+                             % (i, length, feature_size, max_length, frame_size - 1))
 
+        if length < max_length:
+            memset(&output[i, 0 if align_right else length, 0], 0,
+                   (max_length - length) * frame_size * sizeof(FLOAT_t))
 
-    return 0
\ No newline at end of file
+        if feature_size == 1:
+            # waveform: one strided pass instead of a memcpy call per sample point
+            for j in range(length):
+                output[i, offset + j, 0] = 1
+                output[i, offset + j, 1] = sample[j, 0]
+        else:
+            for j in range(length):
+                output[i, offset + j, 0] = 1
+                memcpy(&output[i, offset + j, 1], &sample[j, 0], feature_size * sizeof(FLOAT_t))
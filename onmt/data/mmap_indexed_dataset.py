@@ -1,4 +1,5 @@
 import os
+import shutil
 import struct
 
 import numpy as np
@@ -70,25 +71,22 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
                 @staticmethod
                 def _get_pointers(sizes):
                     dtype_size = dtype().itemsize
-                    address = 0
-                    pointers = []
-
-                    for size in sizes:
-                        pointers.append(address)
-                        address += size * dtype_size
+                    pointers = np.zeros(len(sizes), dtype=np.int64)
+                    # the address of each item is the sum of the sizes of the previous items
+                    np.cumsum(sizes[:-1], dtype=np.int64, out=pointers[1:])
+                    pointers *= dtype_size
 
                     return pointers
 
                 def write(self, sizes):
+                    sizes = np.asarray(sizes, dtype=np.int32)
                     pointers = self._get_pointers(sizes)
 
                     self._file.write(struct.pack('<Q', len(sizes)))
 
-                    sizes = np.array(sizes, dtype=np.int32)
                     self._file.write(sizes.tobytes(order='C'))
                     del sizes
 
-                    pointers = np.array(pointers, dtype=np.int64)
                     self._file.write(pointers.tobytes(order='C'))
                     del pointers
 
@@ -164,8 +162,11 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         _warmup_mmap_file(data_file_path(self._path))
         self._bin_buffer_mmap = np.memmap(data_file_path(self._path), mode='r', order='C')
         self._bin_buffer = memoryview(self._bin_buffer_mmap)
+        # view of all the tokens, for the batch gather
+        self._data = np.frombuffer(self._bin_buffer, dtype=self._index.dtype)
 
     def __del__(self):
+        del self._data
         self._bin_buffer_mmap._mmap.close()
         del self._bin_buffer_mmap
         del self._index
@@ -184,6 +185,32 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         # to avoid the warning
         return torch.from_numpy(np.array(np_array))
 
+    def get_batch(self, ids, pad, align_right=False, pin_memory=False):
+        """
+        Gather the sequences of a mini-batch into one padded int64 tensor in one vectorized pass,
+        without the temporary arrays and tensors of __getitem__
+        :param ids: indices of the sequences
+        :param pad: padding value
+        :param align_right: pad on the left side instead of the right side
+        :param pin_memory: allocate the tensor in pinned memory
+        :return: tensor [len(ids) x max_length], list of the lengths
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        sizes = self._index.sizes[ids].astype(np.int64)
+        starts = self._index._pointers[ids] // self._index._dtype_size
+
+        batch_size = len(ids)
+        max_length = int(sizes.max()) if batch_size > 0 else 0
+        tensor = torch.empty(batch_size, max_length, dtype=torch.long, pin_memory=pin_memory).fill_(pad)
+
+        # row, position in the sequence and position in the data file of each token of the batch
+        rows = np.repeat(np.arange(batch_size), sizes)
+        positions = np.arange(int(sizes.sum())) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        columns = positions + np.repeat(max_length - sizes, sizes) if align_right else positions
+        tensor.numpy()[rows, columns] = self._data[np.repeat(starts, sizes) + positions]
+
+        return tensor, sizes.tolist()
+
     @property
     def sizes(self):
         return self._index.sizes
@@ -204,6 +231,13 @@ class MMapIndexedDatasetBuilder(object):
         self._data_file = open(out_file, 'wb')
         self._dtype = dtype
         self._sizes = []
+        # sizes of the merged files (and of the items added before them), kept as numpy arrays
+        self._size_chunks = []
+
+    def _flush_sizes(self):
+        if len(self._sizes) > 0:
+            self._size_chunks.append(np.asarray(self._sizes, dtype=np.int32))
+            self._sizes = []
 
     def add_item(self, tensor):
 
@@ -214,13 +248,18 @@ class MMapIndexedDatasetBuilder(object):
         self._data_file.write(np_array.tobytes(order='C'))
         self._sizes.append(np_array.size)
 
+        # keep the memory of the sizes flat for very large datasets
+        if len(self._sizes) >= 1048576:
+            self._flush_sizes()
+
     def merge_file_(self, another_file):
         # Concatenate index
         index = MMapIndexedDataset.Index(index_file_path(another_file))
         assert index.dtype == self._dtype
 
-        for size in index.sizes:
-            self._sizes.append(size)
+        self._flush_sizes()
+        self._size_chunks.append(np.array(index.sizes, dtype=np.int32))
+        del index
 
         # Concatenate data
         with open(data_file_path(another_file), 'rb') as f:
@@ -229,5 +268,121 @@ class MMapIndexedDatasetBuilder(object):
     def finalize(self, index_file):
         self._data_file.close()
 
+        self._flush_sizes()
+        if len(self._size_chunks) > 0:
+            sizes = np.concatenate(self._size_chunks)
+        else:
+            sizes = np.zeros(0, dtype=np.int32)
+
         with MMapIndexedDataset.Index.writer(index_file, self._dtype) as index:
-            index.write(self._sizes)
\ No newline at end of file
+            index.write(sizes)
+
+
+def column_file_path(prefix_path):
+    return prefix_path + '.npy'
+
+
+class MMapColumnDataset(object):
+    """
+    One small integer per item (for example the language or attribute id of each sentence).
+    The column is stored as a flat fixed-width numpy array, or as runs of the same value
+    (a [2 x n_runs] array of values and end positions) when the data comes from a few
+    monolingual files. The file is memory-mapped at load time.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+
+        self._path = None
+        self._column = None
+        self._values = None
+        self._ends = None
+
+        self._do_init(path)
+
+    def __getstate__(self):
+        return self._path
+
+    def __setstate__(self, state):
+        self._do_init(state)
+
+    def _do_init(self, path):
+        self._path = path
+        data = np.load(column_file_path(path), mmap_mode='r')
+
+        if data.ndim == 2:
+            self._column = None
+            self._values, self._ends = data[0], data[1]
+            self._len = int(self._ends[-1]) if len(self._ends) > 0 else 0
+        else:
+            self._column = data
+            self._len = len(data)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        # one-element tensor, same as the items of the memory indexed dataset
+        return self.get_batch([i])
+
+    def get_batch(self, ids):
+        """
+        :param ids: list or array of item indices
+        :return: LongTensor with the values of the items
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if self._column is not None:
+            values = self._column[ids]
+        else:
+            values = self._values[np.searchsorted(self._ends, ids, side='right')]
+
+        return torch.from_numpy(values.astype(np.int64))
+
+    @property
+    def supports_prefetch(self):
+        return False
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(column_file_path(path))
+
+    @staticmethod
+    def write(path, values):
+        """
+        :param path: prefix of the output file
+        :param values: list of ints or one-element tensors
+        """
+        values = np.asarray([int(v) for v in values], dtype=np.int64)
+
+        # the smallest fixed width for the values
+        if len(values) == 0 or (values.min() >= 0 and values.max() < 256):
+            dtype = np.uint8
+        elif values.min() >= -32768 and values.max() < 32768:
+            dtype = np.int16
+        else:
+            dtype = np.int32
+
+        ends = np.append(np.flatnonzero(np.diff(values)) + 1, len(values))
+
+        # run-length encoding if it is smaller than the column
+        if len(values) > 0 and 2 * len(ends) * 8 < len(values) * dtype().itemsize:
+            np.save(column_file_path(path), np.stack((values[ends - 1], ends)))
+        else:
+            np.save(column_file_path(path), values.astype(dtype))
+
+
+def column_dataset_exists(path):
+    return MMapColumnDataset.exists(path) or MMapIndexedDataset.exists(path)
+
+
+def load_column_dataset(path):
+    """
+    :param path: prefix of the column files (for example data.src_lang)
+    :return: the column dataset, the memory indexed dataset of the older format, or None if there is no data
+    """
+    if MMapColumnDataset.exists(path):
+        return MMapColumnDataset(path)
+    elif MMapIndexedDataset.exists(path):
+        return MMapIndexedDataset(path)
+
+    return None
@@ -1,120 +1,144 @@
-import itertools
-import logging
-import math
-import operator
 import os
-import queue
-import time
-from threading import Thread
-from .data_iterator import EpochBatchIterating, DataIterator
 
 import numpy as np
 import torch
+from .data_iterator import EpochBatchIterating, DataIterator, CountingIterator, BufferedIterator
+from .batch_utils import BatchList
 
 
-class MultiEpochIterator(object):
-    # this class stores N epoch iterators for N datasets
-    # init is called at the beginning of the epoch
+class MultiDataset(torch.utils.data.Dataset):
+    """
+    View of several datasets as one, so that a single DataLoader (and its workers) serves all of them.
+    The samples are indexed by (dataset id, index in the dataset), and all the samples of a batch come from
+    the same dataset, whose collater makes the batch.
+    """
 
-    def __init__(self, iterators, round_robin=False):
-        """
-        :param iterators: a list of CountingIterators
-        :param round_robin: if the data is sampled iteratively 1 to N or randomly
-        """
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.collaters = [dataset.get_collater() for dataset in datasets]
 
-        self.iterators = iterators
-        self.round_robin = round_robin
-        self.n_iterators = len(iterators)
-        # self.total = sum([len(iterator) for iterator in self.iterators])
-        self.sizes = [len(iterator) for iterator in self.iterators]
-        self.total = sum(self.sizes)
-        self.itr = iter(self)
+    def __getitem__(self, index):
+        dataset_id, i = index
 
-        if self.round_robin:
-            self.itr_indices = torch.arange(self.n_iterators)
-        else:
-            # self.itr_indices = torch.randperm(self.n_iterators)
-            with torch.no_grad():
-                self.itr_indices = torch.Tensor(self.sizes).div(self.total)
+        return dataset_id, self.datasets[dataset_id][i]
 
-        self.idx = -1
-        self.n_yielded = 0
+    def collater(self, samples):
+        dataset_id = samples[0][0]
 
-    def iterations_in_epoch(self):
-        """
-        :return: a list of iterations in epoch for each iterator
-        """
-        return [iterator.n for iterator in self.iterators]
+        return self.collaters[dataset_id]([sample for _, sample in samples])
 
-    def load_iterations(self, iteration_in_epochs):
 
-        for iterator, iter_in_epoch in zip(self.iterators, iteration_in_epochs):
-            iterator.n = iter_in_epoch
+class ScheduleSampler(object):
+    """
+    Batch sampler following the schedule of the epoch: the step j takes the next batch of the dataset schedule[j]
+    """
 
-    def __len__(self):
+    def __init__(self, schedule, dataset_batches):
+        """
+        :param schedule: array with the dataset id of each step
+        :param dataset_batches: for each dataset, the list of its batches in the order of the steps
+        """
+        self.schedule = schedule
+        self.dataset_batches = dataset_batches
 
-        return sum([len(iterator) for iterator in self.iterators])
+    def __len__(self):
+        return len(self.schedule)
 
     def __iter__(self):
+        positions = [0] * len(self.dataset_batches)
+
+        for dataset_id in self.schedule.tolist():
+            batch = self.dataset_batches[dataset_id][positions[dataset_id]]
+            positions[dataset_id] += 1
+            yield [(dataset_id, i) for i in batch]
+
+
+def sampling_distribution(sizes, temperature=1.0, weights=None):
+    """
+    :param sizes: number of batches of each dataset
+    :param temperature: the probabilities are proportional to size^(1/temperature)
+    (1: proportional to the sizes, large values: closer to uniform)
+    :param weights: explicit weights of the datasets (instead of the sizes and the temperature)
+    :return: numpy array of probabilities
+    """
+    sizes = np.asarray(sizes, dtype=np.float64)
+
+    if weights is not None and len(weights) > 0:
+        assert len(weights) == len(sizes), "Expect one sampling weight per dataset (%d)" % len(sizes)
+        probs = np.asarray(weights, dtype=np.float64) * (sizes > 0)
+    else:
+        probs = sizes ** (1.0 / temperature)
+
+    if probs.sum() <= 0:
+        probs = (sizes > 0).astype(np.float64)
+
+    return probs / max(probs.sum(), 1e-12)
+
+
+def sample_schedule(sizes, probs, rng, exhaust=True):
+    """
+    Draw the dataset of each step of the epoch (the epoch has sum(sizes) steps)
+
+    :param sizes: number of batches of each dataset
+    :param probs: sampling probabilities of the datasets
+    :param rng: numpy RandomState
+    :param exhaust: every batch is used exactly once: the datasets that run out of batches are not drawn anymore.
+    Otherwise the datasets are drawn independently (the small datasets are repeated)
+    :return: numpy array with the dataset id of each step
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    total = int(sizes.sum())
+
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    if not exhaust:
+        return rng.choice(len(sizes), size=total, p=probs)
+
+    # drawing from probs and skipping the empty datasets is the same as
+    # drawing from probs and keeping only the first "size" draws of each dataset
+    schedule = []
+    remaining = sizes.copy()
+    while remaining.sum() > 0:
+        probs_ = probs * (remaining > 0)
+        if probs_.sum() <= 0:
+            probs_ = (remaining > 0).astype(np.float64)
+        probs_ = probs_ / probs_.sum()
+
+        draws = rng.choice(len(sizes), size=int(remaining.sum()), p=probs_)
+        keep = np.zeros(len(draws), dtype=bool)
+        for dataset_id in np.flatnonzero(remaining):
+            positions = np.flatnonzero(draws == dataset_id)[:remaining[dataset_id]]
+            keep[positions] = True
+            remaining[dataset_id] -= len(positions)
+
+        schedule.append(draws[keep])
+
+    return np.concatenate(schedule) if len(schedule) > 0 else np.zeros(0, dtype=np.int64)
+
+
+def round_robin_schedule(sizes):
+    """
+    :param sizes: number of batches of each dataset
+    :return: numpy array with the dataset id of each step (datasets taken in turn until they are exhausted)
+    """
+    dataset_ids = np.repeat(np.arange(len(sizes)), sizes)
+    positions = np.concatenate([np.arange(size) for size in sizes]) if len(sizes) > 0 else dataset_ids
+
+    return dataset_ids[np.lexsort((dataset_ids, positions))]
+
+
+class MultiEpochIterator(CountingIterator):
+    """
+    Iterator over the batches of all datasets for one epoch
+    """
 
-        while True:
-
-            if self.n_yielded >= self.total:
-                return
-
-            if self.round_robin:
-                self.idx = self.idx + 1
-                if self.idx >= self.n_iterators:
-                    self.idx = 0
-
-                cur_iterator = self.iterators[self.itr_indices[self.idx]]
-
-                # if the current iterator is not exhausted, then yield
-                # otherwise go to the next one
-                if cur_iterator.has_next():
-                    self.n_yielded += 1
-                    yield next(cur_iterator)
-                else:
-                    continue
-            else:
-                # sample randomly from the iterators
-                # large datasets will be likely to generate more samples
-                # smaller datasets will be less likely
-                # but averaging-out, the model is more balanced than round-robin
-                sampled_itr = torch.multinomial(self.itr_indices, 1).unsqueeze(-1).item()
-
-                # if the current iterator is not exhausted, then yield
-                # otherwise resample
-                cur_iterator = self.iterators[sampled_itr]
-                if cur_iterator.has_next():
-                    self.n_yielded += 1
-                    yield next(cur_iterator)
-                else:
-                    # zero-out that index to avoid sampling into the same empty iterator
-                    with torch.no_grad():
-                        self.itr_indices[sampled_itr].zero_()
-                    continue
-
-    def __next__(self):
-
-        return next(self.itr)
-
-    def has_next(self):
-
-        return self.n_yielded < self.total
-
-    def skip(self, num_to_skip):
-
-        for iterator in self.iterators:
-            iterator.skip(num_to_skip)
-
-    def take(self, n):
+    @property
+    def n_yielded(self):
+        return self.n
 
-        """
-        Truncates the iterator to n elements at most.
-        """
-        for iterator in self.iterators:
-            iterator.take(n)
+    def iterations_in_epoch(self):
+        return self.n
 
 
 class MultiDataIterator(EpochBatchIterating):
@@ -133,24 +157,28 @@ class MultiDataIterator(EpochBatchIterating):
         self.shuffle = shuffle
         return self._cur_epoch_itr
 
-    # each dataset = dataiterator > generate 1 epoch iterator
-    # this class gen
+    # each dataset = dataiterator > generate its batches for the epoch
+    # one data loader (with one pool of workers) serves the batches of all datasets
     def __init__(self, datasets, seed=1., num_workers=0, epoch=1, buffer_size=0,
-                 timeout=0, round_robin=False, num_shards=1, shard_id=0, split_even=True, dataset_ids=None):
+                 timeout=0, round_robin=False, num_shards=1, shard_id=0, split_even=True, dataset_ids=None,
+                 sampling_temperature=1.0, sampling_weights=None):
         """
         :param datasets: list of Datasets
         :param seed: randomizing seed to
-        :param num_workers:
+        :param num_workers: number of workers of the data loader (shared by all the datasets)
         :param epoch:
         :param buffer_size:
         :param timeout:
-        :param round_robin:
+        :param round_robin: take the datasets in turn
         :param num_shards:
         :param shard_id:
         :param split_even:  Split the datasets evenly (otherwise adding samples)
         :param dataset_ids: Selectively choose datasets involved
+        :param sampling_temperature: sample the datasets with probabilities proportional to size^(1/temperature).
+        With a temperature or weights, the datasets are drawn independently at each step (small datasets are repeated)
+        :param sampling_weights: explicit sampling weights of the (chosen) datasets
         """
-        self.datasets = datasets
+        self.datasets = list()
         self.data_iterators = list()
 
         for i, dataset in enumerate(datasets):
@@ -158,18 +186,27 @@ class MultiDataIterator(EpochBatchIterating):
                 if i not in dataset_ids:
                     continue
 
+            self.datasets.append(dataset)
+            # only used for the batches of each epoch (its data loader is not created)
             self.data_iterators.append(DataIterator(dataset, dataset.get_collater(), dataset.get_batches(), seed=seed,
                                                     num_workers=num_workers, epoch=epoch, buffer_size=buffer_size,
                                                     timeout=timeout, num_shards=num_shards,
                                                     shard_id=shard_id, split_even=split_even))
 
+        self.multi_dataset = MultiDataset(self.datasets)
+        self.seed = seed
+        self.num_workers = num_workers
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+
         self.shuffle = True
         self._cur_epoch_itr = None
         self._next_epoch_itr = None
         self._support_prefetch = False
         self.round_robin = round_robin
+        self.sampling_temperature = sampling_temperature
+        self.sampling_weights = sampling_weights
         self.epoch = max(epoch, 1)
-        self.n_samples = sum([dataset.get_size() for dataset in self.datasets])
 
     def __len__(self):
         return sum([len(data_iterator) for data_iterator in self.data_iterators])
@@ -187,14 +224,6 @@ class MultiDataIterator(EpochBatchIterating):
     def end_of_epoch(self) -> bool:
         return not self._cur_epoch_itr.has_next()
 
-    def state_dict(self):
-        """Returns a dictionary containing a whole state of the iterator."""
-        return {
-            'epoch': self.epoch,
-            'iterations_in_epoch': self.iterations_in_epoch,
-            'shuffle': self.shuffle,
-        }
-
     @property
     def iterations_in_epoch(self):
         """ The number of consumed batches in the current epoch"""
@@ -202,7 +231,7 @@ class MultiDataIterator(EpochBatchIterating):
             return self._cur_epoch_itr.iterations_in_epoch()
         elif self._next_epoch_itr is not None:
             return self._next_epoch_itr.iterations_in_epoch()
-        return [0] * len(self.data_iterators)
+        return 0
 
     def state_dict(self):
         """Returns a dictionary containing a whole state of the iterator."""
@@ -216,14 +245,17 @@ class MultiDataIterator(EpochBatchIterating):
         """Copies the state of the iterator from the given *state_dict*."""
         if state_dict is not None:
             self.epoch = state_dict['epoch']
-            itr_pos = state_dict.get('iterations_in_epoch', [0] * len(self.data_iterators))
+            itr_pos = state_dict.get('iterations_in_epoch', 0)
+            # older states have the position in each dataset
+            if isinstance(itr_pos, (list, tuple)):
+                itr_pos = sum(itr_pos)
 
-            if sum(itr_pos) > 0:
-                # fast-forward epoch iterator
+            if itr_pos > 0:
+                # fast-forward epoch iterator (the schedule of the epoch is deterministic)
                 self._next_epoch_itr = self._get_iterator_for_epoch(
                     self.epoch,
                     shuffle=state_dict.get('shuffle', True),
-                    offsets=itr_pos
+                    offset=itr_pos
                 )
                 if self._next_epoch_itr is None:
                     # we finished the epoch, increment epoch counter
@@ -232,25 +264,76 @@ class MultiDataIterator(EpochBatchIterating):
                 self._next_epoch_itr = None
         else:
             self.epoch = 1
-            itr_pos = list()
             self._next_epoch_itr = None
 
-    def _get_iterator_for_epoch(self, epoch, shuffle=False, offsets=None, pin_memory=False):
+    def _get_schedule_for_epoch(self, epoch, shuffle):
+        """
+        :return: the dataset id of each step, and the batches of each dataset in the order of the steps
+        """
+        dataset_batches = [data_iterator._get_batches_for_epoch(epoch, shuffle)
+                           for data_iterator in self.data_iterators]
+        sizes = [len(batches) for batches in dataset_batches]
+
+        if self.round_robin:
+            return round_robin_schedule(sizes), dataset_batches
 
-        epoch_iterators = list()
+        exhaust = self.sampling_temperature == 1.0 and not self.sampling_weights
+        probs = sampling_distribution(sizes, self.sampling_temperature, self.sampling_weights)
 
-        if offsets is not None and sum(offsets) >= self.n_samples:
-            return None
+        # same schedule on every rank and when resuming
+        epoch_seed = int(self.seed + epoch) % (2 ** 32)
+        rng = np.random.RandomState(epoch_seed)
+        schedule = sample_schedule(sizes, probs, rng, exhaust=exhaust)
+
+        if not exhaust:
+            # the datasets drawn more often than their size start again with another order
+            for dataset_id, batches in enumerate(dataset_batches):
+                n_draws = int((schedule == dataset_id).sum())
+                n_pass = 1
+                batch_ids = list(range(sizes[dataset_id]))
+                while len(batch_ids) < n_draws:
+                    extra = list(range(sizes[dataset_id]))
+                    np.random.RandomState([epoch_seed, n_pass, dataset_id]).shuffle(extra)
+                    batch_ids.extend(extra)
+                    n_pass += 1
 
-        if offsets is None:
-            offsets = [0] * len(self.data_iterators)
+                if n_pass > 1:
+                    dataset_batches[dataset_id] = batches.select(batch_ids) if isinstance(batches, BatchList) \
+                        else [batches[i] for i in batch_ids]
 
-        # first, generate an iterator for each data iterator
-        for (data_iterator, offset) in zip(self.data_iterators, offsets):
-            epoch_iterator =  data_iterator._get_iterator_for_epoch(epoch, shuffle, offset, pin_memory=pin_memory)
-            epoch_iterators.append(epoch_iterator)
+        return schedule, dataset_batches
 
-        # next, use an multi epoch iterator
-        epoch_iterator = MultiEpochIterator(epoch_iterators, round_robin=self.round_robin)
+    def _get_iterator_for_epoch(self, epoch, shuffle=False, offset=0, pin_memory=False):
+
+        schedule, dataset_batches = self._get_schedule_for_epoch(epoch, shuffle)
+
+        if offset > 0 and offset >= len(schedule):
+            return None
 
-        return epoch_iterator
+        sampler = ScheduleSampler(schedule, dataset_batches)
+        if offset > 0:
+            # skip the batches of the first steps without loading them
+            positions = [0] * len(dataset_batches)
+            for dataset_id in schedule[:offset].tolist():
+                positions[dataset_id] += 1
+            sampler = ScheduleSampler(schedule[offset:],
+                                      [batches[position:] for batches, position in zip(dataset_batches, positions)])
+
+        if self.num_workers > 0:
+            os.environ['PYTHONWARNINGS'] = 'ignore:semaphore_tracker:UserWarning'
+
+        # one data loader for all the datasets
+        itr = torch.utils.data.DataLoader(
+            self.multi_dataset,
+            collate_fn=self.multi_dataset.collater,
+            batch_sampler=sampler,
+            num_workers=self.num_workers,
+            pin_memory=pin_memory,
+            timeout=self.timeout,
+        )
+
+        # Wrap with a BufferedIterator if needed
+        if self.buffer_size > 0:
+            itr = BufferedIterator(self.buffer_size, itr)
+
+        return MultiEpochIterator(itr, start=offset, empty=len(schedule) == 0)
@@ -0,0 +1,187 @@
+import os
+
+import numpy as np
+import torch
+
+
+_SCP_DTYPE = np.dtype([('path', np.int64), ('offset', np.int64)])
+_WAV_DTYPE = np.dtype([('path', np.int64), ('start', np.float64), ('end', np.float64), ('sample_rate', np.int64)])
+
+
+def _split_scp_path(scp_path):
+    # 'a.ark:12' -> ('a.ark', 12), the paths that don't end with a byte offset are kept as they are
+    fname, _, offset = scp_path.rpartition(':')
+    if fname and offset.isdigit() and str(int(offset)) == offset:
+        return fname, int(offset)
+
+    return scp_path, -1
+
+
+def _save_array(file_name, array):
+    tmp_name = "%s.tmp%d" % (file_name, os.getpid())
+    with open(tmp_name, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_name, file_name)
+
+
+class PathTable(object):
+    """
+    Compact table of the audio paths of a dataset (replaces the python list of the .pt file).
+    The distinct file names are stored once as one utf-8 byte blob with offsets, and each item is a fixed-size
+    record (the id of its file and the byte offset in the ark file, or the start, end and sample rate of the wav).
+    When the table is loaded from the disk the arrays are memory-mapped, so all the processes of a node
+    (ranks and data loader workers) share one copy.
+
+    The items are the same as the entries of the list: the scp path (string) or a tuple
+    (wav_path, start, end, sample_rate)
+    """
+
+    def __init__(self, names, name_offsets, items):
+        self._names = names
+        self._name_offsets = name_offsets
+        self._items = items
+        self._is_scp = 'offset' in items.dtype.names
+
+    @classmethod
+    def from_list(cls, entries):
+        """
+        :param entries: list of scp paths or of tuples (wav_path, start, end, sample_rate)
+        :return: PathTable (in memory)
+        """
+        is_scp = len(entries) == 0 or isinstance(entries[0], str)
+        items = np.zeros(len(entries), dtype=_SCP_DTYPE if is_scp else _WAV_DTYPE)
+
+        name_ids = dict()
+        path_ids = np.zeros(len(entries), dtype=np.int64)
+        for i, entry in enumerate(entries):
+            if is_scp:
+                name, items['offset'][i] = _split_scp_path(entry)
+            else:
+                name = entry[0]
+                items['start'][i], items['end'][i], items['sample_rate'][i] = entry[1:4]
+
+            path_ids[i] = name_ids.setdefault(name, len(name_ids))
+        items['path'] = path_ids
+
+        return cls(*cls._encode_names(list(name_ids)), items)
+
+    @staticmethod
+    def _encode_names(names):
+        encoded = [name.encode('utf-8') for name in names]
+        name_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        return blob, name_offsets
+
+    @classmethod
+    def load(cls, prefix):
+        return cls(np.load(prefix + '.names.npy', mmap_mode='r'),
+                   np.load(prefix + '.name_offsets.npy', mmap_mode='r'),
+                   np.load(prefix + '.items.npy', mmap_mode='r'))
+
+    @staticmethod
+    def exists(prefix):
+        return os.path.exists(prefix + '.items.npy')
+
+    def save(self, prefix):
+        # the items are written last (they mark a complete table)
+        _save_array(prefix + '.names.npy', np.asarray(self._names))
+        _save_array(prefix + '.name_offsets.npy', np.asarray(self._name_offsets))
+        _save_array(prefix + '.items.npy', np.asarray(self._items))
+
+    def __getstate__(self):
+        # memory-mapped arrays are opened again in the other processes instead of being copied
+        state = dict()
+        for key in ['_names', '_name_offsets', '_items']:
+            array = getattr(self, key)
+            if isinstance(array, np.memmap) and array.filename is not None:
+                state[key] = ('mmap', array.filename)
+            else:
+                state[key] = ('array', np.asarray(array))
+
+        return state
+
+    def __setstate__(self, state):
+        arrays = dict()
+        for key, (kind, value) in state.items():
+            arrays[key] = np.load(value, mmap_mode='r') if kind == 'mmap' else value
+
+        self.__init__(arrays['_names'], arrays['_name_offsets'], arrays['_items'])
+
+    def __len__(self):
+        return len(self._items)
+
+    def _name(self, name_id):
+        start, end = self._name_offsets[name_id], self._name_offsets[name_id + 1]
+        return self._names[start:end].tobytes().decode('utf-8')
+
+    def __getitem__(self, i):
+        item = self._items[i]
+        name = self._name(item['path'])
+
+        if self._is_scp:
+            offset = int(item['offset'])
+            return name if offset < 0 else "%s:%d" % (name, offset)
+
+        return name, float(item['start']), float(item['end']), int(item['sample_rate'])
+
+    def replace(self, old, new):
+        """
+        :return: PathTable with old replaced by new in the file names (the items are shared)
+        """
+        names = [self._name(i).replace(old, new) for i in range(len(self._name_offsets) - 1)]
+
+        return PathTable(*self._encode_names(names), self._items)
+
+
+def load_path_tables(pt_file):
+    """
+    Load the audio paths saved by the preprocessing (data.scp_path.pt or .wav_path.pt) as PathTables.
+    The first time, the tables are written next to the .pt file, later they are only memory-mapped
+    (and the .pt file is not read).
+
+    :param pt_file: the .pt file with a list of paths, or a dictionary of lists
+    :return: PathTable or dictionary of PathTables
+    """
+    prefix = pt_file[:-len('.pt')] if pt_file.endswith('.pt') else pt_file
+    index_file = prefix + '.tables.pt'
+
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(pt_file):
+        keys = torch.load(index_file)
+        if keys is None:
+            return PathTable.load(prefix)
+
+        return {key: PathTable.load("%s.%s" % (prefix, key)) for key in keys}
+
+    return save_path_tables(pt_file, torch.load(pt_file))
+
+
+def save_path_tables(pt_file, data):
+    """
+    Write the tables of the audio paths next to the .pt file
+    :param pt_file: the .pt file with the paths
+    :param data: a list of paths or a dictionary of lists (the content of the .pt file)
+    :return: PathTable or dictionary of PathTables (memory-mapped if they could be written)
+    """
+    prefix = pt_file[:-len('.pt')] if pt_file.endswith('.pt') else pt_file
+
+    if isinstance(data, dict):
+        tables = {key: PathTable.from_list(entries) for key, entries in data.items()}
+        prefixes = {key: "%s.%s" % (prefix, key) for key in data}
+    else:
+        tables = {None: PathTable.from_list(data)}
+        prefixes = {None: prefix}
+
+    try:
+        for key in tables:
+            tables[key].save(prefixes[key])
+            tables[key] = PathTable.load(prefixes[key])
+
+        tmp_name = "%s.tables.pt.tmp%d" % (prefix, os.getpid())
+        torch.save(list(data) if isinstance(data, dict) else None, tmp_name)
+        os.replace(tmp_name, prefix + '.tables.pt')
+    except OSError as e:
+        print("[WARNING] Cannot write the path tables next to %s (%s), keeping them in memory" % (pt_file, e))
+
+    return tables if isinstance(data, dict) else tables[None]
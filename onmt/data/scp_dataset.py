@@ -15,7 +15,7 @@ class SCPIndexDataset(torch.utils.data.Dataset):
 
     def __init__(self, scp_path_list, concat=4, shared_object=None):
         """
-        :param scp_path_list: list of path to the ark matrices
+        :param scp_path_list: list (or PathTable) of path to the ark matrices
         """
         self.scp_path_list = scp_path_list
         self._sizes = len(self.scp_path_list)
@@ -7,6 +7,8 @@ import soundfile
 import math
 import torchaudio
 import os
+from onmt.data.path_table import PathTable
+from onmt.data.audio_utils import FileHandleCache
 
 
 # this function reads wav file based on the timestamp in seconds
@@ -35,14 +37,13 @@ def safe_readaudio_from_cache(file_, wav_path, start=0.0, end=0.0, sample_rate=1
 class WavDataset(torch.utils.data.Dataset):
     def __init__(self, wav_path_list, cache_size=0, wav_path_replace=None):
         """
-        :param scp_path_list: list of path to the ark matrices
+        :param wav_path_list: list (or PathTable) of tuples (wav_path, start, end, sample_rate)
         """
         self.wav_path_list = wav_path_list
         self._sizes = len(self.wav_path_list)
         self._dtype = torch.float32
         if cache_size > 0:
-            self.cache = dict()
-            self.usage = dict()
+            self.cache = FileHandleCache(cache_size, opener=self._open)
         else:
             self.cache = None
         self.cache_size = cache_size
@@ -53,21 +54,33 @@ class WavDataset(torch.utils.data.Dataset):
                 if old in self.wav_path_list[0][0]:
                     found = True
 
-                self.wav_path_list = [(x[0].replace(old,new),*x[1:]) for x in self.wav_path_list]
+                if isinstance(self.wav_path_list, PathTable):
+                    self.wav_path_list = self.wav_path_list.replace(old, new)
+                else:
+                    self.wav_path_list = [(x[0].replace(old,new),*x[1:]) for x in self.wav_path_list]
 
             if not found:
                 print(wav_path_replace, self.wav_path_list[0][0])
                 print("WARNING: Could not replace wav path")
 
+    @staticmethod
+    def _open(wav_path):
+        try:
+            return soundfile.SoundFile(wav_path, 'r')
+        except RuntimeError as e:
+            print("Wavpath invalid:", wav_path, os.path.exists(wav_path))
+            raise e
+
     def flush_cache(self):
 
         if self.cache is not None:
-            for wav_path in self.cache:
-                self.cache[wav_path].close()
-                self.cache[wav_path] = None
+            self.cache.close()
 
-        self.cache = dict()
-        self.usage = dict()
+    def cache_info(self):
+        """
+        :return: hits, misses, maxsize, currsize of the file cache (of this process) or None
+        """
+        return self.cache.cache_info() if self.cache is not None else None
 
     @property
     def dtype(self):
@@ -89,36 +102,9 @@ class WavDataset(torch.utils.data.Dataset):
 
         # there are many utterances sharing the save wavfiles -> we can keep the same object in memory
         if self.cache is not None:
-
-            # take the object in cache if exists
-            if wav_path in self.cache:
-                file_ = self.cache[wav_path]
-                self.usage[wav_path] = self.usage[wav_path] + 1
-            else:
-                # read the audio file
-                # print(os.path.exists(wav_path), wav_path)
-
-                try:
-                    file_ = soundfile.SoundFile(wav_path, 'r')
-                except RuntimeError as e:
-
-                    print("Wavpath invalid:", wav_path, os.path.exists(wav_path))
-                    raise e
-                if len(self.cache) > self.cache_size:
-                    # remove 1 file from cache based on lowest usage, maybe?
-                    min_key = min(self.usage, key=self.usage.get)
-                    if min_key != file_:
-                        self.cache[min_key].close()
-                        self.cache.pop(min_key, None)
-                        self.usage.pop(min_key, None)
-
-                # add the object to the cache
-                self.cache[wav_path] = file_
-                self.usage[wav_path] = 1
-
+            file_ = self.cache.get(wav_path)
             data = safe_readaudio_from_cache(file_, wav_path, start, end, sample_rate)
         else:
-            file_ = None
             data = safe_readaudio(wav_path, start, end, sample_rate)
 
         return data
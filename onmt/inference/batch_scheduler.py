@@ -0,0 +1,158 @@
+"""
+Request scheduling for the online translation servers (flask_mt.py and flask_online.py)
+"""
+import queue
+import threading
+import traceback
+
+
+class Request(object):
+    """
+    A request waiting for the translator.
+    Requests with higher priority come first, then in the order of arrival.
+    """
+    next_index = 0
+
+    def __init__(self, priority, data):
+        self.index = Request.next_index
+
+        Request.next_index += 1
+
+        self.priority = priority
+        self.data = data
+        self.result = None
+        self.done = threading.Event()
+
+    def __lt__(self, other):
+        return (-self.priority, self.index) < (-other.priority, other.index)
+
+    def get_data(self):
+        return self.data
+
+    def publish(self, result):
+        """
+        Send the result back to the waiting client. Only the first result is kept, so a request can be
+        answered as soon as its sentence is finished and the end of the batch doesn't answer it again.
+        """
+        if self.done.is_set():
+            return
+
+        self.result = result
+        self.done.set()
+
+    def is_published(self):
+        return self.done.is_set()
+
+    def wait(self):
+        self.done.wait()
+        return self.result
+
+
+class RequestBatchScheduler(object):
+    """
+    Forms the batches of the translation server at request granularity, between two runs of the translator:
+
+    - every request that arrived in the meantime is admitted before a new batch is formed,
+      not only the ones that came before the previous batch finished collecting
+    - requests that cannot join the current batch (different batch_key) stay in the waiting pool
+      and are served in the next batch instead of being decoded one by one
+    - the run function answers each request as soon as its sentence is finished (Request.publish),
+      the beam search already removes the finished sentences from the batch
+    - urgent requests (priority >= urgent_priority) are decoded alone
+
+    New requests never join a beam search that is already running: a batch is decoded until its
+    longest sentence is finished, and the waiting requests form the next batch.
+    """
+
+    def __init__(self, run_batch, max_batch_size=16, batch_key=None, urgent_priority=1):
+        """
+        :param run_batch: function that takes a list of requests and publishes their results
+        :param max_batch_size: maximum number of requests decoded together
+        :param batch_key: function mapping the data of a request to a key, only requests with the same key
+        are batched together (None: all requests can be batched)
+        :param urgent_priority: requests with at least this priority are decoded without waiting for others
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.batch_key = batch_key
+        self.urgent_priority = urgent_priority
+
+        self.queue = queue.PriorityQueue()
+        self.waiting = list()
+
+    def submit(self, data, priority=0):
+        """
+        Add a request and block until its result is published
+        :param data: input of the request (passed to run_batch)
+        :param priority: higher is served earlier
+        :return: result of the request
+        """
+        req = Request(priority, data)
+        self.queue.put(req)
+
+        return req.wait()
+
+    def start(self):
+        decoding = threading.Thread(target=self.run)
+        decoding.daemon = True
+        decoding.start()
+
+        return decoding
+
+    def admit(self):
+        """
+        Move the new requests into the waiting pool (blocks if there is nothing to do)
+        """
+        if len(self.waiting) == 0:
+            self.waiting.append(self.queue.get())
+
+        while True:
+            try:
+                self.waiting.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        self.waiting.sort()
+
+    def next_batch(self):
+        """
+        :return: the requests to decode next, starting with the most urgent / oldest request
+        """
+        self.admit()
+
+        first = self.waiting[0]
+
+        if first.priority >= self.urgent_priority:
+            batch = [first]
+        else:
+            key = self.batch_key(first.get_data()) if self.batch_key is not None else None
+            batch = list()
+
+            for req in self.waiting:
+                if len(batch) >= self.max_batch_size:
+                    break
+
+                if self.batch_key is None or self.batch_key(req.get_data()) == key:
+                    batch.append(req)
+
+        selected = set(id(req) for req in batch)
+        self.waiting = [req for req in self.waiting if id(req) not in selected]
+
+        return batch
+
+    def run(self):
+
+        while True:
+            reqs = self.next_batch()
+
+            print("Batch size:", len(reqs), "Queue size:", len(self.waiting) + self.queue.qsize())
+
+            try:
+                self.run_batch(reqs)
+            except Exception as e:
+                print("An error occured during model inference")
+                traceback.print_exc()
+
+            # the requests that did not get any result
+            for req in reqs:
+                req.publish({"hypo": "", "status": 400})
@@ -3,6 +3,7 @@ import onmt
 import onmt.modules
 import torch
 import math
+from collections import defaultdict
 from onmt.model_factory import build_model, optimize_model
 from onmt.inference.search import BeamSearch, Sampling
 from onmt.inference.translator import Translator
@@ -29,6 +30,8 @@ class FastTranslator(Translator):
         self.src_unk = onmt.constants.SRC_UNK
 
         self.tgt_bos = self.bos_id
+        # bos rule of change_language, used for the batches with one language pair per sentence
+        self.use_srclang_as_bos = None
         self.tgt_pad = onmt.constants.TGT_PAD
         self.tgt_eos = onmt.constants.TGT_EOS
         self.tgt_unk = onmt.constants.TGT_UNK
@@ -50,6 +53,17 @@ class FastTranslator(Translator):
         else:
             self.no_repeat_ngram_size = 0
 
+        if hasattr(opt, 'share_encoder_context'):
+            self.share_context = opt.share_encoder_context
+        else:
+            self.share_context = False
+
+        if self.share_context and not all(self.supports_shared_context(model_opt) for model_opt in self.model_opts):
+            print("[WARNING] -share_encoder_context needs the optimized encoder-decoder attention "
+                  "(models trained with -fast_xattention, or mbart/deltalm decoders). "
+                  "The encoder context is copied for every beam.")
+            self.share_context = False
+
         if hasattr(opt, 'dynamic_max_len'):
             self.dynamic_max_len = opt.dynamic_max_len
         else:
@@ -60,6 +74,15 @@ class FastTranslator(Translator):
         else:
             self.dynamic_max_len_scale = 1.2
 
+        if hasattr(opt, 'early_stop_bound'):
+            self.early_stop_bound = opt.early_stop_bound
+        else:
+            self.early_stop_bound = False
+
+        # statistics of the bound-based early stopping (the steps are an upper bound: max_len - stopping step)
+        self.early_stopped_sents = 0
+        self.early_stopped_steps = 0
+
         if opt.verbose:
             # print('* Current bos id is: %d, default bos id is: %d' % (self.tgt_bos, onmt.constants.BOS))
             print("src bos id is %d; src eos id is %d;  src pad id is %d; src unk id is %d"
@@ -110,6 +133,21 @@ class FastTranslator(Translator):
         else:
             self.use_filter = False
 
+        if hasattr(opt, 'lexical_table') and opt.lexical_table:
+            topk = opt.lexical_table_topk if hasattr(opt, 'lexical_table_topk') else 100
+            self.lexical_table = self.load_lexical_table(opt.lexical_table, topk)
+        else:
+            self.lexical_table = None
+
+        if hasattr(opt, 'shortlist_frequent'):
+            self.shortlist_frequent = opt.shortlist_frequent
+        else:
+            self.shortlist_frequent = 0
+
+        self.use_shortlist = self.lexical_table is not None or self.shortlist_frequent > 0
+        if self.use_shortlist:
+            self.frequent_words = self.get_frequent_words(self.shortlist_frequent)
+
         # Sub-model is used for ensembling Speech and Text models
         if opt.sub_model:
             self.sub_models = list()
@@ -301,6 +339,123 @@ class FastTranslator(Translator):
             self.external_tokenizer = None
             self.tgt_external_tokenizer = None
 
+        # the sentences of a batch can have different language pairs only if every language-dependent
+        # module of the models selects the language of each row
+        models = self.models + (self.sub_models if opt.sub_model else [])
+        self.mixed_languages = all(self.supports_mixed_languages(model) for model in models)
+
+    @staticmethod
+    def supports_shared_context(model_opt):
+        """
+        :param model_opt: training options of a model
+        :return: the encoder-decoder attention of the model can attend to a context shared by the beams
+        (EncdecMultiheadAttn, or the cross-attention of the pretrained mbart/deltalm decoders)
+        """
+        if getattr(model_opt, 'dec_pretrained_model', '') in ["deltalm", "mbart", "mbart50"]:
+            return True
+
+        return getattr(model_opt, 'fast_xattention', False)
+
+    @staticmethod
+    def supports_mixed_languages(model):
+        """
+        :param model: a translation model
+        :return: the model can decode a batch whose sentences have different languages. The language embeddings
+        and the fast factorized layers of the mbart decoder select the language of each row. The adapters,
+        the other factorized layers and the factorized encoder layers take one language for the whole batch.
+        """
+        decoder = getattr(model, 'decoder', None)
+        decoder_modules = set(id(module) for module in decoder.modules()) if decoder is not None else set()
+
+        for module in model.modules():
+            if type(module).__name__ == 'MultilingualAdapter' or \
+                    type(module).__module__.startswith(('onmt.modules.multilingual_factorized',
+                                                        'onmt.modules.multilingual_partitioned')):
+                return False
+
+            if getattr(module, 'is_factorized', False):
+                if not getattr(module, 'fast_factorize', False) or id(module) not in decoder_modules:
+                    return False
+
+        return True
+
+    def load_lexical_table(self, filename, topk=100):
+        """
+        :param filename: lexical translation table, one entry per line: source_word target_word [probability]
+        :param topk: number of target words kept for each source word (with the highest probabilities)
+        :return: dictionary source word index -> LongTensor of target word indices
+        """
+        print("[INFO] Reading the lexical translation table from %s" % filename)
+        entries = defaultdict(list)
+        src_dict = getattr(self, 'src_dict', None)
+
+        with open(filename, encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 2:
+                    continue
+
+                src_idx = src_dict.lookup(parts[0]) if src_dict is not None else None
+                tgt_idx = self.tgt_dict.lookup(parts[1])
+                if src_idx is None or tgt_idx is None:
+                    continue
+
+                prob = float(parts[2]) if len(parts) > 2 else 0
+                entries[src_idx].append((prob, tgt_idx))
+
+        lexical_table = dict()
+        for src_idx, targets in entries.items():
+            # the order of the file is kept for the entries without probability
+            targets = sorted(targets, key=lambda x: x[0], reverse=True)[:topk]
+            lexical_table[src_idx] = torch.LongTensor([tgt_idx for _, tgt_idx in targets])
+
+        print("[INFO] Lexical translation table with %d source words" % len(lexical_table))
+
+        return lexical_table
+
+    def get_frequent_words(self, n):
+        """
+        :param n: number of words
+        :return: LongTensor with the n most frequent target words and the special words which are always candidates
+        """
+        frequencies = self.tgt_dict.frequencies
+        n = min(n, self.tgt_dict.size())
+
+        if len(frequencies) > 0 and sum(frequencies.values()) > 0:
+            words = sorted(frequencies, key=lambda idx: frequencies[idx], reverse=True)[:n]
+        else:
+            # no counts (vocabulary of a pretrained model): the vocabularies are usually sorted by frequency
+            words = list(range(n))
+
+        return torch.LongTensor(words + [self.tgt_eos, self.tgt_unk, self.tgt_bos])
+
+    def build_shortlist(self, src, prefix_tokens=None):
+        """
+        :param src: source of the batch (T x B word indices for text)
+        :param prefix_tokens: forced prefixes of the batch (B x T), they must be candidates too
+        :return: sorted LongTensor of the candidate target words of the batch
+        """
+        candidates = [self.frequent_words]
+
+        if self.lexical_table is not None and src.dim() == 2:
+            for word in torch.unique(src).tolist():
+                if word in self.lexical_table:
+                    candidates.append(self.lexical_table[word])
+
+        if prefix_tokens is not None:
+            candidates.append(prefix_tokens.view(-1).cpu())
+
+        return torch.unique(torch.cat(candidates))
+
+    def set_shortlist(self, shortlist=None):
+        """
+        :param shortlist: candidate target words of the batch, None to decode with the whole vocabulary
+        """
+        for model in self.models + (self.sub_models if self.n_sub_models > 0 else []):
+            generator = model.generator[0] if isinstance(model.generator, torch.nn.ModuleList) else model.generator
+            if hasattr(generator, 'set_shortlist'):
+                generator.set_shortlist(shortlist)
+
     def change_language(self, new_src_lang=None, new_tgt_lang=None, use_srclang_as_bos=True):
         if new_src_lang is not None:
             self.src_lang = new_src_lang
@@ -318,16 +473,41 @@ class FastTranslator(Translator):
             print("[INFO] New Bos Token: %s Bos_ID: %d" % (self.bos_token, self.bos_id))
 
         self.tgt_bos = self.bos_id
+        self.use_srclang_as_bos = use_srclang_as_bos
         self.external_tokenizer.src_lang = self.src_lang
         self.tgt_external_tokenizer.src_lang = self.tgt_lang
 
-    def translate_batch(self, batches, sub_batches=None, prefix_tokens=None, anti_prefix=None, memory=None):
+    def get_bos_id(self, src_lang, tgt_lang):
+        """
+        BOS of a sentence when the languages are given per sentence, following the same rule as change_language
+        :param src_lang: source language of the sentence
+        :param tgt_lang: target language of the sentence
+        :return: index of the bos token in the target dictionary
+        """
+        if self.use_srclang_as_bos is None:
+            # the languages have never been changed: the bos token comes from the options
+            return self.tgt_bos
+
+        bos_token = src_lang if self.use_srclang_as_bos else tgt_lang
+
+        return self.tgt_dict.labelToIdx[bos_token]
+
+    def translate_batch(self, batches, sub_batches=None, prefix_tokens=None, anti_prefix=None, memory=None,
+                        on_finished=None, bos_tokens=None):
 
         with torch.no_grad():
             return self._translate_batch(batches, sub_batches=sub_batches, prefix_tokens=prefix_tokens,
-                                         anti_prefix=anti_prefix, memory=memory)
+                                         anti_prefix=anti_prefix, memory=memory, on_finished=on_finished,
+                                         bos_tokens=bos_tokens)
 
-    def _translate_batch(self, batches, sub_batches, prefix_tokens=None, anti_prefix=None, memory=None):
+    def _translate_batch(self, batches, sub_batches, prefix_tokens=None, anti_prefix=None, memory=None,
+                         on_finished=None, bos_tokens=None):
+        """
+        :param on_finished: optional function called with (sentence index, hypotheses sorted by score)
+        as soon as the search of one sentence is finished, while the rest of the batch is still decoding
+        :param bos_tokens: optional LongTensor [bsz] with the first target token of each sentence
+        (batches with different target languages), otherwise every hypothesis starts with self.tgt_bos
+        """
         batch = batches[0]
         # Batch size is in different location depending on data.
 
@@ -358,7 +538,10 @@ class FastTranslator(Translator):
         scores_buf = scores.clone()
         tokens = src.new(bsz * beam_size, max_len + 2).long().fill_(self.tgt_pad)
         tokens_buf = tokens.clone()
-        tokens[:, 0].fill_(self.tgt_bos)  # first token is
+        if bos_tokens is not None:
+            tokens[:, 0].copy_(bos_tokens.to(tokens.device).repeat_interleave(beam_size))
+        else:
+            tokens[:, 0].fill_(self.tgt_bos)  # first token is
         # tokens[:, 1].fill_(self.tgt_bos)  # first token is bos
         attn, attn_buf = None, None
         nonpad_idxs = None
@@ -378,14 +561,18 @@ class FastTranslator(Translator):
                     batchable_prefix = True
 
             if batchable_prefix:
-                prefix_tokens = prefix_tokens.repeat(beam_size, 1)
+                # the hypotheses are ordered sentence by sentence (bbsz_offsets)
+                prefix_tokens = prefix_tokens.repeat_interleave(beam_size, dim=0)
+                prefix_len = min(max_len + 2, prefix_tokens.size(1))
 
-                for b in range(bsz  * beam_size):
-                    for l in range(min(max_len + 2, prefix_tokens.size(1))):
-                        tokens[b, l].fill_(prefix_tokens[b, l])
+                tokens[:, :prefix_len].copy_(prefix_tokens[:, :prefix_len])
 
             # In this case, the scores of the prefix positions should be 0
 
+        if self.use_shortlist:
+            # the output layer only computes the candidate words of this batch
+            self.set_shortlist(self.build_shortlist(src, prefix_tokens))
+
         # list of completed sentences
         finalized = [[] for i in range(bsz)]
         finished = [False for i in range(bsz)]
@@ -493,6 +680,50 @@ class FastTranslator(Translator):
                 if not finished[sent] and is_finished(sent, step, unfin_idx):
                     finished[sent] = True
                     newly_finished.append(unfin_idx)
+
+                    if on_finished is not None:
+                        on_finished(sent, sorted(finalized[sent], key=lambda r: r['score'], reverse=True))
+            return newly_finished
+
+        def bound_finish(step, batch_sents, finalized_sents, cand_scores, eos_mask):
+            """
+            Finish the sentences whose finalized hypotheses can not be beaten anymore by the active ones:
+            the cumulative score of a hypothesis can only decrease, so its final (normalized) score is
+            at most its current score divided by the most favorable length penalty.
+            The n-best list of these sentences has less than beam_size hypotheses.
+            :param step: current time step
+            :param batch_sents: sentence of each row of the current batch
+            :param finalized_sents: rows finished by finalize_hypos at this step
+            :param cand_scores: cumulative scores of the candidates [bsz x cand_size]
+            :param eos_mask: eos candidates [bsz x cand_size]
+            :return: list of the newly finished rows
+            """
+            rows = [row for row, sent in enumerate(batch_sents)
+                    if not finished[sent] and len(finalized[sent]) > 0 and row not in finalized_sents]
+            if len(rows) == 0:
+                return []
+
+            # best score among the hypotheses that continue
+            best_active = cand_scores.masked_fill(eos_mask, -math.inf).max(dim=1)[0]
+            if self.normalize_scores:
+                # the hypotheses continuing after this step end with a length in [step + 2, max_len + 1]
+                length = max_len + 1 if self.len_penalty >= 0 else step + 2
+                best_active = best_active / (length ** self.len_penalty)
+            best_active = best_active.tolist()
+
+            newly_finished = []
+            for row in rows:
+                sent = batch_sents[row]
+                worst_score = min(hypo['score'] for hypo in finalized[sent])
+                if worst_score >= best_active[row]:
+                    finished[sent] = True
+                    newly_finished.append(row)
+                    self.early_stopped_sents += 1
+                    self.early_stopped_steps += max_len - step
+
+                    if on_finished is not None:
+                        on_finished(sent, sorted(finalized[sent], key=lambda r: r['score'], reverse=True))
+
             return newly_finished
 
         reorder_state = None
@@ -512,16 +743,23 @@ class FastTranslator(Translator):
             pretrained_clf = self.pretrained_clfs[i] if self.opt.pretrained_classifier else None
             decoder_states[i] = self.models[i].create_decoder_state(batches[i], beam_size, type=2,
                                                                     buffering=self.buffering,
-                                                                    pretrained_classifier=pretrained_clf)
+                                                                    pretrained_classifier=pretrained_clf,
+                                                                    share_context=self.share_context)
         if self.opt.sub_model:
             for i in range(self.n_sub_models):
                 sub_decoder_states[i] = self.sub_models[i].create_decoder_state(sub_batches[i], beam_size, type=2,
-                                                                                buffering=self.buffering)
+                                                                                buffering=self.buffering,
+                                                                                share_context=self.share_context)
 
         if self.dynamic_max_len:
             src_len = src.size(0)
             max_len = math.ceil(int(src_len) * self.dynamic_max_len_scale)
 
+        # preallocate the self-attention buffers for the maximum number of decoding steps
+        for decoder_state in list(decoder_states.values()) + list(sub_decoder_states.values()):
+            if hasattr(decoder_state, 'reserve'):
+                decoder_state.reserve(max_len + 1)
+
         # Start decoding
         if prefix_tokens is not None:
             if batchable_prefix:
@@ -620,15 +858,6 @@ class FastTranslator(Translator):
                         if decoded_.tolist() == anti_prefix[:-1]:
                             lprobs[i, _anti_prefix] = -math.inf
 
-            if self.no_repeat_ngram_size > 0:
-                # for each beam and batch sentence, generate a list of previous ngrams
-                gen_ngrams = [{} for bbsz_idx in range(bsz * beam_size)]
-                for bbsz_idx in range(bsz * beam_size):
-                    gen_tokens = tokens[bbsz_idx].tolist()
-                    for ngram in zip(*[gen_tokens[i:] for i in range(self.no_repeat_ngram_size)]):
-                        gen_ngrams[bbsz_idx][tuple(ngram[:-1])] = \
-                            gen_ngrams[bbsz_idx].get(tuple(ngram[:-1]), []) + [ngram[-1]]
-
             # Record attention scores
             if avg_attn_scores is not None:
                 if attn is None:
@@ -641,20 +870,9 @@ class FastTranslator(Translator):
             eos_bbsz_idx = buffer('eos_bbsz_idx')
             eos_scores = buffer('eos_scores', type_of=scores)
 
-            if self.no_repeat_ngram_size > 0:
-                def calculate_banned_tokens(bbsz_idx):
-                    # before decoding the next token, prevent decoding of ngrams that have already appeared
-                    ngram_index = tuple(tokens[bbsz_idx, step + 2 - self.no_repeat_ngram_size:step + 1].tolist())
-                    return gen_ngrams[bbsz_idx].get(ngram_index, [])
-
-                if step + 2 - self.no_repeat_ngram_size >= 0:
-                    # no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
-                    banned_tokens = [calculate_banned_tokens(bbsz_idx) for bbsz_idx in range(bsz * beam_size)]
-                else:
-                    banned_tokens = [[] for bbsz_idx in range(bsz * beam_size)]
-
-                for bbsz_idx in range(bsz * beam_size):
-                    lprobs[bbsz_idx, banned_tokens[bbsz_idx]] = -math.inf
+            # no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
+            if self.no_repeat_ngram_size > 0 and step + 2 - self.no_repeat_ngram_size >= 0:
+                self.ban_repeated_ngrams(tokens, lprobs, step)
 
             cand_scores, cand_indices, cand_beams = self.search.step(
                 step,
@@ -678,6 +896,10 @@ class FastTranslator(Translator):
                 out=eos_bbsz_idx.resize_(0),
             )
 
+            if self.early_stop_bound:
+                # sentence of each row of the batch, before finalizing the hypotheses of this step
+                batch_sents = [sent for sent in range(len(finished)) if not finished[sent]]
+
             finalized_sents = set()
             if eos_bbsz_idx.numel() > 0:
                 torch.masked_select(
@@ -688,6 +910,12 @@ class FastTranslator(Translator):
                 finalized_sents = finalize_hypos(step, eos_bbsz_idx, eos_scores)
                 num_remaining_sent -= len(finalized_sents)
 
+            if self.early_stop_bound and step < max_len:
+                bound_finished = bound_finish(step, batch_sents, finalized_sents, cand_scores, eos_mask)
+                if len(bound_finished) > 0:
+                    finalized_sents = list(finalized_sents) + bound_finished
+                    num_remaining_sent -= len(bound_finished)
+
             assert num_remaining_sent >= 0
             if num_remaining_sent == 0:
                 break
@@ -803,8 +1031,33 @@ class FastTranslator(Translator):
         for sent in range(len(finalized)):
             finalized[sent] = sorted(finalized[sent], key=lambda r: r['score'], reverse=True)
 
+        if self.use_shortlist:
+            self.set_shortlist(None)
+
         return finalized, gold_scores, gold_words, allgold_scores
 
+    def ban_repeated_ngrams(self, tokens, lprobs, step):
+        """
+        Prevent decoding the ngrams that have already appeared in the hypotheses (in place).
+        All ngrams of the token buffer are compared with the last (n-1) tokens of each hypothesis at once,
+        the tokens that would complete a matching ngram are banned.
+        :param tokens: token buffer [bsz*beam x max_len+2], the current step is at position step
+        :param lprobs: log probabilities of the next token [bsz*beam x vocab_size]
+        :param step: decoding step
+        """
+        n = self.no_repeat_ngram_size
+
+        # all ngrams of each hypothesis: [bsz*beam x n_ngrams x n]
+        ngrams = tokens.unfold(1, n, 1)
+
+        # the last (n-1) generated tokens: [bsz*beam x 1 x n-1]
+        last_tokens = tokens[:, step + 2 - n:step + 1].unsqueeze(1)
+
+        matched = ngrams[:, :, :-1].eq(last_tokens).all(dim=-1)
+        hypo_idx, ngram_idx = matched.nonzero(as_tuple=True)
+
+        lprobs[hypo_idx, ngrams[hypo_idx, ngram_idx, -1]] = -math.inf
+
     def _decode(self, tokens, decoder_states, sub_decoder_states=None):
 
         # require batch first for everything
@@ -832,34 +1085,45 @@ class FastTranslator(Translator):
 
         return out, attn
 
-    def build_prefix(self, prefixes, bsz=None):
+    def build_prefix(self, prefixes, bsz=None, bos_ids=None):
         """
         :param bsz:
         :param prefixes: List of strings
+        :param bos_ids: optional list of bos ids (one per sentence) replacing self.bos_id
         :return:
         """
+        if bos_ids is None:
+            bos_ids = [self.bos_id] * len(prefixes)
+        elif len(prefixes) == 1 and len(bos_ids) > 1:
+            # the same prefix for every sentence, but each one starts with its own bos
+            prefixes = prefixes * len(bos_ids)
+
+        # sentences without prefix (None) in a batch with prefixes get an empty (all-padding) prefix
         if self.external_tokenizer is None:
             prefix_data = [self.tgt_dict.convertToIdx(sent.split(),
                                                       onmt.constants.UNK_WORD)
-                            for sent in prefixes]
+                           if sent is not None else torch.LongTensor([])
+                           for sent in prefixes]
         else:
             # move the last element which is <eos>
             if self.opt.force_bos:
-                _prefix_data = [torch.LongTensor([self.bos_id] + self.external_tokenizer(sent)['input_ids'][:-1])
-                                for sent in prefixes]
+                _prefix_data = [torch.LongTensor([bos_id] + self.external_tokenizer(sent)['input_ids'][:-1])
+                                if sent is not None else torch.LongTensor([])
+                                for sent, bos_id in zip(prefixes, bos_ids)]
             else:
                 _prefix_data = [torch.LongTensor(self.external_tokenizer(sent)['input_ids'][:-1])
+                                if sent is not None else torch.LongTensor([])
                                 for sent in prefixes]
 
             prefix_data = _prefix_data
             #
             new_prefix_data = []
             #
-            for prefix_tensor in prefix_data:
-                if "MultilingualDeltaLM" in self.external_tokenizer.__class__.__name__:
+            for prefix_tensor, bos_id in zip(prefix_data, bos_ids):
+                if "MultilingualDeltaLM" in self.external_tokenizer.__class__.__name__ or prefix_tensor.numel() == 0:
                     pass
                 else:
-                    prefix_tensor[0] = self.bos_id
+                    prefix_tensor[0] = bos_id
                 new_prefix_data.append(prefix_tensor)
             #
             prefix_data = new_prefix_data
@@ -915,8 +1179,48 @@ class FastTranslator(Translator):
 
         return anti_prefix
 
+    @staticmethod
+    def tokenize_external(tokenizer, sents, langs=None):
+        """
+        :param tokenizer: external (huggingface) tokenizer
+        :param sents: list of tokenized sentences
+        :param langs: optional list of languages (one per sentence), the language code added by the
+        tokenizer is switched for each sentence
+        :return: list of LongTensor
+        """
+        if langs is None:
+            return [torch.LongTensor(tokenizer(" ".join(b))['input_ids']) for b in sents]
+
+        default_lang = tokenizer.src_lang
+        data = list()
+
+        for b, lang in zip(sents, langs):
+            tokenizer.src_lang = lang
+            data.append(torch.LongTensor(tokenizer(" ".join(b))['input_ids']))
+
+        tokenizer.src_lang = default_lang
+
+        return data
+
+    def build_lang_data(self, lang, langs=None):
+        """
+        :param lang: language of the whole batch
+        :param langs: optional list of languages (one per sentence)
+        :return: list of language tensors for onmt.Dataset
+        """
+        if langs is None or len(set(langs)) == 1:
+            # one language for the whole batch
+            langs = [lang if langs is None else langs[0]]
+
+        return [torch.Tensor([self.lang_dict[lang_]]) if lang_ in self.lang_dict else torch.Tensor([0])
+                for lang_ in langs]
+
     # override the "build_data" from parent Translator
-    def build_data(self, src_sents, tgt_sents, type='mt', past_sents=None):
+    def build_data(self, src_sents, tgt_sents, type='mt', past_sents=None, src_langs=None, tgt_langs=None):
+        """
+        :param src_langs: optional list of source languages (one per sentence), by default self.src_lang
+        :param tgt_langs: optional list of target languages (one per sentence), by default self.tgt_lang
+        """
         # This needs to be the same as preprocess.py.
         data_type = 'text'
 
@@ -947,8 +1251,7 @@ class FastTranslator(Translator):
                 else:
                     past_src_data = None
             else:
-                src_data = [torch.LongTensor(self.external_tokenizer(" ".join(b))['input_ids'])
-                            for b in src_sents]
+                src_data = self.tokenize_external(self.external_tokenizer, src_sents, src_langs)
 
                 if past_sents is not None:
                     past_src_data = [torch.LongTensor(self.external_tokenizer(" ".join(b))['input_ids'])
@@ -974,23 +1277,15 @@ class FastTranslator(Translator):
         tgt_data = None
         if tgt_sents:
             if self.tgt_external_tokenizer is not None:
-                tgt_data = [torch.LongTensor(self.tgt_external_tokenizer(" ".join(b))['input_ids'])
-                            for b in tgt_sents]
+                tgt_data = self.tokenize_external(self.tgt_external_tokenizer, tgt_sents, tgt_langs)
             else:
                 tgt_data = [self.tgt_dict.convertToIdx(b,
                                                        onmt.constants.UNK_WORD,
                                                        tgt_bos_word,
                                                        onmt.constants.EOS_WORD) for b in tgt_sents]
 
-        if self.src_lang in self.lang_dict:
-            src_lang_data = [torch.Tensor([self.lang_dict[self.src_lang]])]
-        else:
-            src_lang_data = [torch.Tensor([0])]
-
-        if self.tgt_lang in self.lang_dict:
-            tgt_lang_data = [torch.Tensor([self.lang_dict[self.tgt_lang]])]
-        else:
-            tgt_lang_data = [torch.Tensor([0])]
+        src_lang_data = self.build_lang_data(self.src_lang, src_langs)
+        tgt_lang_data = self.build_lang_data(self.tgt_lang, tgt_langs)
 
         try:
             src_atb = self.opt.src_atb
@@ -1026,11 +1321,35 @@ class FastTranslator(Translator):
                             past_src_data=past_src_data)
 
     def translate(self, src_data, tgt_data, past_src_data=None, sub_src_data=None, type='mt',
-                  prefix=None, anti_prefix=None, memory=None):
+                  prefix=None, anti_prefix=None, memory=None, on_finished=None, src_lang=None, tgt_lang=None):
+        """
+        :param on_finished: optional function called with (sentence index, n-best tokens, n-best ids)
+        as soon as one sentence of the batch is translated (used by the online servers to answer early)
+        :param src_lang: optional list of source languages, one per sentence (default: self.src_lang)
+        :param tgt_lang: optional list of target languages, one per sentence (default: self.tgt_lang)
+        the sentences of a batch can then be translated between different languages
+        (language ids, bos and prefix of each sentence follow its language pair), if the models support it
+        (self.mixed_languages). The languages shared by all sentences are given to the models once per batch.
+        """
 
         if past_src_data is None or len(past_src_data) == 0:
             past_src_data = None
 
+        if src_lang is not None or tgt_lang is not None:
+            n_sents = len(src_lang) if src_lang is not None else len(tgt_lang)
+            src_langs = src_lang if src_lang is not None else [self.src_lang] * n_sents
+            tgt_langs = tgt_lang if tgt_lang is not None else [self.tgt_lang] * n_sents
+            bos_ids = [self.get_bos_id(src_lang_, tgt_lang_) for src_lang_, tgt_lang_ in zip(src_langs, tgt_langs)]
+            bos_tokens = torch.LongTensor(bos_ids)
+
+            if not self.mixed_languages and (len(set(src_langs)) > 1 or len(set(tgt_langs)) > 1):
+                raise ValueError("The models cannot translate different language pairs in the same batch "
+                                 "(adapters or factorized layers with one language per batch), "
+                                 "the batch has to be split by language pair")
+        else:
+            src_langs, tgt_langs = None, None
+            bos_ids, bos_tokens = None, None
+
         #  (1) convert words to indexes
         if isinstance(src_data[0], list) and type in ['asr', 'asr_wav']:
             batches = list()
@@ -1039,24 +1358,27 @@ class FastTranslator(Translator):
                     past_src_data_ = past_src_data[i]
                 else:
                     past_src_data_ = None
-                dataset = self.build_data(src_data_, tgt_data, type=type, past_sents=past_src_data_)
+                dataset = self.build_data(src_data_, tgt_data, type=type, past_sents=past_src_data_,
+                                          src_langs=src_langs, tgt_langs=tgt_langs)
                 batch = dataset.get_batch(0)
                 batches.append(batch)
 
         elif isinstance(src_data[0], list) and isinstance(src_data[0][0], list):
             src_data = src_data[0]
-            dataset = self.build_data(src_data, tgt_data, type=type, past_sents=past_src_data)
+            dataset = self.build_data(src_data, tgt_data, type=type, past_sents=past_src_data,
+                                      src_langs=src_langs, tgt_langs=tgt_langs)
             batch = dataset.get_batch(0)  # this dataset has only one mini-batch
             batches = [batch] * self.n_models
             src_data = [src_data] * self.n_models
         else:
-            dataset = self.build_data(src_data, tgt_data, type=type, past_sents=past_src_data)
+            dataset = self.build_data(src_data, tgt_data, type=type, past_sents=past_src_data,
+                                      src_langs=src_langs, tgt_langs=tgt_langs)
             batch = dataset.get_batch(0)  # this dataset has only one mini-batch
             batches = [batch] * self.n_models
             src_data = [src_data] * self.n_models
 
         if sub_src_data is not None and len(sub_src_data) > 0:
-            sub_dataset = self.build_data(sub_src_data, tgt_data, type='mt')
+            sub_dataset = self.build_data(sub_src_data, tgt_data, type='mt', src_langs=src_langs, tgt_langs=tgt_langs)
             sub_batch = sub_dataset.get_batch(0)
             sub_batches = [sub_batch] * self.n_sub_models
             sub_src_data = [sub_src_data] * self.n_sub_models
@@ -1071,8 +1393,8 @@ class FastTranslator(Translator):
                 for i, _ in enumerate(sub_batches):
                     sub_batches[i].cuda(fp16=self.fp16)
 
-        if prefix is not None and len(prefix)>0 and prefix[0] is not None:
-            prefix_tensor = self.build_prefix(prefix, bsz=batch_size)
+        if prefix is not None and any(_prefix is not None for _prefix in prefix):
+            prefix_tensor = self.build_prefix(prefix, bsz=batch_size, bos_ids=bos_ids)
             print("PREFIX:", prefix_tensor)
         else:
             prefix_tensor = None
@@ -1081,12 +1403,25 @@ class FastTranslator(Translator):
             anti_prefix = self.build_anti_prefix(anti_prefix)
             print("ANTI PREFIX:", anti_prefix)
 
+        if on_finished is not None:
+            _src_data = src_data[0]
+
+            def _on_finished(b, hypos):
+                n_best = min(self.opt.n_best, len(hypos))
+                on_finished(b, [self.build_target_tokens(hypos[n]['tokens'], _src_data[b], None)
+                                for n in range(n_best)],
+                            [hypos[n]['tokens'] for n in range(n_best)])
+        else:
+            _on_finished = None
+
         #  (2) translate
         #  each model in the ensemble uses one batch in batches
         finalized, gold_score, gold_words, allgold_words = self.translate_batch(batches, sub_batches=sub_batches,
                                                                                 prefix_tokens=prefix_tensor,
                                                                                 anti_prefix=anti_prefix,
-                                                                                memory=memory)
+                                                                                memory=memory,
+                                                                                on_finished=_on_finished,
+                                                                                bos_tokens=bos_tokens)
         pred_length = []
 
         #  (3) convert indexes to words
@@ -1104,11 +1439,13 @@ class FastTranslator(Translator):
                 )
                 pred_ids.append([[] for n in range(self.opt.n_best)])
             else:
+                # the n-best list is shorter when the search of the sentence was stopped early
+                n_best = min(self.opt.n_best, len(finalized[b]))
                 pred_batch.append(
                     [self.build_target_tokens(finalized[b][n]['tokens'], src_data[b], None)
-                     for n in range(self.opt.n_best)]
+                     for n in range(n_best)]
                 )
-                pred_ids.append([finalized[b][n]['tokens'] for n in range(self.opt.n_best)])
+                pred_ids.append([finalized[b][n]['tokens'] for n in range(n_best)])
         pred_score = []
         for b in range(batch_size):
             if len(finalized[b]) == 0:
@@ -1119,7 +1456,7 @@ class FastTranslator(Translator):
             else:
                 pred_score.append(
                     [torch.FloatTensor([finalized[b][n]['score']])
-                     for n in range(self.opt.n_best)]
+                     for n in range(min(self.opt.n_best, len(finalized[b])))]
                 )
 
         return pred_batch, pred_ids, pred_score, pred_length, gold_score, gold_words, allgold_words
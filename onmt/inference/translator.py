@@ -31,6 +31,7 @@ class Translator(object):
 
         self.models = list()
         self.model_types = list()
+        self.model_opts = list()
 
         # models are string with | as delimiter
         models = opt.model.split("|")
@@ -50,6 +51,7 @@ class Translator(object):
                 model_opt.dec_state_dict = None
 
             self.main_model_opt = model_opt
+            self.model_opts.append(model_opt)
             dicts = checkpoint['dicts']
 
             # update special tokens
@@ -462,7 +462,7 @@ class RelativeTransformerDecoder(TransformerDecoder):
                                                         incremental, incremental_cache)
         else:
             for i, layer in enumerate(self.layer_modules):
-                buffer = buffers[i] if i in buffers else None
+                buffer = decoder_state.get_attention_buffer(i) if buffering else None
 
                 if buffering:
                     output, coverage, buffer = layer(output, context, pos_emb, dec_attn_mask, mask_src,
@@ -641,7 +641,8 @@ class RelativeTransformerDecoder(TransformerDecoder):
 
         if buffering:
             # use the last value of input to continue decoding
-            if input.size(1) > 1:
+            # (if the buffers are not initialized yet, then the whole prefix is decoded at once)
+            if input.size(1) > 1 and len(buffers) > 0:
                 input_ = input[:, -1].unsqueeze(1).transpose(0, 1)
             else:
                 input_ = input.transpose(0, 1)
@@ -676,7 +677,7 @@ class RelativeTransformerDecoder(TransformerDecoder):
 
         pos_emb = self.positional_encoder(pos)
 
-        if not buffering:
+        if not buffering or qlen > 1:
             dec_attn_mask = torch.triu(
                 emb.new_ones(qlen, klen), diagonal=1 + mlen).byte()[:, :, None]
             if onmt.constants.torch_version >= 1.2:
@@ -702,7 +703,7 @@ class RelativeTransformerDecoder(TransformerDecoder):
             output_1, output_2 = output, output
 
         for i, layer in enumerate(self.layer_modules):
-            buffer = buffers[i] if i in buffers else None
+            buffer = decoder_state.get_attention_buffer(i) if buffering else None
 
             if self.reversible:
                 if buffering:
@@ -833,9 +834,11 @@ class RelativeTransformer(Transformer):
 
     def create_decoder_state(self, batch, beam_size=1, type=1, streaming=False, previous_decoding_state=None,
                              factorize=True,
-                             pretrained_layer_states=None, **kwargs):
+                             pretrained_layer_states=None, buffering=False, share_context=False, **kwargs):
         """
         Generate a new decoder state based on the batch input
+        :param buffering: cache the keys and values of the previous steps (incremental decoding)
+        :param share_context: share the encoder output across the beams instead of copying it
         :param factorize:
         :param pretrained_layer_states:
         :param previous_decoding_state:
@@ -875,7 +878,8 @@ class RelativeTransformer(Transformer):
             else:
                 decoder_state = TransformerDecodingState(src, tgt_lang, encoder_output['context'],
                                                          encoder_output['src_mask'],
-                                                         beam_size=beam_size, model_size=self.model_size, type=type)
+                                                         beam_size=beam_size, model_size=self.model_size, type=type,
+                                                         buffering=buffering, share_context=share_context)
         else:
             streaming_state = previous_decoding_state.streaming_state
 
@@ -513,7 +513,7 @@ class SpeechTransformerDecoder(TransformerDecoder):
         output = emb.contiguous()
 
         for i, layer in enumerate(self.layer_modules):
-            buffer = buffers[i] if i in buffers else None
+            buffer = decoder_state.get_attention_buffer(i) if buffering else None
 
             if buffering:
                 output, coverage, buffer = layer(output, context, pos_emb, dec_attn_mask, mask_src,
@@ -540,9 +540,10 @@ class RelativeTransformer(Transformer):
 
     def create_decoder_state(self, batch, beam_size=1, type=1, streaming=False, previous_decoding_state=None,
                              factorize=True,
-                             pretrained_layer_states=None, **kwargs):
+                             pretrained_layer_states=None, share_context=False, **kwargs):
         """
         Generate a new decoder state based on the batch input
+        :param share_context: share the encoder output across the beams instead of copying it
         :param factorize:
         :param pretrained_layer_states:
         :param previous_decoding_state:
@@ -582,7 +583,8 @@ class RelativeTransformer(Transformer):
             else:
                 decoder_state = TransformerDecodingState(src, tgt_lang, encoder_output['context'],
                                                          encoder_output['src_mask'],
-                                                         beam_size=beam_size, model_size=self.model_size, type=type)
+                                                         beam_size=beam_size, model_size=self.model_size, type=type,
+                                                         share_context=share_context)
         else:
             streaming_state = previous_decoding_state.streaming_state
 
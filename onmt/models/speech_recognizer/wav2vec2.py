@@ -563,10 +563,11 @@ class Wav2vecTransformer(Transformer):
         return
 
     def forward(self, batch, adv_ptb_grad=False, input_ptb=None, factorize=False,
-                mirror=False, target_mask=None, **kwargs):
+                mirror=False, target_mask=None, chunked_loss=False, **kwargs):
         """
         :param factorize:
         :param mirror:
+        :param chunked_loss: don't compute the logits, the loss function projects the hidden states by chunks
         :param adv_ptb_grad: If we need to tell the model to set input.requires_grad=True (1st step)
         :param input_ptb: 2nd step of adversarial: add the perturbation to input
         :param batch: data object sent from the dataset
@@ -614,8 +615,11 @@ class Wav2vecTransformer(Transformer):
         output_dict['source'] = encoder_output['source']
 
         # final layer: computing softmax
-        logprobs = self.generator[0](output_dict)['logits']
-        output_dict['logprobs'] = logprobs
+        if chunked_loss:
+            output_dict['generator_weight'], output_dict['generator_bias'] = self.generator[0].get_output_weights()
+        else:
+            logprobs = self.generator[0](output_dict)['logits']
+            output_dict['logprobs'] = logprobs
 
         # Mirror network: reverse the target sequence and perform backward language model
         if mirror:
@@ -659,9 +663,10 @@ class Wav2vecTransformer(Transformer):
         self.encoder.wav2vec_encoder.load_state_dict(checkpoint['model'])
 
     def create_decoder_state(self, batch, beam_size=1, type=2, buffering=True,
-                             pretrained_layer_states=None, **kwargs):
+                             pretrained_layer_states=None, share_context=False, **kwargs):
         """
         Generate a new decoder state based on the batch input
+        :param share_context: share the encoder output across the beams instead of copying it
         :param pretrained_layer_states:
         :param buffering:
         :param type:
@@ -685,7 +690,8 @@ class Wav2vecTransformer(Transformer):
         print("[INFO] create Transformer decoding state with buffering", buffering)
         decoder_state = TransformerDecodingState(src, tgt_lang, encoder_output['context'], src_lang,
                                                  beam_size=beam_size, model_size=self.model_size,
-                                                 type=type, buffering=buffering, src_mask=src_mask)
+                                                 type=type, buffering=buffering, src_mask=src_mask,
+                                                 share_context=share_context)
 
         return decoder_state
 
@@ -765,6 +771,7 @@ class Wav2vecBERT(Wav2vecTransformer):
                 checkpointing_ffn=False,
                 checkpointing_cross_attn=False,
                 checkpointing_self_attn=False,
+                chunked_loss=False,
                 **kwargs):
         """
         :param checkpointing_self_attn:
@@ -775,6 +782,7 @@ class Wav2vecBERT(Wav2vecTransformer):
         :param factorize:
         :param target_mask:
         :param mirror:
+        :param chunked_loss: don't compute the logits, the loss function projects the hidden states by chunks
         :param kwargs:
         :return:
         """
@@ -910,8 +918,11 @@ class Wav2vecBERT(Wav2vecTransformer):
             output_dict['dec_pred_lang'] = decoder_outputs[-1]
 
         # final layer: computing softmax
-        logprobs = self.generator[0](output_dict)['logits']
-        output_dict['logprobs'] = logprobs
+        if chunked_loss:
+            output_dict['generator_weight'], output_dict['generator_bias'] = self.generator[0].get_output_weights()
+        else:
+            logprobs = self.generator[0](output_dict)['logits']
+            output_dict['logprobs'] = logprobs
 
         # Mirror network: reverse the target sequence and perform backward language model
         if mirror:
@@ -962,10 +973,12 @@ class Wav2vecBERT(Wav2vecTransformer):
 
         return output_dict
 
-    def create_decoder_state(self, batch, beam_size=1, type=1, buffering=True, **kwargs):
+    def create_decoder_state(self, batch, beam_size=1, type=1, buffering=True, share_context=False, **kwargs):
         """
         Generate a new decoder state based on the batch input
         :param buffering:
+        :param share_context: project the encoder output once per sentence instead of once per beam
+        (mbart/deltalm decoders only)
         :param streaming:
         :param type:
         :param batch: Batch object (may not contain target during decoding)
@@ -1002,11 +1015,14 @@ class Wav2vecBERT(Wav2vecTransformer):
             print("Warning: unknown dec_pretrained_model")
             raise NotImplementedError
 
+        # only the cross-attention of the mbart/deltalm decoders supports a context shared by the beams
+        share_context = share_context and dec_pretrained_model in ["deltalm", "mbart", "mbart50"]
+
         decoder_state = TransformerDecodingState(src, tgt_lang, encoder_output['context'], src_lang,
                                                  beam_size=beam_size, model_size=self.model_size,
                                                  type=type, buffering=buffering, src_mask=mask_src,
                                                  dec_pretrained_model=self.decoder.dec_pretrained_model,
-                                                 tgt_atb=tgt_atb)
+                                                 tgt_atb=tgt_atb, share_context=share_context)
 
         return decoder_state
 
@@ -12,6 +12,7 @@ from onmt.models.transformer_layers import EncoderLayer, DecoderLayer, Positiona
     PrePostProcessing
 from onmt.modules.base_seq2seq import NMTModel, Reconstructor, DecoderState
 from onmt.modules.dropout import embedded_dropout, switchout
+from onmt.modules.optimized.kv_cache import IncrementalKVCache
 from onmt.modules.linear import FeedForward, FeedForwardSwish
 from onmt.reversible_models.transformers import ReversibleTransformerEncoderLayer, ReversibleEncoderFunction, \
     ReversibleDecoderFunction, ReversibleTransformerDecoderLayer
@@ -543,10 +544,11 @@ class Transformer(NMTModel):
 
     def forward(self, batch, target_mask=None, streaming=False, zero_encoder=False,
                 mirror=False, streaming_state=None, nce=False, factorize=True,
-                pretrained_layer_states=None, **kwargs):
+                pretrained_layer_states=None, chunked_loss=False, **kwargs):
         """
         :param pretrained_layer_states:
         :param nce: use noise contrastive estimation
+        :param chunked_loss: don't compute the logits, the loss function projects the hidden states by chunks
         :param streaming_state:
         :param streaming:
         :param mirror: if using mirror network for future anticipation
@@ -610,6 +612,8 @@ class Transformer(NMTModel):
         # final layer: computing softmax
         if self.training and nce:
             output_dict = self.generator[0](output_dict)
+        elif chunked_loss:
+            output_dict['generator_weight'], output_dict['generator_bias'] = self.generator[0].get_output_weights()
         else:
             logprobs = self.generator[0](output_dict)['logits']
             output_dict['logprobs'] = logprobs
@@ -786,9 +790,11 @@ class Transformer(NMTModel):
         return output_dict
 
     def create_decoder_state(self, batch, beam_size=1, type=1, buffering=True,
-                             pretrained_classifier=None, pretrained_layer_states=None, **kwargs):
+                             pretrained_classifier=None, pretrained_layer_states=None, share_context=False,
+                             **kwargs):
         """
         Generate a new decoder state based on the batch input
+        :param share_context: share the encoder output across the beams instead of copying it
         :param pretrained_classifier: model to create mixtures
         :param buffering:
         :param type:
@@ -813,7 +819,8 @@ class Transformer(NMTModel):
         print("[INFO] create Transformer decoding state with buffering", buffering)
         decoder_state = TransformerDecodingState(src, tgt_lang, encoder_output['context'], src_lang,
                                                  beam_size=beam_size, model_size=self.model_size,
-                                                 type=type, buffering=buffering, tgt_atb=tgt_atb)
+                                                 type=type, buffering=buffering, tgt_atb=tgt_atb,
+                                                 share_context=share_context)
 
         return decoder_state
 
@@ -828,9 +835,12 @@ class Transformer(NMTModel):
 
 class TransformerDecodingState(DecoderState):
 
+    # buffers of the encoder-decoder attention (projected context), one row per sentence with share_context
+    context_buffer_keys = ('c_k', 'c_v')
+
     def __init__(self, src, tgt_lang, context, src_lang, beam_size=1, model_size=512, type=2,
                  cloning=True, buffering=False, src_mask=None, tgt_atb=None,
-                 dec_pretrained_model="", ):
+                 dec_pretrained_model="", max_len=None, share_context=False):
 
         """
         :param src:
@@ -842,21 +852,33 @@ class TransformerDecodingState(DecoderState):
         :param type: Type 1 is for old translation code. Type 2 is for fast buffering. (Type 2 default).
         :param cloning:
         :param buffering:
+        :param max_len: maximum number of decoding steps, used to preallocate the self-attention buffers
+        :param share_context: keep the encoder-side tensors (context, src, src_mask) at batch size instead of
+        copying them for every beam. The encoder-decoder attention broadcasts them across the beams.
+        tgt_lang and src_lang can be given per sentence (LongTensor [B]), then they follow the hypotheses
+        like the other states (src_lang like the context).
         """
 
         self.beam_size = beam_size
         self.model_size = model_size
         self.attention_buffers = dict()
+        self.max_len = max_len
         self.buffering = buffering
         self.dec_pretrained_model = dec_pretrained_model
         self.tgt_atb = tgt_atb
-
+        self.share_context = share_context and beam_size > 1
 
         bsz = src.size(1)  # src is T x B
         new_order = torch.arange(bsz).view(-1, 1).repeat(1, self.beam_size).view(-1)
         new_order = new_order.to(src.device)
 
-        if cloning:
+        if self.share_context:
+            # the beams of each sentence are kept together (sentence-major order)
+            # so the attention only needs to know the beam size to find the context of each beam
+            self.src = src
+            self.context = context
+            self.src_mask = src_mask
+        elif cloning:
             self.src = src.index_select(1, new_order)  # because src is time first
 
             if context is not None:
@@ -871,16 +893,61 @@ class TransformerDecodingState(DecoderState):
         else:
             self.context = context
             self.src = src
+            self.src_mask = src_mask
 
         self.concat_input_seq = False  # deprecated
+
+        # one language per sentence (heterogeneous batch) instead of one language for the whole batch
+        self.per_row_tgt_lang = self.is_per_row(tgt_lang, bsz)
+        self.per_row_src_lang = self.is_per_row(src_lang, bsz) and (self.share_context or cloning)
+
+        if self.per_row_tgt_lang:
+            tgt_lang = tgt_lang.index_select(0, new_order.to(tgt_lang.device))
+
+        if self.per_row_src_lang and not self.share_context:
+            src_lang = src_lang.index_select(0, new_order.to(src_lang.device))
+
         self.tgt_lang = tgt_lang
         self.src_lang = src_lang
 
+    @staticmethod
+    def is_per_row(lang, bsz):
+        """
+        :param lang: language ids given to the decoding state
+        :param bsz: batch size
+        :return: True if there is one language id for each sentence of the batch
+        """
+        return torch.is_tensor(lang) and lang.dim() == 1 and bsz > 1 and lang.numel() == bsz
 
     def update_attention_buffer(self, buffer, layer):
 
         self.attention_buffers[layer] = buffer  # dict of 2 keys (k, v) : T x B x H
 
+    def get_attention_buffer(self, layer):
+        """
+        Get the buffer of a decoder layer for incremental decoding.
+        New buffers come with a preallocated key/value cache ('kv') for the self-attention,
+        which is used by the attention functions that support it.
+        :param layer: layer index
+        :return: dictionary of the layer buffers
+        """
+        if layer not in self.attention_buffers or self.attention_buffers[layer] is None:
+            self.attention_buffers[layer] = {'kv': IncrementalKVCache(max_len=self.max_len)}
+
+        return self.attention_buffers[layer]
+
+    def reserve(self, max_len):
+        """
+        Set the maximum number of decoding steps so that the self-attention buffers are allocated only once
+        :param max_len: maximum number of decoding steps
+        """
+        self.max_len = max_len
+
+        for l in self.attention_buffers:
+            buffer_ = self.attention_buffers[l]
+            if buffer_ is not None and isinstance(buffer_.get('kv', None), IncrementalKVCache):
+                buffer_['kv'].reserve(max_len)
+
     def update_beam(self, beam, b, remaining_sents, idx):
 
         if self.beam_size == 1:
@@ -888,7 +955,7 @@ class TransformerDecodingState(DecoderState):
 
         for tensor in [self.src, self.input_seq]:
 
-            if tensor is None:
+            if tensor is None or (tensor is self.src and self.share_context):
                 continue
 
             t_, br = tensor.size()
@@ -904,11 +971,17 @@ class TransformerDecodingState(DecoderState):
                 continue
 
             for k in buffer_:
-                t_, br_, d_ = buffer_[k].size()
-                sent_states = buffer_[k].view(t_, self.beam_size, remaining_sents, d_)[:, :, idx, :]
+                if isinstance(buffer_[k], IncrementalKVCache):
+                    tensors = [buffer_[k].keys, buffer_[k].values] if not buffer_[k].is_empty() else []
+                else:
+                    tensors = [buffer_[k]]
 
-                sent_states.data.copy_(sent_states.data.index_select(
-                    1, beam[b].getCurrentOrigin()))
+                for tensor in tensors:
+                    t_, br_, d_ = tensor.size()
+                    sent_states = tensor.view(t_, self.beam_size, remaining_sents, d_)[:, :, idx, :]
+
+                    sent_states.data.copy_(sent_states.data.index_select(
+                        1, beam[b].getCurrentOrigin()))
 
     # in this section, the sentences that are still active are
     # compacted so that the decoder is not run on completed sentences
@@ -935,11 +1008,19 @@ class TransformerDecodingState(DecoderState):
             new_t = view.index_select(1, active_idx).view(*new_size)
             return new_t
 
-        self.context = update_active_with_hidden(self.context)
+        if self.share_context:
+            self.context = self.context.index_select(1, active_idx) if self.context is not None else None
+            self.src = self.src.index_select(1, active_idx)
+            if self.src_mask is not None:
+                self.src_mask = self.src_mask.index_select(0, active_idx)
+        else:
+            self.context = update_active_with_hidden(self.context)
 
         self.input_seq = update_active_without_hidden(self.input_seq)
 
-        if self.src.dim() == 2:
+        if self.share_context:
+            pass
+        elif self.src.dim() == 2:
             self.src = update_active_without_hidden(self.src)
         elif self.src.dim() == 3:
             t = self.src
@@ -950,26 +1031,55 @@ class TransformerDecodingState(DecoderState):
             new_t = view.index_select(1, active_idx).view(*new_size)
             self.src = new_t
 
+        # the rows of the preallocated buffers are laid out as beam x remaining_sents (see update_beam)
+        beam_offsets = torch.arange(self.beam_size, device=active_idx.device).unsqueeze(1) * remaining_sents
+        active_rows = (beam_offsets + active_idx.unsqueeze(0)).view(-1)
+
         for l in self.attention_buffers:
             buffer_ = self.attention_buffers[l]
 
             for k in buffer_:
-                buffer_[k] = update_active_with_hidden(buffer_[k])
+                if isinstance(buffer_[k], IncrementalKVCache):
+                    buffer_[k].index_select_(active_rows)
+                elif self.share_context and k in self.context_buffer_keys:
+                    buffer_[k] = buffer_[k].index_select(1, active_idx)
+                else:
+                    buffer_[k] = update_active_with_hidden(buffer_[k])
 
     # For the new decoder version only
     def _reorder_incremental_state(self, reorder_state):
 
-        if self.context is not None:
-            self.context = self.context.index_select(1, reorder_state)
+        if self.share_context:
+            # the beams only move inside their sentence, so the encoder-side tensors are untouched
+            # unless some sentences are finished and removed from the batch
+            if reorder_state.numel() != self.src.size(1) * self.beam_size:
+                sent_order = reorder_state.view(-1, self.beam_size)[:, 0].div(self.beam_size, rounding_mode='floor')
+                self._select_sentences(sent_order)
+        else:
+            if self.context is not None:
+                self.context = self.context.index_select(1, reorder_state)
 
-        if self.src_mask is not None:
-            self.src_mask = self.src_mask.index_select(0, reorder_state)
-        self.src = self.src.index_select(1, reorder_state)
+            if self.src_mask is not None:
+                self.src_mask = self.src_mask.index_select(0, reorder_state)
+            self.src = self.src.index_select(1, reorder_state)
+
+            if self.per_row_src_lang:
+                self.src_lang = self.src_lang.index_select(0, reorder_state.to(self.src_lang.device))
+
+        if self.per_row_tgt_lang:
+            self.tgt_lang = self.tgt_lang.index_select(0, reorder_state.to(self.tgt_lang.device))
 
         for l in self.attention_buffers:
             buffer_ = self.attention_buffers[l]
             if buffer_ is not None:
                 for k in buffer_.keys():
+                    if isinstance(buffer_[k], IncrementalKVCache):
+                        # reordered (and pruned) in place, the buffer is not copied to a new tensor
+                        buffer_[k].index_select_(reorder_state)
+                        continue
+                    if self.share_context and k in self.context_buffer_keys:
+                        # projected context (one row per sentence): already handled by _select_sentences
+                        continue
                     t_, br_, d_ = buffer_[k].size()
                     buffer_[k] = buffer_[k].index_select(1, reorder_state)
                     # if not self.dec_pretrained_model:
@@ -982,6 +1092,29 @@ class TransformerDecodingState(DecoderState):
                     #     print("Warning: check dec_pretrained_model type")
                     #     raise NotImplementedError
 
+    def _select_sentences(self, sent_order):
+        """
+        Remove the finished sentences from the encoder-side tensors when the context is shared across beams
+        :param sent_order: indices of the remaining sentences
+        """
+        if self.context is not None:
+            self.context = self.context.index_select(1, sent_order)
+
+        if self.src_mask is not None:
+            self.src_mask = self.src_mask.index_select(0, sent_order)
+        self.src = self.src.index_select(1, sent_order)
+
+        if self.per_row_src_lang:
+            self.src_lang = self.src_lang.index_select(0, sent_order.to(self.src_lang.device))
+
+        for l in self.attention_buffers:
+            buffer_ = self.attention_buffers[l]
+            if buffer_ is not None:
+                for k in self.context_buffer_keys:
+                    if k in buffer_:
+                        buffer_[k] = buffer_[k].index_select(1, sent_order)
+
+
 class TransformerDecodingStateMemory(TransformerDecodingState):
     def __init__(self, *args, encoder_output_memory=None, memory_text_enc=None, memory_text_mask=None, **kwargs):
         super().__init__(*args, **kwargs)
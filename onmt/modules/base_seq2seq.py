@@ -15,6 +15,9 @@ class Generator(nn.Module):
         self.linear = nn.Linear(hidden_size, output_size)
         self.fix_norm = fix_norm
         self.must_softmax = False
+        self.shortlist = None
+        self.shortlist_weight = None
+        self.shortlist_bias = None
         
         stdv = 1. / math.sqrt(self.linear.weight.size(1))
         
@@ -22,6 +25,35 @@ class Generator(nn.Module):
         
         self.linear.bias.data.zero_()
 
+    def set_shortlist(self, shortlist=None):
+        """
+        Restrict the output layer to a set of candidate words (decoding only).
+        Only the logits of the candidates are computed, the other words get -inf so they are never generated.
+        :param shortlist: LongTensor of word indices, None to use the whole vocabulary again
+        """
+        self.shortlist = shortlist
+
+        if shortlist is None:
+            self.shortlist_weight, self.shortlist_bias = None, None
+        else:
+            shortlist = shortlist.to(self.linear.weight.device)
+            self.shortlist = shortlist
+            self.shortlist_weight = self.linear.weight.index_select(0, shortlist)
+            self.shortlist_bias = self.linear.bias.index_select(0, shortlist)
+
+    def get_output_weights(self):
+        """
+        Weight and bias of the projection to the vocabulary, for the losses that compute the logits by chunks.
+        They are returned as (differentiable) views, so that the parameters are part of the forward pass.
+        :return: weight (V x H), bias (V)
+        """
+        if self.fix_norm:
+            weight = F.normalize(self.linear.weight, dim=-1)
+        else:
+            weight = self.linear.weight.view_as(self.linear.weight)
+
+        return weight, self.linear.bias.view_as(self.linear.bias)
+
     def forward(self, output_dicts):
         """
         :param output_dicts: dictionary contains the outputs from the decoder
@@ -32,7 +64,15 @@ class Generator(nn.Module):
         fix_norm = self.fix_norm
         target_mask = output_dicts['target_mask']
 
-        if not fix_norm:
+        if self.shortlist is not None and not self.training:
+            weight, bias = self.shortlist_weight, self.shortlist_bias
+            if fix_norm:
+                weight = F.normalize(weight, dim=-1)
+
+            shortlist_logits = F.linear(input, weight, bias)
+            logits = shortlist_logits.new_full(shortlist_logits.size()[:-1] + (self.output_size,), -math.inf)
+            logits.index_copy_(-1, self.shortlist, shortlist_logits)
+        elif not fix_norm:
             logits = self.linear(input)
         else:
             normalized_weights = F.normalize(self.linear.weight, dim=-1)
@@ -7,6 +7,7 @@ from torch.nn.modules.loss import _Loss
 
 import onmt
 import onmt.modules
+from onmt.modules.optimized.chunked_xentropy import chunked_linear_cross_entropy
 from onmt.utils import flip
 
 
@@ -62,7 +63,7 @@ class CrossEntropyLossBase(_Loss):
         :param logits: T x B x V or B x T x V tensor (output of decoder)
         :param targets: T x B x V or B x T target tensor
         :param vocab_mask V: bool tensor or None
-        :return:
+        :return: the loss, and the loss data (detached tensor on the device)
         """
         label_smoothing = self.label_smoothing if self.training else 0.0
 
@@ -81,12 +82,13 @@ class CrossEntropyLossBase(_Loss):
 
                 # We need to return the loss data without masking bad positions
                 # Otherwise the values from "low" validation perplexities cannot be trusted
+                # (the loss data stays on the device, reading it back would wait for the GPU)
                 with torch.no_grad():
-                    loss_data = loss.sum().data.item()
+                    loss_data = loss.detach().sum()
 
+                # masking unconditionally avoids testing bad_loss.any() on the host
                 bad_loss = torch.logical_or(torch.isinf(loss), torch.isnan(loss))
-                if bad_loss.any():
-                    loss.masked_fill_(bad_loss, 0)
+                loss.masked_fill_(bad_loss, 0)
 
                 loss = loss.sum()
             else:
@@ -97,11 +99,10 @@ class CrossEntropyLossBase(_Loss):
                                            label_smoothing=label_smoothing)
 
                     with torch.no_grad():
-                        loss_data = loss.sum().data.item()
+                        loss_data = loss.detach().sum()
 
                     bad_loss = torch.logical_or(torch.isinf(loss), torch.isnan(loss))
-                    if bad_loss.any():
-                        loss.masked_fill_(bad_loss, 0)
+                    loss.masked_fill_(bad_loss, 0)
 
                     loss = loss.sum()
 
@@ -123,10 +124,34 @@ class CrossEntropyLossBase(_Loss):
             nll_loss = nll_loss.sum()
             smooth_loss = smooth_loss.sum() if eps_i > 0 else None
             loss = (1. - label_smoothing) * nll_loss + eps_i * smooth_loss if eps_i > 0 else nll_loss
-            loss_data = loss.data.item()
+            loss_data = loss.detach()
 
         return loss, loss_data
 
+    def _compute_chunked_loss(self, hidden, targets, weight, bias=None):
+        """
+        Same loss as _compute_loss on the logits hidden x weight^T + bias, which are computed by chunks
+        of self.chunk_size tokens (the full N x V logits never exist)
+        :param hidden: N x H hidden states
+        :param targets: N target tensor
+        :param weight: V x H output weight
+        :param bias: V output bias or None
+        :return: the loss, the loss data and the number of correct predictions (detached tensors on the device)
+        """
+        label_smoothing = self.label_smoothing if self.training else 0.0
+
+        losses, preds = chunked_linear_cross_entropy(hidden, weight, bias, targets, label_smoothing,
+                                                     self.padding_idx, max(self.chunk_size, 1))
+
+        with torch.no_grad():
+            loss_data = losses.detach().sum()
+            correct = (preds == targets).sum()
+
+        bad_loss = torch.logical_or(torch.isinf(losses), torch.isnan(losses))
+        losses.masked_fill_(bad_loss, 0)
+
+        return losses.sum(), loss_data, correct
+
     def forward(self, model_outputs, targets, hiddens, **kwargs):
         return NotImplementedError
 
@@ -136,13 +161,14 @@ class NMTLossFunc(CrossEntropyLossBase):
     Standard NMT Loss Computation.
     """
 
-    def __init__(self, hidden_size, output_size, label_smoothing, mirror=False, padding_idx=0):
+    def __init__(self, hidden_size, output_size, label_smoothing, mirror=False, padding_idx=0, chunk_size=1024):
         """
         :param hidden_size:
         :param output_size:
         :param label_smoothing:
         :param mirror:
         :param padding_idx:
+        :param chunk_size: number of tokens projected at once when the model doesn't output the logits
         """
         super(NMTLossFunc, self).__init__(output_size, label_smoothing, padding_idx=padding_idx)
         self.hidden_size = hidden_size
@@ -152,6 +178,7 @@ class NMTLossFunc(CrossEntropyLossBase):
         self.confidence = 1.0 - label_smoothing
         self.label_smoothing = label_smoothing
         self.mirror = mirror
+        self.chunk_size = chunk_size
         self.extra_modules = nn.ModuleDict()
 
     def set_label_smoothing(self, new_value):
@@ -187,13 +214,27 @@ class NMTLossFunc(CrossEntropyLossBase):
         targets_ = targets.view(-1)
         non_pad_mask = torch.nonzero(targets_.ne(self.padding_idx)).squeeze(1)
         labels = targets_.index_select(0, non_pad_mask)
-        logits = logits.view(-1, logits.size(-1)).index_select(0, non_pad_mask)
 
-        with torch.no_grad():
-            # don't need softmax, just take argmax on unnormalized probabilities
-            preds = torch.argmax(logits, dim=1)
-            correct = (preds == labels).sum().item()
+        # the model can leave the projection to the vocabulary to the loss (chunked_loss)
+        chunked = logits is None and model_outputs.get('generator_weight') is not None
+
+        if chunked:
+            # the chunks are projected and normalized over the whole vocabulary here
+            assert not softmaxed, "The chunked loss needs the hidden states, not the probabilities"
+            assert vocab_mask is None, "The chunked loss does not support a vocabulary mask"
+            hidden = outputs.reshape(-1, outputs.size(-1)).index_select(0, non_pad_mask)
+            loss, loss_data, correct = self._compute_chunked_loss(hidden, labels,
+                                                                  model_outputs['generator_weight'],
+                                                                  model_outputs.get('generator_bias'))
             total = labels.numel()
+        else:
+            logits = logits.view(-1, logits.size(-1)).index_select(0, non_pad_mask)
+
+            with torch.no_grad():
+                # don't need softmax, just take argmax on unnormalized probabilities
+                preds = torch.argmax(logits, dim=1)
+                correct = (preds == labels).sum()
+                total = labels.numel()
 
         if mirror:
             reverse_outputs = model_outputs['reverse_hidden']
@@ -203,7 +244,8 @@ class NMTLossFunc(CrossEntropyLossBase):
             reverse_targets = model_outputs['reverse_target']
             alpha = 1.0
 
-        loss, loss_data = self._compute_loss(logits, labels, vocab_mask=vocab_mask, softmaxed=softmaxed)
+        if not chunked:
+            loss, loss_data = self._compute_loss(logits, labels, vocab_mask=vocab_mask, softmaxed=softmaxed)
 
         total_loss = loss
 
@@ -299,7 +341,7 @@ class MPCLoss(_Loss):
         source = clean_source.index_select(0, clean_masked_positions)
 
         loss = F.l1_loss(mpc_rec.float(), source.float(), reduction='sum')
-        loss_data = loss.item()
+        loss_data = loss.detach()
 
         output_dict = {"loss": loss, "data": loss_data, "numel": mpc_rec.size(0)}
 
@@ -373,7 +415,7 @@ class ClassifierLoss(CrossEntropyLossBase):
         # # loss, loss_data = self._compute_loss(clean_logits, clean_targets, softmaxed=softmaxed)
         loss = F.cross_entropy(clean_logits.float(), clean_targets, weight=None,
                                 ignore_index=-100, reduction='sum', label_smoothing=self.label_smoothing)
-        loss_data = loss.item()
+        loss_data = loss.detach()
         #
         predictions = F.log_softmax(clean_logits.float()).topk(1, dim=1)[1].squeeze(1)
         #
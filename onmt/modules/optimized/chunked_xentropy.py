@@ -0,0 +1,109 @@
+import torch
+import torch.nn.functional as F
+
+try:
+    from torch.cuda.amp import custom_fwd, custom_bwd
+except (ModuleNotFoundError, ImportError) as e:
+    from .compat import custom_fwd, custom_bwd
+
+
+class ChunkedLinearCrossEntropy(torch.autograd.Function):
+    """
+    Projection of the hidden states to the vocabulary followed by the (label smoothed) cross entropy,
+    computed by chunks of tokens: only the logits of one chunk exist at a time, and they are computed
+    again in the backward pass (from the hidden states and the log-sum-exp saved by the forward pass).
+    The loss of a token is (1 - smoothing) * nll + smoothing * mean_v(-log p_v), as in F.cross_entropy.
+    """
+
+    @staticmethod
+    @custom_fwd
+    def forward(ctx, hidden, weight, bias, labels, smoothing=0.0, padding_idx=0, chunk_size=1024):
+        """
+        :param hidden: N x H
+        :param weight: V x H
+        :param bias: V or None
+        :param labels: N
+        :param smoothing: label smoothing
+        :param padding_idx: the loss of the padded tokens is 0
+        :param chunk_size: number of tokens projected at once
+        :return: the loss of each token (N, float32) and the predicted word of each token (N)
+        """
+        n_tokens = hidden.size(0)
+        losses = hidden.new_empty(n_tokens, dtype=torch.float32)
+        log_sum_exp = hidden.new_empty(n_tokens, dtype=torch.float32)
+        predictions = labels.new_empty(n_tokens)
+
+        for start in range(0, n_tokens, chunk_size):
+            end = min(start + chunk_size, n_tokens)
+            logits = F.linear(hidden[start:end], weight, bias).float()
+
+            lse = torch.logsumexp(logits, dim=-1)
+            nll = lse - logits.gather(1, labels[start:end].unsqueeze(1)).squeeze(1)
+            if smoothing > 0:
+                nll = (1.0 - smoothing) * nll + smoothing * (lse - logits.mean(dim=-1))
+
+            losses[start:end] = nll
+            log_sum_exp[start:end] = lse
+            predictions[start:end] = logits.argmax(dim=-1)
+
+        losses.masked_fill_(labels.eq(padding_idx), 0)
+
+        ctx.save_for_backward(hidden, weight, bias, labels, log_sum_exp)
+        ctx.smoothing = smoothing
+        ctx.padding_idx = padding_idx
+        ctx.chunk_size = chunk_size
+        ctx.mark_non_differentiable(predictions)
+
+        return losses, predictions
+
+    @staticmethod
+    @custom_bwd
+    def backward(ctx, grad_losses, grad_predictions):
+        hidden, weight, bias, labels, log_sum_exp = ctx.saved_tensors
+        smoothing, chunk_size = ctx.smoothing, ctx.chunk_size
+        vocab_size = weight.size(0)
+
+        grad_losses = grad_losses.float().masked_fill(labels.eq(ctx.padding_idx), 0)
+
+        grad_hidden = torch.empty_like(hidden) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros_like(weight, dtype=torch.float32) if ctx.needs_input_grad[1] else None
+        grad_bias = torch.zeros_like(bias, dtype=torch.float32) \
+            if bias is not None and ctx.needs_input_grad[2] else None
+
+        for start in range(0, hidden.size(0), chunk_size):
+            end = min(start + chunk_size, hidden.size(0))
+            chunk_hidden = hidden[start:end]
+            grad_chunk = grad_losses[start:end]
+
+            # d loss / d logits = softmax - (1 - smoothing) * one_hot(label) - smoothing / V
+            grad_logits = F.linear(chunk_hidden, weight, bias).float()
+            grad_logits.sub_(log_sum_exp[start:end].unsqueeze(1)).exp_()
+            grad_logits[torch.arange(end - start, device=labels.device), labels[start:end]] -= (1.0 - smoothing)
+            if smoothing > 0:
+                grad_logits.sub_(smoothing / vocab_size)
+            grad_logits.mul_(grad_chunk.unsqueeze(1))
+            # the tokens without gradient (padding, masked losses) can have non-finite logits
+            grad_logits.masked_fill_(grad_chunk.eq(0).unsqueeze(1), 0)
+            grad_logits = grad_logits.to(hidden.dtype)
+
+            if grad_hidden is not None:
+                grad_hidden[start:end] = torch.mm(grad_logits, weight.to(hidden.dtype))
+            if grad_weight is not None:
+                grad_weight.add_(torch.mm(grad_logits.t(), chunk_hidden))
+            if grad_bias is not None:
+                grad_bias.add_(grad_logits.float().sum(dim=0))
+
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+        if grad_bias is not None:
+            grad_bias = grad_bias.to(bias.dtype)
+
+        return grad_hidden, grad_weight, grad_bias, None, None, None, None
+
+
+def chunked_linear_cross_entropy(hidden, weight, bias, labels, smoothing=0.0, padding_idx=0, chunk_size=1024):
+    """
+    :return: the loss of each token and the predicted words, without the full N x V logits
+    (see ChunkedLinearCrossEntropy)
+    """
+    return ChunkedLinearCrossEntropy.apply(hidden, weight, bias, labels, smoothing, padding_idx, chunk_size)
@@ -3,7 +3,7 @@ import torch
 from torch import nn
 from torch.nn import Parameter
 import torch.nn.functional as F
-from .encdec_attention_func import encdec_attn_func
+from .encdec_attention_func import encdec_attn_func, beam_shared_attention
 import onmt
 
 
@@ -95,6 +95,7 @@ class EncdecMultiheadAttn(nn.Module):
             len_q = query.size(0)
             len_k = key.size(0)
             bsz = query.size(1)
+            bsz_kv = key.size(1)  # smaller than bsz if the context is shared across beams
             heads = self.num_heads
             head_dim = self.head_dim
             scale_t = torch.tensor([head_dim ** -0.5])
@@ -105,24 +106,31 @@ class EncdecMultiheadAttn(nn.Module):
             if incremental and ('c_k' in incremental_cache and 'c_v' in incremental_cache):
                 keys = incremental_cache['c_k']
                 values = incremental_cache['c_v']
-                keys = keys.view(len_k, bsz * heads, head_dim)
-                values = values.view(len_k, bsz * heads, head_dim)
+                keys = keys.view(len_k, bsz_kv * heads, head_dim)
+                values = values.view(len_k, bsz_kv * heads, head_dim)
             else:
                 input_lin_kv_results = self.linear_kv(key)
 
-                input_lin_kv_results = input_lin_kv_results.view(len_k, bsz * heads, 2, head_dim)
+                input_lin_kv_results = input_lin_kv_results.view(len_k, bsz_kv * heads, 2, head_dim)
 
                 keys = input_lin_kv_results[:, :, 0, :]
                 values = input_lin_kv_results[:, :, 1, :]
                 if incremental:
-                    keys = keys.contiguous().view(len_k, bsz, heads * head_dim)
-                    values = values.contiguous().view(len_k, bsz, heads * head_dim)
+                    keys = keys.contiguous().view(len_k, bsz_kv, heads * head_dim)
+                    values = values.contiguous().view(len_k, bsz_kv, heads * head_dim)
 
                     incremental_cache['c_k'] = keys
                     incremental_cache['c_v'] = values
 
-                    keys = keys.view(len_k, bsz * heads, head_dim)
-                    values = values.view(len_k, bsz * heads, head_dim)
+                    keys = keys.view(len_k, bsz_kv * heads, head_dim)
+                    values = values.view(len_k, bsz_kv * heads, head_dim)
+
+            if bsz_kv != bsz:
+                matmul2_results, softmax_results = beam_shared_attention(queries, keys, values, mask,
+                                                                         heads, scale_t[0])
+                outputs = self.out_linear(matmul2_results)
+
+                return outputs, softmax_results
 
             matmul1_results = torch.matmul(queries.transpose(0, 1), keys.transpose(0, 1).transpose(1, 2))
             matmul1_results.mul_(scale_t[0])
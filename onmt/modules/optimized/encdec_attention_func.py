@@ -33,6 +33,56 @@ def rotate_backward(dx):
     return torch.cat((dx1, -dx2), dim=dx1.ndim - 1)
 
 
+def beam_shared_attention(queries, keys, values, mask, heads, scale):
+    """
+    Attention of the queries of all beams over the keys and values of their source sentence,
+    used when the encoder output is not copied for every beam during decoding.
+    The beams of one sentence are consecutive in the query batch (the order of TransformerDecodingState)
+    (no backward pass, only for inference)
+    :param queries: [len_q x bsz*beam*heads x head_dim]
+    :param keys: [len_k x bsz*heads x head_dim]
+    :param values: [len_k x bsz*heads x head_dim]
+    :param mask: None or bool mask [bsz x 1 x 1 x len_k]
+    :param heads: number of heads
+    :param scale: scaling factor of the attention scores
+    :return: attention output [len_q x bsz*beam x heads*head_dim] and
+             attention probabilities [bsz*beam*heads x len_q x len_k]
+    """
+    len_q, len_k, head_dim = queries.size(0), keys.size(0), queries.size(2)
+    bsz = keys.size(1) // heads
+    beam = queries.size(1) // (bsz * heads)
+
+    # the beams of each sentence are moved into the query dimension
+    # [len_q, bsz, beam, heads, head_dim] -> [bsz * heads, beam * len_q, head_dim]
+    queries = queries.view(len_q, bsz, beam, heads, head_dim).permute(1, 3, 2, 0, 4) \
+        .reshape(bsz * heads, beam * len_q, head_dim)
+
+    matmul1_results = torch.bmm(queries, keys.transpose(0, 1).transpose(1, 2)).mul_(scale)
+
+    if mask is not None:
+        matmul1_results = matmul1_results.view(bsz, heads, beam * len_q, len_k)
+        matmul1_results = matmul1_results.masked_fill_(mask, float('-inf'))
+        matmul1_results = matmul1_results.view(bsz * heads, beam * len_q, len_k)
+
+    softmax_results = F.softmax(matmul1_results, dim=-1, dtype=torch.float32).type_as(matmul1_results)
+
+    nan_mask = torch.isnan(softmax_results)
+    if nan_mask.any():
+        softmax_results.masked_fill_(nan_mask, 0)
+
+    matmul2_results = torch.bmm(softmax_results, values.transpose(0, 1))
+
+    # [bsz, heads, beam, len_q, head_dim] -> [len_q, bsz * beam, heads * head_dim]
+    matmul2_results = matmul2_results.view(bsz, heads, beam, len_q, head_dim).permute(3, 0, 2, 1, 4) \
+        .reshape(len_q, bsz * beam, heads * head_dim)
+
+    # back to the layout of the normal attention [bsz * beam * heads, len_q, len_k]
+    softmax_results = softmax_results.view(bsz, heads, beam, len_q, len_k).transpose(1, 2) \
+        .reshape(bsz * beam * heads, len_q, len_k)
+
+    return matmul2_results, softmax_results
+
+
 class EncdecAttnFunc(torch.autograd.Function):
     @staticmethod
     @custom_fwd
@@ -59,6 +109,8 @@ class EncdecAttnFunc(torch.autograd.Function):
         output_weights = output_weights.contiguous()
 
         bsz, len_q, len_k = inputs_q.size(1), inputs_q.size(0), inputs_kv.size(0)
+        # the context can be shared by several beams (bsz_kv < bsz) during incremental decoding
+        bsz_kv = inputs_kv.size(1)
         ctx.incremental = incremental
         ctx.fused_softmax_dropout = False
         ctx.fused_all = False
@@ -78,7 +130,7 @@ class EncdecAttnFunc(torch.autograd.Function):
             else:
                 mask = mask.unsqueeze(1).unsqueeze(2)  # for the head and query dimension
 
-        if encdec_multihead_attn_cuda is not None and not incremental and len_k <= 2048 \
+        if encdec_multihead_attn_cuda is not None and not incremental and len_k <= 2048 and bsz_kv == bsz \
                 and inputs_q.type() == 'torch.cuda.HalfTensor' and not rotary_pos_enc:
             input_lin_q_results, input_lin_kv_results, \
             softmax_results, dropout_results, dropout_mask, \
@@ -148,8 +200,8 @@ class EncdecAttnFunc(torch.autograd.Function):
         if incremental and ('c_k' in incremental_cache and 'c_v' in incremental_cache):
             keys = incremental_cache['c_k']
             values = incremental_cache['c_v']
-            keys = keys.view(len_k, bsz * heads, head_dim)
-            values = values.view(len_k, bsz * heads, head_dim)
+            keys = keys.view(len_k, bsz_kv * heads, head_dim)
+            values = values.view(len_k, bsz_kv * heads, head_dim)
             input_lin_kv_results = torch.stack([keys, values], dim=-2)
         else:
             input_lin_kv_results = torch.mm(inputs_kv.view(inputs_kv.size(0) * inputs_kv.size(1), inputs_kv.size(2)),
@@ -161,14 +213,29 @@ class EncdecAttnFunc(torch.autograd.Function):
             keys = input_lin_kv_results[:, :, 0, :]
             values = input_lin_kv_results[:, :, 1, :]
             if incremental:
-                keys = keys.contiguous().view(len_k, bsz, heads * head_dim)
-                values = values.contiguous().view(len_k, bsz, heads * head_dim)
+                keys = keys.contiguous().view(len_k, bsz_kv, heads * head_dim)
+                values = values.contiguous().view(len_k, bsz_kv, heads * head_dim)
 
                 incremental_cache['c_k'] = keys
                 incremental_cache['c_v'] = values
 
-                keys = keys.view(len_k, bsz * heads, head_dim)
-                values = values.view(len_k, bsz * heads, head_dim)
+                keys = keys.view(len_k, bsz_kv * heads, head_dim)
+                values = values.view(len_k, bsz_kv * heads, head_dim)
+
+        if bsz_kv != bsz:
+            assert not is_training and not rotary_pos_enc, \
+                "Sharing the context across beams is only supported for decoding"
+            matmul2_results, softmax_results = beam_shared_attention(queries, keys, values, mask,
+                                                                     heads, scale_t[0])
+
+            outputs = torch.mm(matmul2_results.view(len_q * bsz, inputs_q.size(2)),
+                               output_weights.transpose(0, 1))
+            outputs = outputs.view(len_q, bsz, output_weights.size(0))
+
+            if return_coverage:
+                return outputs, softmax_results
+            else:
+                return (outputs,)
 
         # TODO: rotary pos encoding
         if rotary_pos_enc:
@@ -12,6 +12,8 @@ try:
 except (ModuleNotFoundError, ImportError) as e:
     from .compat import custom_fwd, custom_bwd
 
+from .encdec_attention_func import beam_shared_attention
+
 try:
     import encdec_multihead_attn_bias_cuda
 except (ModuleNotFoundError, ImportError) as e:
@@ -56,6 +58,8 @@ class EncdecAttnBiasFunc(torch.autograd.Function):
         use_mask = (mask is not None)
 
         bsz, len_q, len_k = inputs_q.size(1), inputs_q.size(0), inputs_kv.size(0)
+        # the context can be shared by several beams (bsz_kv < bsz) during decoding
+        bsz_kv = inputs_kv.size(1)
         ctx.incremental = incremental
         ctx.fused_softmax_dropout = False
         ctx.fused_all = False
@@ -66,7 +70,7 @@ class EncdecAttnBiasFunc(torch.autograd.Function):
         ctx.recompute = recompute
         ctx.rotary_pos_enc = rotary_pos_enc
 
-        if encdec_multihead_attn_bias_cuda is not None and not incremental and len_k <= 2048 \
+        if encdec_multihead_attn_bias_cuda is not None and not incremental and len_k <= 2048 and bsz_kv == bsz \
                 and inputs_q.type() == 'torch.cuda.HalfTensor' and not rotary_pos_enc and low_precision:
 
             mask_ = mask
@@ -171,8 +175,8 @@ class EncdecAttnBiasFunc(torch.autograd.Function):
         if incremental and ('c_k' in incremental_cache and 'c_v' in incremental_cache):
             keys = incremental_cache['c_k']
             values = incremental_cache['c_v']
-            keys = keys.view(len_k, bsz * heads, head_dim)
-            values = values.view(len_k, bsz * heads, head_dim)
+            keys = keys.view(len_k, bsz_kv * heads, head_dim)
+            values = values.view(len_k, bsz_kv * heads, head_dim)
             input_lin_kv_results = torch.stack([keys, values], dim=-2)
         else:
             #print("inputs_kv",inputs_kv.shape, "len_kv x b x d_model")
@@ -188,14 +192,31 @@ class EncdecAttnBiasFunc(torch.autograd.Function):
             values = input_lin_kv_results[:, :, 1, :]
             #print("keys", keys.shape, "values", values.shape, "len_kv x b*heads x head_dim")
             if incremental:
-                keys = keys.contiguous().view(len_k, bsz, heads * head_dim)
-                values = values.contiguous().view(len_k, bsz, heads * head_dim)
+                keys = keys.contiguous().view(len_k, bsz_kv, heads * head_dim)
+                values = values.contiguous().view(len_k, bsz_kv, heads * head_dim)
 
                 incremental_cache['c_k'] = keys
                 incremental_cache['c_v'] = values
 
-                keys = keys.view(len_k, bsz * heads, head_dim)
-                values = values.view(len_k, bsz * heads, head_dim)
+                keys = keys.view(len_k, bsz_kv * heads, head_dim)
+                values = values.view(len_k, bsz_kv * heads, head_dim)
+
+        if bsz_kv != bsz:
+            assert not is_training and not rotary_pos_enc, \
+                "Sharing the context across beams is only supported for decoding"
+            matmul2_results, softmax_results = beam_shared_attention(queries, keys, values, mask,
+                                                                     heads, scale_t[0])
+
+            outputs = torch.addmm(output_bias,
+                                  matmul2_results.view(len_q * bsz, inputs_q.size(2)),
+                                  output_weights.transpose(0, 1),
+                                  beta=1., alpha=1.)
+            outputs = outputs.view(len_q, bsz, output_weights.size(0))
+
+            if return_coverage:
+                return outputs, softmax_results
+            else:
+                return (outputs,)
 
         # TODO: rotary pos encoding
         if rotary_pos_enc:
@@ -675,6 +696,8 @@ class EncdecAttnBiasCompactFunc(torch.autograd.Function):
         use_mask = (mask is not None)
 
         bsz, len_q, len_k = input_lin_q_results.size(1), input_lin_q_results.size(0), input_lin_kv_results.size(0)
+        # the context can be shared by several beams (bsz_kv < bsz) during decoding
+        bsz_kv = input_lin_kv_results.size(1)
         ctx.incremental = incremental
         ctx.fused_softmax_dropout = False
         ctx.fused_all = False
@@ -685,7 +708,7 @@ class EncdecAttnBiasCompactFunc(torch.autograd.Function):
         ctx.recompute = recompute
         ctx.rotary_pos_enc = rotary_pos_enc
 
-        if encdec_multihead_attn_bias_cuda is not None and not incremental and len_k <= 2048 \
+        if encdec_multihead_attn_bias_cuda is not None and not incremental and len_k <= 2048 and bsz_kv == bsz \
                 and input_lin_q_results.type() == 'torch.cuda.HalfTensor' and not rotary_pos_enc and low_precision:
 
             mask_ = mask
@@ -744,8 +767,8 @@ class EncdecAttnBiasCompactFunc(torch.autograd.Function):
         if incremental and ('c_k' in incremental_cache and 'c_v' in incremental_cache):
             keys = incremental_cache['c_k']
             values = incremental_cache['c_v']
-            keys = keys.view(len_k, bsz * heads, head_dim)
-            values = values.view(len_k, bsz * heads, head_dim)
+            keys = keys.view(len_k, bsz_kv * heads, head_dim)
+            values = values.view(len_k, bsz_kv * heads, head_dim)
             input_lin_kv_results = torch.stack([keys, values], dim=-2)
         else:
 
@@ -755,14 +778,26 @@ class EncdecAttnBiasCompactFunc(torch.autograd.Function):
             values = input_lin_kv_results[:, :, 1, :]
 
             if incremental:
-                keys = keys.contiguous().view(len_k, bsz, heads * head_dim)
-                values = values.contiguous().view(len_k, bsz, heads * head_dim)
+                keys = keys.contiguous().view(len_k, bsz_kv, heads * head_dim)
+                values = values.contiguous().view(len_k, bsz_kv, heads * head_dim)
 
                 incremental_cache['c_k'] = keys
                 incremental_cache['c_v'] = values
 
-                keys = keys.view(len_k, bsz * heads, head_dim)
-                values = values.view(len_k, bsz * heads, head_dim)
+                keys = keys.view(len_k, bsz_kv * heads, head_dim)
+                values = values.view(len_k, bsz_kv * heads, head_dim)
+
+        if bsz_kv != bsz:
+            assert not is_training and not rotary_pos_enc, \
+                "Sharing the context across beams is only supported for decoding"
+            # [len_q, bsz*beam, heads*head_dim] has the same layout as the [len_q, bsz*heads, head_dim] output below
+            matmul2_results, softmax_results = beam_shared_attention(queries, keys, values, mask,
+                                                                     heads, scale_t[0])
+
+            if return_coverage:
+                return matmul2_results, softmax_results
+            else:
+                return (matmul2_results,)
 
         # TODO: rotary pos encoding
         if rotary_pos_enc:
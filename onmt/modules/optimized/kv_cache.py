@@ -0,0 +1,137 @@
+"""
+Preallocated key/value cache for incremental (step-by-step) self-attention.
+"""
+
+import torch
+
+
+class IncrementalKVCache(object):
+    """
+    Key/value buffer for the decoder self-attention during beam search
+
+    The buffer is allocated once with shape [max_len x (bsz*beam) x hidden] (time first, like the
+    rest of the decoder states). Each step writes the new keys/values in place at the step cursor and
+    the attention gets a view of the filled part, so we don't copy the whole history with torch.cat
+    at every step. The beam reordering gathers the history into a second buffer of the same size,
+    which then replaces the first one (one copy of the history per step instead of two).
+    """
+
+    # capacity used when the maximum length is not known in advance (doubled when exceeded)
+    init_len = 64
+
+    def __init__(self, max_len=None):
+
+        self.max_len = max_len
+        self.k = None
+        self.v = None
+        # the other buffers of the ping-pong reordering
+        self.spare_k = None
+        self.spare_v = None
+        self.length = 0
+
+    @property
+    def keys(self):
+        """
+        :return: view of the filled part of the key buffer [len x B x H]
+        """
+        return self.k[:self.length] if self.k is not None else None
+
+    @property
+    def values(self):
+        """
+        :return: view of the filled part of the value buffer [len x B x H]
+        """
+        return self.v[:self.length] if self.v is not None else None
+
+    def is_empty(self):
+
+        return self.length == 0
+
+    def reserve(self, max_len):
+        """
+        Make sure that the buffer can hold max_len time steps without reallocation
+        :param max_len: number of time steps
+        """
+        self.max_len = max(max_len, self.max_len or 0)
+
+        if self.k is not None and self.k.size(0) < max_len:
+            self._resize(max_len)
+
+    def _resize(self, capacity):
+
+        _, bsz, hidden = self.k.size()
+        new_k = self.k.new_empty(capacity, bsz, hidden)
+        new_v = self.v.new_empty(capacity, bsz, hidden)
+        new_k[:self.length].copy_(self.keys)
+        new_v[:self.length].copy_(self.values)
+        self.k, self.v = new_k, new_v
+
+    def append(self, keys, values):
+        """
+        Write the keys and values of the current step into the buffer
+        :param keys: [len_q x B x H]
+        :param values: [len_q x B x H]
+        :return: keys and values of all steps so far [len_k x B x H] (views of the buffer)
+        """
+        len_q, bsz, hidden = keys.size()
+
+        if self.k is None:
+            capacity = max(self.max_len or self.init_len, len_q)
+            self.k = keys.new_empty(capacity, bsz, hidden)
+            self.v = values.new_empty(capacity, bsz, hidden)
+        elif self.length + len_q > self.k.size(0):
+            # the hypotheses are longer than expected: grow geometrically to keep the amortized cost constant
+            self._resize(max(2 * self.k.size(0), self.length + len_q))
+
+        self.k[self.length:self.length + len_q].copy_(keys)
+        self.v[self.length:self.length + len_q].copy_(values)
+        self.length += len_q
+
+        return self.keys, self.values
+
+    def index_select_(self, order):
+        """
+        Reorder the batch (beam) dimension in place, following the beam search choice.
+        If order is shorter than the current batch size, then the finished sentences are removed.
+        :param order: LongTensor of row indices [new_bsz]
+        :return: self
+        """
+        if self.k is None:
+            return self
+
+        capacity, _, hidden = self.k.size()
+        if self.spare_k is None or self.spare_k.size() != (capacity, order.numel(), hidden):
+            # first reordering, growth or shrinking batch: the spare buffers are reallocated once
+            self.spare_k = self.k.new_empty(capacity, order.numel(), hidden)
+            self.spare_v = self.v.new_empty(capacity, order.numel(), hidden)
+
+        torch.index_select(self.keys, 1, order, out=self.spare_k[:self.length])
+        torch.index_select(self.values, 1, order, out=self.spare_v[:self.length])
+
+        self.k, self.spare_k = self.spare_k, self.k
+        self.v, self.spare_v = self.spare_v, self.v
+
+        return self
+
+
+def kv_cache_append(incremental_cache, keys, values):
+    """
+    Update the incremental cache of the self-attention with the keys and values of the current step
+    Uses the preallocated buffer if the decoding state provides one (key 'kv'),
+    otherwise the keys and values are concatenated with the previous ones.
+    :param incremental_cache: dictionary of the layer buffers
+    :param keys: [len_q x B x H]
+    :param values: [len_q x B x H]
+    :return: keys and values of all steps so far [len_k x B x H]
+    """
+    if isinstance(incremental_cache.get('kv', None), IncrementalKVCache):
+        return incremental_cache['kv'].append(keys, values)
+
+    if 'k' in incremental_cache and 'v' in incremental_cache:
+        keys = torch.cat([incremental_cache['k'], keys], dim=0)  # time first
+        values = torch.cat([incremental_cache['v'], values], dim=0)  # time first
+
+    incremental_cache['k'] = keys
+    incremental_cache['v'] = values
+
+    return keys, values
@@ -7,6 +7,7 @@ import torch.nn.functional as F
 
 from .relative_self_attention_func import relative_self_attn_func
 from .relative_self_attention_func import RelativeShift
+from .kv_cache import kv_cache_append
 import onmt
 
 
@@ -173,14 +174,8 @@ class RelativeSelfMultiheadAttn(nn.Module):
                 keys = keys.reshape(len_q, bsz, heads * head_dim)
                 values = values.reshape(len_q, bsz, heads * head_dim)
 
-                if 'k' in incremental_cache and 'v' in incremental_cache:
-                    keys = torch.cat([incremental_cache['k'], keys], dim=0)  # time first
-                    incremental_cache['k'] = keys
-                    values = torch.cat([incremental_cache['v'], values], dim=0)  # time first
-                    incremental_cache['v'] = values
-                else:
-                    incremental_cache['k'] = keys
-                    incremental_cache['v'] = values
+                # the keys and values are written into the preallocated buffer if the decoding state has one
+                keys, values = kv_cache_append(incremental_cache, keys, values)
 
                 keys = keys.view(-1, bsz * heads, head_dim)
                 values = values.view(-1, bsz * heads, head_dim)
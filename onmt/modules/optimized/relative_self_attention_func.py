@@ -12,6 +12,8 @@ try:
 except (ModuleNotFoundError, ImportError) as e:
     from .compat import custom_fwd, custom_bwd
 
+from .kv_cache import kv_cache_append
+
 try:
     import relative_self_attn_blaslt
 except (ModuleNotFoundError, ImportError) as e:
@@ -191,14 +193,8 @@ class RelativeSelfAttnFunc(torch.autograd.Function):
             keys = keys.reshape(len_q, bsz, heads * head_dim)
             values = values.reshape(len_q, bsz, heads * head_dim)
 
-            if 'k' in incremental_cache and 'v' in incremental_cache:
-                keys = torch.cat([incremental_cache['k'], keys], dim=0)  # time first
-                incremental_cache['k'] = keys
-                values = torch.cat([incremental_cache['v'], values], dim=0)  # time first
-                incremental_cache['v'] = values
-            else:
-                incremental_cache['k'] = keys
-                incremental_cache['v'] = values
+            # the keys and values are written into the preallocated buffer if the decoding state has one
+            keys, values = kv_cache_append(incremental_cache, keys, values)
 
             keys = keys.view(-1, bsz * heads, head_dim)
             values = values.view(-1, bsz * heads, head_dim)
@@ -153,8 +153,10 @@ class OnlineTranslator(object):
         self.use_tgt_lang_as_source = opt.use_tgt_lang_as_source
 
 
-    def set_language(self, input_language, output_language, language_code_system="mbart50"):
-
+    def map_languages(self, input_language, output_language, language_code_system="mbart50"):
+        """
+        :return: the language codes of the model for the input and output languages
+        """
         # override the input_language
         if self.use_tgt_lang_as_source:
             input_language = output_language
@@ -164,11 +166,13 @@ class OnlineTranslator(object):
                                  "pt": "pt_XX", "it": "it_IT", "nl": "nl_XX", "None": "<s>",
                                  "ja": "ja_XX", "zh": "zh_CN", "vn": "vi_VN"}
 
-        else:
-            language_map_dict = defaultdict(lambda self, missing_key: missing_key)
+            return language_map_dict[input_language], language_map_dict[output_language]
 
-        input_lang = language_map_dict[input_language]
-        output_lang = language_map_dict[output_language]
+        return input_language, output_language
+
+    def set_language(self, input_language, output_language, language_code_system="mbart50"):
+
+        input_lang, output_lang = self.map_languages(input_language, output_language, language_code_system)
 
         self.translator.change_language(new_src_lang=input_lang, new_tgt_lang=output_lang, use_srclang_as_bos=False)
 
@@ -229,22 +233,36 @@ class OnlineTranslator(object):
 
         return output_sentence
 
-    def translate_batch(self, inputs, prefixes):
+    def translate_batch(self, inputs, prefixes, on_finished=None, languages=None):
         """
         Args:
             inputs: list of audio tensors
             prefixes: list of prefixes
+            on_finished: optional function called with (index, output sentence) as soon as
+                         one sentence of the batch is translated
+            languages: optional list of (input_language, output_language), one per sentence,
+                       by default the languages of set_language are used for the whole batch
 
         Returns:
 
         """
         inputs = [_input.strip().split() for _input in inputs]
 
+        if languages is not None:
+            tgt_langs = [output_language for _, output_language in languages]
+            lang_codes = [self.map_languages(input_language, output_language)
+                          for input_language, output_language in languages]
+            src_lang_codes = [input_lang for input_lang, _ in lang_codes]
+            tgt_lang_codes = [output_lang for _, output_lang in lang_codes]
+        else:
+            tgt_langs = [self.tgt_lang] * len(inputs)
+            src_lang_codes, tgt_lang_codes = None, None
+
         if self.detokenize:
             new_prefixes = []
-            for _prefix in prefixes:
+            for _prefix, tgt_lang in zip(prefixes, tgt_langs):
                 if _prefix is not None:
-                    with MosesTokenizer(self.tgt_lang) as tokenize:
+                    with MosesTokenizer(tgt_lang) as tokenize:
                         tokenized_sentence = tokenize(_prefix)
                         tokenized_sentence = " ".join(tokenized_sentence)
                         _prefix = tokenized_sentence
@@ -263,30 +281,41 @@ class OnlineTranslator(object):
 
         anti_prefix = self.anti_prefix if len(self.anti_prefix) > 0 else None
 
+        external_tokenizer = self.translator.external_tokenizer
+
+        if on_finished is not None:
+            def _on_finished(b, pred, pred_id):
+                on_finished(b, self.postprocess(get_sentence_from_tokens(pred[0], pred_id[0], "word",
+                                                                         external_tokenizer), tgt_langs[b]))
+        else:
+            _on_finished = None
+
         pred_batch, pred_ids, pred_score, pred_length, \
         gold_score, num_gold_words, all_gold_scores = self.translator.translate(
             src_batches, tgt_batch,
-            prefix=prefixes, anti_prefix=anti_prefix)
-
-        external_tokenizer = self.translator.external_tokenizer
+            prefix=prefixes, anti_prefix=anti_prefix, on_finished=_on_finished,
+            src_lang=src_lang_codes, tgt_lang=tgt_lang_codes)
 
         outputs = list()
 
         for pred, pred_id in zip(pred_batch, pred_ids):
             outputs.append(get_sentence_from_tokens(pred[0], pred_id[0], "word", external_tokenizer))
 
+        return [self.postprocess(output_sentence, tgt_lang) for output_sentence, tgt_lang in zip(outputs, tgt_langs)]
+
+    def postprocess(self, output_sentence, tgt_lang=None):
+        """
+        Moses-detokenize an output sentence if the model requires it
+        :param tgt_lang: language of the sentence (default: the output language of set_language)
+        """
         if self.detokenize and MosesDetokenizer is not None:
-            outputs_detok = []
-            for output_sentence in outputs:
-                # here if we want to use mosestokenizer, probably we need to split the sentence AFTER the sentencepiece/bpe
-                # model applies their de-tokenization
-                output_sentence_parts = output_sentence.split()
-                with MosesDetokenizer(self.tgt_lang) as detokenize:
-                    output_sentence = detokenize(output_sentence_parts)
-                outputs_detok.append(output_sentence)
-            return outputs_detok
-
-        return outputs
+            # here if we want to use mosestokenizer, probably we need to split the sentence AFTER the sentencepiece/bpe
+            # model applies their de-tokenization
+            output_sentence_parts = output_sentence.split()
+            with MosesDetokenizer(tgt_lang if tgt_lang is not None else self.tgt_lang) as detokenize:
+                output_sentence = detokenize(output_sentence_parts)
+
+        return output_sentence
 
 # Checklist to integrate:
 
@@ -375,11 +404,7 @@ class ASROnlineTranslator(object):
         # use the external sentencepiece model
         external_tokenizer = self.translator.external_tokenizer
 
-        if memory is not None and len(memory) > 0:
-            memory_text_ids = [torch.as_tensor(external_tokenizer.encode(m)) for m in memory]
-            memory = torch.ones(len(memory_text_ids), max(len(x) for x in memory_text_ids), dtype=torch.int64)
-            for i, m in enumerate(memory_text_ids):
-                memory[i, :len(m)] = m
+        memory = self.build_memory(memory)
 
         # perform beam search in the model
         pred_batch, pred_ids, pred_score, pred_length, \
@@ -400,11 +425,31 @@ class ASROnlineTranslator(object):
 
         return output_sentence
 
-    def translate_batch(self, inputs, prefixes):
+    def build_memory(self, memory):
+        """
+        Args:
+            memory: list of memory strings (can be None)
+
+        Returns: padded tensor of memory token ids (or None)
+
+        """
+        if memory is not None and len(memory) > 0:
+            external_tokenizer = self.translator.external_tokenizer
+            memory_text_ids = [torch.as_tensor(external_tokenizer.encode(m)) for m in memory]
+            memory = torch.ones(len(memory_text_ids), max(len(x) for x in memory_text_ids), dtype=torch.int64)
+            for i, m in enumerate(memory_text_ids):
+                memory[i, :len(m)] = m
+
+        return memory
+
+    def translate_batch(self, inputs, prefixes, memory=None, on_finished=None):
         """
         Args:
             inputs: list of audio tensors
             prefixes: list of prefixes
+            memory: list of memory strings shared by the batch (can be None)
+            on_finished: optional function called with (index, output sentence) as soon as
+                         one sentence of the batch is recognized
 
         Returns:
 
@@ -435,29 +480,40 @@ class ASROnlineTranslator(object):
 
         anti_prefix = self.anti_prefix if len(self.anti_prefix) > 0 else None
 
+        external_tokenizer = self.translator.external_tokenizer
+
+        memory = self.build_memory(memory)
+
+        if on_finished is not None:
+            def _on_finished(b, pred, pred_id):
+                on_finished(b, self.postprocess(get_sentence_from_tokens(pred[0], pred_id[0], "word",
+                                                                         external_tokenizer)))
+        else:
+            _on_finished = None
+
         pred_batch, pred_ids, pred_score, pred_length, \
         gold_score, num_gold_words, all_gold_scores = self.translator.translate(
             src_batches, tgt_batch, type='asr',
-            prefix=prefixes, anti_prefix=anti_prefix)
-
-        external_tokenizer = self.translator.external_tokenizer
+            prefix=prefixes, anti_prefix=anti_prefix, memory=memory, on_finished=_on_finished)
 
         outputs = list()
 
         for pred, pred_id in zip(pred_batch, pred_ids):
             outputs.append(get_sentence_from_tokens(pred[0], pred_id[0], "word", external_tokenizer))
 
-        if self.detokenize and MosesDetokenizer is not None:
-            outputs_detok = []
-            for output_sentence in outputs:
-                # here if we want to use mosestokenizer, probably we need to split the sentence AFTER the sentencepiece/bpe
-                # model applies their de-tokenization
-                output_sentence_parts = output_sentence.split()
-                with MosesDetokenizer(self.tgt_lang) as detokenize:
-                    output_sentence = detokenize(output_sentence_parts)
-                outputs_detok.append(output_sentence)
-            return outputs_detok
-
         print(pred, outputs)
 
-        return outputs
+        return [self.postprocess(output_sentence) for output_sentence in outputs]
+
+    def postprocess(self, output_sentence):
+        """
+        Moses-detokenize an output sentence if the model requires it
+        """
+        if self.detokenize and MosesDetokenizer is not None:
+            # here if we want to use mosestokenizer, probably we need to split the sentence AFTER the sentencepiece/bpe
+            # model applies their de-tokenization
+            output_sentence_parts = output_sentence.split()
+            with MosesDetokenizer(self.tgt_lang) as detokenize:
+                output_sentence = detokenize(output_sentence_parts)
+
+        return output_sentence
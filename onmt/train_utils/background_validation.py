@@ -0,0 +1,135 @@
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from torch.cuda.amp import autocast
+
+import onmt
+from onmt.data.dataset import rewrap
+from onmt.data.collated_batches import CollatedBatches
+from onmt.train_utils.checkpoint_writer import snapshot_state
+
+
+def validation_device(name):
+    """
+    :param name: 'cpu' or the id of a GPU
+    :return: torch.device
+    """
+    return torch.device('cpu') if name == 'cpu' else torch.device('cuda', int(name))
+
+
+class BackgroundValidator(object):
+    """
+    Cross-entropy evaluation of a copy of the model in a background thread, while the training continues.
+    The side model lives on another device (the CPU or a spare GPU): the current weights are copied into it
+    when a validation starts, and the worker thread evaluates it on the validation batches, which are read
+    and collated once. The training thread collects the result together with the checkpoint state of the
+    validated weights, so that the checkpoint is saved with the perplexity of these weights.
+    No collective is called: the side model evaluates the whole validation set on one rank.
+    """
+
+    def __init__(self, model, loss_function, device, opt):
+        """
+        :param model: the model, still on the CPU (the copy never takes memory on the training GPU)
+        :param loss_function: the loss function, still on the CPU
+        :param device: torch.device of the side model
+        :param opt: the training options
+        """
+        self.device = device
+        self.opt = opt
+        self.model = copy.deepcopy(model).to(device)
+        self.loss_function = copy.deepcopy(loss_function).to(device)
+        self.model.eval()
+        self.loss_function.eval()
+        self.fp16 = opt.fp16 and device.type == 'cuda'
+        self.chunked_loss = hasattr(opt, 'loss_chunk_size') and opt.loss_chunk_size > 0 and not opt.nce
+
+        self.batches = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future = None
+        self._checkpoint = None
+        self._optim_buffers = dict()
+
+    @property
+    def pending(self):
+        return self._future is not None
+
+    def submit(self, model, checkpoint, data_iterator):
+        """
+        Start the validation of the current weights of model
+        :param model: the training model (without the DDP wrapper)
+        :param checkpoint: checkpoint state whose model state dict is the one of self.model
+        (the optimizer state is copied to the CPU here, the training can change it afterwards)
+        :param data_iterator: iterator over the validation data (only read for the first validation)
+        """
+        assert self._future is None, "The result of the previous validation must be collected first"
+
+        with torch.no_grad():
+            self.model.load_state_dict(model.state_dict())
+
+        self._checkpoint = dict(checkpoint)
+        if self._checkpoint.get('optim') is not None:
+            self._checkpoint['optim'] = snapshot_state(self._checkpoint['optim'], self._optim_buffers)
+
+        self._future = self._executor.submit(self._evaluate, data_iterator)
+
+    def result(self, wait=False):
+        """
+        :param wait: wait for the running validation
+        :return: (loss per word, accuracy, checkpoint) of the finished validation, or None
+        """
+        if self._future is None or (not wait and not self._future.done()):
+            return None
+
+        future, checkpoint = self._future, self._checkpoint
+        self._future, self._checkpoint = None, None
+        valid_loss, valid_accuracy = future.result()
+
+        return valid_loss, valid_accuracy, checkpoint
+
+    def close(self):
+        if self._future is not None:
+            self._future.result()
+        self._future, self._checkpoint = None, None
+        self._executor.shutdown()
+
+    def _evaluate(self, data_iterator):
+        if self.batches is None:
+            self.batches = CollatedBatches.from_iterator(data_iterator)
+            if self.device.type == 'cuda':
+                self.batches.pin_memory()
+
+        if self.device.type == 'cuda':
+            with torch.cuda.device(self.device):
+                return self._evaluate_batches()
+
+        return self._evaluate_batches()
+
+    def _evaluate_batches(self):
+        opt = self.opt
+        total_loss = torch.zeros(1, device=self.device)
+        total_correct = torch.zeros(1, device=self.device)
+        total_words = 0
+
+        with torch.no_grad():
+            for light_batch in self.batches:
+                with autocast(enabled=self.fp16):
+                    batch = rewrap(light_batch)
+                    if self.device.type == 'cuda':
+                        batch.cuda(fp16=False, device=self.device, non_blocking=True)
+                    targets = batch.get('target_output')
+                    tgt_mask = targets.ne(onmt.constants.PAD)
+
+                    outputs = self.model(batch, streaming=False, target_mask=tgt_mask,
+                                         mirror=opt.mirror_loss, nce=opt.nce, chunked_loss=self.chunked_loss)
+
+                    outputs['tgt_mask'] = tgt_mask
+                    loss_dict = self.loss_function(outputs, targets, model=self.model, eval=True)
+
+                total_loss.add_(loss_dict['data'])
+                total_correct.add_(loss_dict['correct'])
+                total_words += batch.tgt_size
+
+        total_words = max(int(total_words), 1)
+
+        return total_loss.item() / total_words, total_correct.item() / total_words
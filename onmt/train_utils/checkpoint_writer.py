@@ -0,0 +1,159 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from onmt.utils import checkpoint_paths
+
+
+def _snapshot(obj, buffers, key='', memo=None):
+    """
+    Copy the tensors of a (nested) state dict to CPU memory, reusing the buffers of an earlier snapshot
+    :param obj: state dict (dictionaries, lists and tuples of tensors and other objects)
+    :param buffers: dictionary key -> CPU tensor, updated with the new buffers
+    :param key: position of obj in the state dict
+    :param memo: the tensors already copied (tied weights are copied once, as torch.save shares them)
+    :return: copy of obj with the tensors on the CPU (the other objects are shared)
+    """
+    memo = dict() if memo is None else memo
+
+    if isinstance(obj, torch.Tensor):
+        tensor_id = (obj.device, obj.dtype, obj.data_ptr(), obj.size(), obj.stride())
+        if obj.numel() > 0 and tensor_id in memo:
+            return memo[tensor_id]
+
+        buffer = buffers.get(key)
+        if buffer is None or buffer.size() != obj.size() or buffer.dtype != obj.dtype:
+            buffer = torch.empty(obj.size(), dtype=obj.dtype, pin_memory=obj.is_cuda)
+            buffers[key] = buffer
+
+        # the copies from the GPU are ordered before the next updates of the parameters on the stream
+        # (the tensors of the other GPUs are not covered by the event of the current stream)
+        non_blocking = obj.is_cuda and obj.get_device() == torch.cuda.current_device()
+        buffer.copy_(obj.detach(), non_blocking=non_blocking)
+        memo[tensor_id] = buffer
+        return buffer
+    elif isinstance(obj, dict):
+        return type(obj)((k, _snapshot(v, buffers, "%s/%s" % (key, k), memo)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return type(obj)(_snapshot(v, buffers, "%s/%d" % (key, i), memo) for i, v in enumerate(obj))
+
+    return obj
+
+
+def snapshot_state(state, buffers=None):
+    """
+    :param state: state dict (the tensors can be on the GPU)
+    :param buffers: the CPU buffers of an earlier snapshot of the same state, updated with the new buffers
+    :return: copy of the state with the tensors on the CPU, complete when the function returns
+    """
+    snapshot = _snapshot(state, dict() if buffers is None else buffers)
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.current_stream().synchronize()
+
+    return snapshot
+
+
+def remove_old_checkpoints(checkpoint_dir, keep_files):
+    """
+    Delete the checkpoints of checkpoint_dir except the keep_files best ones
+    """
+    existed_save_files = checkpoint_paths(checkpoint_dir)
+    for save_file in existed_save_files[keep_files:]:
+        print(" * Deleting old save file %s ...." % save_file)
+        os.remove(save_file)
+
+
+def write_checkpoint(checkpoint, file_name, keep_files=-1, ready=None):
+    """
+    Write the checkpoint to a temporary file renamed to file_name when it is complete,
+    so that an interrupted save never leaves a truncated checkpoint
+
+    :param checkpoint: the state to save
+    :param file_name: path of the checkpoint
+    :param keep_files: number of checkpoints kept in the directory of file_name (all of them if negative)
+    :param ready: CUDA event recorded after the copies of the snapshot
+    """
+    if ready is not None:
+        ready.synchronize()
+
+    tmp_name = "%s.tmp%d" % (file_name, os.getpid())
+    try:
+        torch.save(checkpoint, tmp_name)
+        os.replace(tmp_name, file_name)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+    if keep_files >= 0:
+        remove_old_checkpoints(os.path.dirname(file_name) or '.', keep_files)
+
+
+class CheckpointWriter(object):
+    """
+    Writes the checkpoints in a background thread, so that the training only waits for the copy of the
+    state to (pinned) CPU memory. The old checkpoints are removed by the same thread after each save.
+    """
+
+    def __init__(self, max_pending=1):
+        """
+        :param max_pending: maximum number of saves in flight (a new save waits for the oldest one).
+        Each pending save keeps one copy of the state in pinned CPU memory. 0: the saves are synchronous
+        """
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=1) if max_pending > 0 else None
+        self._slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self._free_buffers = [dict() for _ in range(max(max_pending, 1))]
+        self._futures = []
+
+    def save(self, checkpoint, file_name, keep_files=-1):
+        """
+        :param checkpoint: the state to save (the tensors can be on the GPU)
+        :param file_name: path of the checkpoint
+        :param keep_files: number of checkpoints kept in the directory of file_name (all of them if negative)
+        """
+        if self._executor is None:
+            write_checkpoint(checkpoint, file_name, keep_files)
+            return
+
+        # raise the errors of the previous saves
+        self._collect(wait=False)
+
+        self._slots.acquire()
+        buffers = self._free_buffers.pop()
+        try:
+            snapshot = _snapshot(checkpoint, buffers)
+            ready = None
+            if torch.cuda.is_available() and torch.cuda.is_initialized():
+                ready = torch.cuda.Event()
+                ready.record()
+        except BaseException:
+            self._release(buffers)
+            raise
+
+        future = self._executor.submit(write_checkpoint, snapshot, file_name, keep_files, ready)
+        future.add_done_callback(lambda _: self._release(buffers))
+        self._futures.append(future)
+
+    def _release(self, buffers):
+        self._free_buffers.append(buffers)
+        self._slots.release()
+
+    def _collect(self, wait):
+        finished = [future for future in self._futures if wait or future.done()]
+        self._futures = [future for future in self._futures if future not in finished]
+
+        for future in finished:
+            future.result()
+
+    def wait(self):
+        """
+        Wait until all the checkpoints are written
+        """
+        self._collect(wait=True)
+
+    def close(self):
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown()
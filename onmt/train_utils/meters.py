@@ -7,6 +7,8 @@
 
 import time
 
+import torch
+
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
@@ -31,6 +33,49 @@ class AverageMeter(object):
             self.avg = self.sum / self.count
 
 
+class DeviceMeters(object):
+    """
+    Running sums of several metrics, kept in one preallocated tensor on the device.
+    Adding a device tensor does not wait for the GPU, the sums are only read back by read()
+    (one transfer, and one all_reduce of the whole buffer in distributed training).
+    """
+    def __init__(self, names, device=None, sync=False):
+        """
+        :param names: names of the metrics
+        :param device: device of the buffer
+        :param sync: read every value back to the host when it is added (slow, for debugging)
+        """
+        self.index = {name: i for i, name in enumerate(names)}
+        self.buffer = torch.zeros(len(self.index), device=device)
+        self.sync = sync
+
+    def add(self, name, value):
+        if value is None:
+            return
+
+        if isinstance(value, torch.Tensor):
+            # one-element tensor (0-dim tensors can be added to the buffer from any device)
+            value = value.item() if self.sync else value.detach().reshape(())
+
+        i = self.index[name]
+        self.buffer[i:i + 1].add_(value)
+
+    def read(self, all_reduce=None):
+        """
+        :param all_reduce: function summing the buffer over the processes (in-place)
+        :return: dictionary name -> value (python float)
+        """
+        if all_reduce is not None:
+            all_reduce(self.buffer)
+
+        values = self.buffer.tolist()
+
+        return {name: values[i] for name, i in self.index.items()}
+
+    def reset(self):
+        self.buffer.zero_()
+
+
 class TimeMeter(object):
     """Computes the average occurrence of some event per second"""
     def __init__(self, init=0):
@@ -21,6 +21,10 @@ from onmt.model_factory import build_model, build_language_model, optimize_model
 from onmt.model_factory import init_model_parameters
 from onmt.modules.loss import NMTLossFunc, NMTAndCTCLossFunc
 from onmt.train_utils.stats import Logger
+from onmt.train_utils.meters import DeviceMeters
+from onmt.train_utils.checkpoint_writer import CheckpointWriter
+from onmt.train_utils.background_validation import BackgroundValidator, validation_device
+from onmt.data.collated_batches import CollatedBatches
 from onmt.utils import checkpoint_paths, normalize_gradients, clip_grad_norm
 from onmt.model_factory import build_model, optimize_model, init_model_parameters
 import torch.distributed as dist
@@ -36,17 +40,18 @@ from tqdm import tqdm
 warnings.filterwarnings("ignore", category=UserWarning)
 
 
-def prepare_sample(batch, device=None):
+def prepare_sample(batch, device=None, non_blocking=False):
     """
     Put minibatch on the corresponding GPU
     :param batch:
     :param device:
+    :param non_blocking: asynchronous copies (the batch is in pinned memory)
     :return:
     """
     if isinstance(batch, list):
         batch = batch[0]
     batch = rewrap(batch)
-    batch.cuda(fp16=False, device=device)
+    batch.cuda(fp16=False, device=device, non_blocking=non_blocking)
 
     return batch
 
@@ -62,14 +67,16 @@ def is_list(object):
 
 def generate_data_iterator(dataset, rank, world_size, seed,
                            num_workers=1, epoch=1., buffer_size=0, split_even=True,
-                           dataset_ids=None):
+                           dataset_ids=None, sampling_temperature=1.0, sampling_weights=None):
     # check if dataset is a list:
     if is_list(dataset):
         # this is a multidataset
         data_iterator = MultiDataIterator(dataset, seed=seed, num_workers=num_workers,
                                           epoch=epoch, buffer_size=buffer_size,
                                           num_shards=world_size, shard_id=rank, split_even=split_even,
-                                          dataset_ids=dataset_ids)
+                                          dataset_ids=dataset_ids,
+                                          sampling_temperature=sampling_temperature,
+                                          sampling_weights=sampling_weights)
     else:
         data_iterator = DataIterator(dataset, dataset.get_collater(), dataset.get_batches(), seed=seed,
                                      num_workers=num_workers, epoch=epoch, buffer_size=buffer_size,
@@ -181,6 +188,9 @@ class Trainer(object):
         assert self.cuda, "[ERROR] Training is only available on GPUs."
 
         self.start_time = 0
+        self.checkpoint_writer = CheckpointWriter(opt.max_pending_saves if hasattr(opt, 'max_pending_saves') else 1)
+        # the collated validation batches of this process (opt.valid_batch_cache)
+        self.cached_valid_batches = None
 
         torch.manual_seed(self.opt.seed)
 
@@ -204,6 +214,9 @@ class Trainer(object):
             from onmt.models.speech_recognizer.lid_loss import CrossEntropyLIDLoss
             self.lid_loss_function = CrossEntropyLIDLoss(opt.n_languages, label_smoothing=0.0)
 
+        # project the hidden states to the vocabulary by chunks in the loss function (the logits are not stored)
+        self.loss_chunk_size = opt.loss_chunk_size if hasattr(opt, 'loss_chunk_size') and not opt.nce else 0
+
         if opt.nce:
             from onmt.modules.nce.nce_loss import NCELoss
             loss_function = NCELoss(opt.model_size, dicts['tgt'].size(), noise_ratio=opt.nce_noise,
@@ -212,7 +225,8 @@ class Trainer(object):
             loss_function = NMTLossFunc(opt.model_size, dicts['tgt'].size(),
                                         label_smoothing=opt.label_smoothing,
                                         mirror=opt.mirror_loss,
-                                        padding_idx=tgt_pad)
+                                        padding_idx=tgt_pad,
+                                        chunk_size=self.loss_chunk_size if self.loss_chunk_size > 0 else 1024)
 
         # This function replaces modules with the more optimized counterparts so that it can run faster
         # Currently exp with LayerNorm
@@ -246,6 +260,19 @@ class Trainer(object):
             # if 'scaler' in checkpoint and checkpoint['scaler'] is not None:
             #     self.grad_scaler.load_state_dict(checkpoint['scaler'])
 
+        # validation of a copy of the weights in the background (the copy is made before the model is on the GPU)
+        self.background_validation = opt.background_validation if hasattr(opt, 'background_validation') else False
+        if self.background_validation and (opt.streaming or opt.load_pretrained_classifier or opt.use_memory):
+            self.print("[WARNING] Background validation is not available with streaming, memory or a pretrained "
+                       "classifier, the validation stops the training")
+            self.background_validation = False
+
+        self.background_validator = None
+        if self.background_validation and self.is_main():
+            device = validation_device(opt.background_validation_device)
+            print("[INFO] Validation in the background on %s" % device, flush=True)
+            self.background_validator = BackgroundValidator(model, loss_function, device, opt)
+
         if self.cuda:
             self.loss_function = self.loss_function.cuda(device=self.device)
             self.model = self.model.cuda(device=self.device)
@@ -417,13 +444,19 @@ class Trainer(object):
 
         self.model.decoder.language_embeddings = untrained_lang_emb
 
-    def save(self, epoch, valid_ppl, itr=None):
-
+    def checkpoint_state(self, epoch, itr=None, model=None):
+        """
+        :param epoch: the (fractional) epoch of the checkpoint
+        :param itr: the training data iterator (its position is saved)
+        :param model: the model whose weights are saved (default: the training model)
+        :return: the checkpoint dictionary
+        """
         opt = self.opt
-        if isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
-            model = self.model.module
-        else:
-            model = self.model
+        if model is None:
+            if isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
+                model = self.model.module
+            else:
+                model = self.model
         dicts = self.dicts
 
         model_state_dict = model.state_dict()
@@ -437,8 +470,7 @@ class Trainer(object):
         else:
             itr_state_dict = None
 
-        #  drop a checkpoint
-        checkpoint = {
+        return {
             'model': model_state_dict,
             'dicts': dicts,
             'opt': opt,
@@ -448,16 +480,90 @@ class Trainer(object):
             'scaler': self.grad_scaler.state_dict()
         }
 
+    def save(self, epoch, valid_ppl, itr=None, checkpoint=None):
+
+        opt = self.opt
+
+        #  drop a checkpoint
+        if checkpoint is None:
+            checkpoint = self.checkpoint_state(epoch, itr=itr)
+
         file_name = '%s_ppl_%.6f_e%.2f.pt' % (opt.save_model, valid_ppl, epoch)
         print('Writing to %s' % file_name)
-        torch.save(checkpoint, file_name)
 
-        # check the save directory here
-        checkpoint_dir = os.path.dirname(opt.save_model)
-        existed_save_files = checkpoint_paths(checkpoint_dir)
-        for save_file in existed_save_files[opt.keep_save_files:]:
-            print(" * Deleting old save file %s ...." % save_file)
-            os.remove(save_file)
+        # the state is copied to the CPU here, the file is written (and the old save files in the
+        # save directory are deleted) in the background
+        self.checkpoint_writer.save(checkpoint, file_name, keep_files=opt.keep_save_files)
+
+    def save_value(self, valid_ppl, valid_accuracy):
+        """
+        :return: the value of the validation saved in the checkpoint name (opt.save_metrics, lower is better)
+        """
+        opt = self.opt
+        if opt.save_metrics in ['ppl', 'perplexity']:
+            return valid_ppl
+        elif opt.save_metrics == "memory":
+            if isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
+                return self.model.module.choose_best_epoch_by
+            else:
+                return self.model.choose_best_epoch_by
+        else:
+            return 1 - valid_accuracy
+
+    def start_background_validation(self, data, epoch, itr=None):
+        """
+        Copy the current weights to the side model and validate them in the background (main process only).
+        The result of the previous background validation is collected first.
+        :param data: the validation data
+        :param epoch: the (fractional) epoch of the checkpoint
+        :param itr: the training data iterator
+        """
+        self.collect_background_validation(wait=True)
+
+        if isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
+            model = self.model.module
+        else:
+            model = self.model
+
+        validator = self.background_validator
+        # the validation batches are read from this iterator only once
+        data_iterator = None
+        if validator.batches is None:
+            data_iterator = generate_data_iterator(data, 0, 1, seed=self.opt.seed, num_workers=0, epoch=1,
+                                                   buffer_size=self.opt.buffer_size, split_even=False,
+                                                   dataset_ids=self.opt.valid_sets)
+
+        checkpoint = self.checkpoint_state(epoch, itr=itr, model=validator.model)
+        validator.submit(model, checkpoint, data_iterator)
+        print("[INFO] Validation of the weights of epoch %.2f started in the background" % epoch, flush=True)
+
+    def collect_background_validation(self, wait=False):
+        """
+        Report the finished background validation and save its checkpoint
+        :param wait: wait for the running validation
+        """
+        if self.background_validator is None:
+            return
+
+        result = self.background_validator.result(wait=wait)
+        if result is None:
+            return
+
+        valid_loss, valid_accuracy, checkpoint = result
+        valid_ppl = math.exp(min(valid_loss, 100))
+        print('[INFO] Background validation (epoch %.2f) perplexity: %g' % (checkpoint['epoch'], valid_ppl))
+        print('[INFO] Background validation accuracy: %g percent' % (100 * valid_accuracy))
+
+        self.save(checkpoint['epoch'], self.save_value(valid_ppl, valid_accuracy), checkpoint=checkpoint)
+
+    def close(self):
+        """
+        Finish the background validation and wait for the checkpoints being written
+        """
+        self.collect_background_validation(wait=True)
+        if self.background_validator is not None:
+            self.background_validator.close()
+        self.checkpoint_writer.close()
 
     def eval(self, data):
 
@@ -466,13 +572,19 @@ class Trainer(object):
 
         rank = self.rank
         world_size = self.world_size
-        # the data iterator creates an epoch iterator
-        data_iterator = generate_data_iterator(data, rank, world_size, seed=self.opt.seed,
-                                               num_workers=1, epoch=1, buffer_size=opt.buffer_size, split_even=False,
-                                               dataset_ids=opt.valid_sets)
-        epoch_iterator = data_iterator.next_epoch_itr(False, pin_memory=False)
-
-        data_size = len(data_iterator)
+        epoch_iterator = self.cached_valid_batches
+        if epoch_iterator is None:
+            # the data iterator creates an epoch iterator
+            data_iterator = generate_data_iterator(data, rank, world_size, seed=self.opt.seed,
+                                                   num_workers=1, epoch=1, buffer_size=opt.buffer_size,
+                                                   split_even=False, dataset_ids=opt.valid_sets)
+            epoch_iterator = self.cache_valid_batches(data_iterator)
+            if epoch_iterator is None:
+                epoch_iterator = data_iterator.next_epoch_itr(False, pin_memory=False)
+        # the cached batches are in pinned memory (or memory-mapped)
+        non_blocking = self.cached_valid_batches is not None
+
+        data_size = len(epoch_iterator)
         i = 0
 
         self.model.eval()
@@ -491,8 +603,7 @@ class Trainer(object):
 
         with torch.no_grad():
             # while not data_iterator.end_of_epoch():
-            while i < len(epoch_iterator):
-                samples = next(epoch_iterator)
+            for samples in epoch_iterator:
 
                 def maybe_no_sync():
                     if isinstance(self.model, DDP_model):
@@ -503,7 +614,7 @@ class Trainer(object):
                 if samples:
                     with maybe_no_sync():
                         with autocast(enabled=opt.fp16):
-                            batch = prepare_sample(samples, device=self.device)
+                            batch = prepare_sample(samples, device=self.device, non_blocking=non_blocking)
                             targets = batch.get('target_output')
                             tgt_mask = targets.ne(onmt.constants.PAD)
 
@@ -514,7 +625,8 @@ class Trainer(object):
 
                             outputs = self.model(batch, streaming=opt.streaming, target_mask=tgt_mask,
                                                  mirror=opt.mirror_loss, streaming_state=streaming_state, nce=opt.nce,
-                                                 pretrained_layer_states=layer_states)
+                                                 pretrained_layer_states=layer_states,
+                                                 chunked_loss=self.loss_chunk_size > 0)
 
                             outputs['tgt_mask'] = tgt_mask
                             loss_dict = self.loss_function(outputs, targets, model=self.model, eval=True)
@@ -563,6 +675,41 @@ class Trainer(object):
 
         return total_loss.item() / total_words.item(), total_correct.item() / total_words.item()
 
+    def cache_valid_batches(self, data_iterator):
+        """
+        Read and collate the validation batches of this process once (opt.valid_batch_cache):
+        'memory' keeps them in pinned memory, otherwise they are written to <valid_batch_cache>.rank<rank>.pt,
+        which is memory-mapped (and reused by the next runs on the same data)
+        :param data_iterator: iterator over the validation shard of this process
+        :return: CollatedBatches, or None without cache
+        """
+        opt = self.opt
+        cache = opt.valid_batch_cache if hasattr(opt, 'valid_batch_cache') else ''
+        if not cache:
+            return None
+
+        if cache == 'memory':
+            batches = CollatedBatches.from_iterator(data_iterator).pin_memory()
+        else:
+            file_name = '%s.rank%d.pt' % (cache, self.rank)
+            # the cache is only reused for the same data (paths and sizes), batching and sharding
+            signature = {'num_shards': self.world_size, 'shard_id': self.rank,
+                         'num_batches': len(data_iterator), 'valid_sets': list(opt.valid_sets),
+                         'data': os.path.abspath(opt.data), 'data_format': opt.data_format,
+                         'sizes': CollatedBatches.data_digest(data_iterator),
+                         'batch_size_words': opt.batch_size_words, 'batch_size_sents': opt.batch_size_sents,
+                         'batch_size_frames': opt.batch_size_frames,
+                         'batch_size_multiplier': opt.batch_size_multiplier,
+                         'max_src_length': opt.max_src_length, 'max_tgt_length': opt.max_tgt_length}
+            batches = CollatedBatches.load(file_name, signature)
+            if batches is None:
+                self.print("[INFO] Writing the collated validation batches to %s" % file_name, flush=True)
+                CollatedBatches.from_iterator(data_iterator).save(file_name, signature)
+                batches = CollatedBatches.load(file_name, signature)
+
+        self.cached_valid_batches = batches
+        return batches
+
     def train_epoch(self, train_data, valid_data, epoch, resume=False, itr_progress=None):
 
         opt = self.opt
@@ -578,7 +725,11 @@ class Trainer(object):
         data_iterator = generate_data_iterator(dataset, self.rank, self.world_size,
                                                seed=self.opt.seed, num_workers=opt.num_workers,
                                                epoch=epoch, buffer_size=opt.buffer_size, split_even=True,
-                                               dataset_ids=opt.train_sets)
+                                               dataset_ids=opt.train_sets,
+                                               sampling_temperature=opt.data_sampling_temperature
+                                               if hasattr(opt, 'data_sampling_temperature') else 1.0,
+                                               sampling_weights=opt.data_sampling_weights
+                                               if hasattr(opt, 'data_sampling_weights') else None)
 
         # TODO: fix resume which is currently buggy
         if resume:
@@ -588,18 +739,14 @@ class Trainer(object):
 
         total_tokens, total_loss, total_words = zero_tensor(), zero_tensor(), zero_tensor()
         total_non_pads = zero_tensor()
-        report_loss, report_tgt_words = zero_tensor(), zero_tensor()
-        report_ctc_loss = zero_tensor()
-        report_ewc_loss = zero_tensor()
-        report_ewc_count = 0
-        report_src_words = zero_tensor()
-        report_sents = zero_tensor()
-        report_rec_loss, report_rev_loss, report_mirror_loss = zero_tensor(), zero_tensor(), zero_tensor()
 
-        report_enc_lid_loss = zero_tensor()
-        report_enc_lid_count = 0
-        report_dec_lid_loss = zero_tensor()
-        report_dec_lid_count = 0
+        # the report metrics stay on the device and are read back once per log interval
+        # (with -sync_metrics every value is read back when it is added, as a debugging aid)
+        sync_metrics = opt.sync_metrics if hasattr(opt, 'sync_metrics') else False
+        report = DeviceMeters(['loss', 'tgt_words', 'src_words', 'sents', 'rec_loss', 'rev_loss', 'mirror_loss',
+                               'ctc_loss', 'ewc_loss', 'ewc_count', 'enc_lid_loss', 'enc_lid_count',
+                               'dec_lid_loss', 'dec_lid_count', 'contrastive_loss'],
+                              device=total_loss.device, sync=sync_metrics)
 
         start = time.time()
         n_samples = len(data_iterator)
@@ -607,7 +754,8 @@ class Trainer(object):
         counter = 0
         num_accumulated_words = zero_tensor()
         num_accumulated_sents = zero_tensor()
-        report_contrastive_loss = zero_tensor()
+        # hits and misses of the audio file caches of the data loader processes of this rank
+        file_cache = [0, 0]
 
         if opt.streaming:
             streaming_state = self.model.init_stream()
@@ -643,6 +791,10 @@ class Trainer(object):
             batch = prepare_sample(samples, device=self.device)
             targets = batch.get('target_output')
 
+            if batch.get('file_cache') is not None:
+                file_cache[0] += batch.get('file_cache')[0]
+                file_cache[1] += batch.get('file_cache')[1]
+
             if opt.streaming:
                 if train_data.is_new_stream():
                     streaming_state = self.model.init_stream()
@@ -680,7 +832,10 @@ class Trainer(object):
                                              adv_ptb_grad=opt.virtual_adversarial_training_mode > 0,
                                              checkpointing_ffn=opt.checkpointing_ffn,
                                              checkpointing_cross_attn=opt.checkpointing_cross_attn,
-                                             checkpointing_self_attn=opt.checkpointing_self_attn
+                                             checkpointing_self_attn=opt.checkpointing_self_attn,
+                                             # adversarial training needs the logits
+                                             chunked_loss=self.loss_chunk_size > 0 and
+                                             opt.virtual_adversarial_training_mode == 0
                                              )
 
                         batch_size = batch.size
@@ -695,7 +850,7 @@ class Trainer(object):
 
                         if opt.ctc_loss > 0.0:
                             ctc_loss = self.ctc_loss_function(outputs, targets)
-                            ctc_loss_data = ctc_loss.item()
+                            ctc_loss_data = ctc_loss.detach()
                             full_loss = full_loss + opt.ctc_loss * ctc_loss
 
                         if opt.mirror_loss:
@@ -703,7 +858,7 @@ class Trainer(object):
                             rev_loss_data = loss_dict['rev_loss_data']
                             mirror_loss = loss_dict['mirror_loss']
                             full_loss = full_loss + rev_loss + mirror_loss
-                            mirror_loss_data = loss_dict['mirror_loss'].item()
+                            mirror_loss_data = loss_dict['mirror_loss'].detach()
                         else:
                             rev_loss_data = None
                             mirror_loss_data = 0
@@ -721,13 +876,11 @@ class Trainer(object):
 
                             full_loss = full_loss + 0.01 * (enc_lid_loss + dec_lid_loss)
 
-                            report_enc_lid_loss.add_(enc_lid_loss.item())
-                            report_enc_lid_count += enc_mask.ne(1).int().sum().item()
+                            report.add('enc_lid_loss', enc_lid_loss)
+                            report.add('enc_lid_count', enc_mask.ne(1).int().sum())
 
-                            # print(dec_mask)
-                            # print(dec_mask.ne(1).int().sum().item())
-                            report_dec_lid_loss.add_(dec_lid_loss.item())
-                            report_dec_lid_count += dec_mask.ne(1).int().sum().item()
+                            report.add('dec_lid_loss', dec_lid_loss)
+                            report.add('dec_lid_count', dec_mask.ne(1).int().sum())
 
                         else:
                             enc_lid_loss = None
@@ -752,7 +905,7 @@ class Trainer(object):
                         if opt.contrastive_loss_coeff > 0 and 'contrastive_loss' in outputs:
                             contrastive_loss = outputs['contrastive_loss']
                             full_loss = full_loss + opt.contrastive_loss_coeff * contrastive_loss
-                            report_contrastive_loss.add_(contrastive_loss.item())
+                            report.add('contrastive_loss', contrastive_loss)
 
                         correct, total = loss_dict['correct'], loss_dict['total']
                         optimizer = self.optim.optimizer
@@ -880,22 +1033,16 @@ class Trainer(object):
                 # accumulated gradient case, in this case the update frequency
                 self.all_reduce(num_accumulated_words, op=dist.ReduceOp.SUM, group=self.group)
 
-                grad_denom = 1.0
-
                 self.grad_scaler.unscale_(self.optim.optimizer)
 
-                if self.opt.normalize_gradient:
-                    grad_denom = num_accumulated_words.item() * grad_denom
-                else:
-                    grad_denom = 1
-
                 # the gradient is scaled by world size, so in order to match the model without multiGPU
                 # we rescale the model parameters w.r.t the world size
                 # grad_denom = grad_denom / self.world_size
 
                 # When we accumulate the gradients, each gradient is already normalized by a constant grad_scaler
-                if grad_denom != 1:
-                    normalize_gradients(self.model.parameters(), grad_denom)
+                # the number of words is used on the device (without reading it back)
+                if self.opt.normalize_gradient:
+                    normalize_gradients(self.model.parameters(), num_accumulated_words[0])
 
                 # Update the pagrameters.
                 grad_norm = clip_grad_norm(self.model.parameters(), self.opt.max_grad_norm)
@@ -917,11 +1064,10 @@ class Trainer(object):
                                     ewc_penalty = ewc_penalty + penalty.sum()
 
                             loss = ewc_penalty * ewc_importance
-                            ewc_loss = ewc_penalty.item()
                             # accumulate the gradients from EWC loss
                             loss.backward()
-                            report_ewc_loss.add_(ewc_loss)
-                            report_ewc_count += 1
+                            report.add('ewc_loss', ewc_penalty)
+                            report.add('ewc_count', 1)
 
                 self.optim.step(scaler=self.grad_scaler)
                 self.grad_scaler.update()
@@ -931,102 +1077,96 @@ class Trainer(object):
                 num_accumulated_sents.zero_()
 
                 num_updates = self.optim._step
+                # report the validation running in the background when it is finished
+                self.collect_background_validation()
+
                 if (opt.save_every > 0 and num_updates % opt.save_every == -1 % opt.save_every) \
                         or (num_updates >= opt.max_step):
-                    valid_loss, valid_accuracy = self.eval(valid_data)
-                    valid_ppl = math.exp(min(valid_loss, 100))
-
-                    if self.is_main():
-                        print('Validation perplexity: %g' % valid_ppl)
-                        print('Validation accuracy: %g percent' % (100 * valid_accuracy))
-                        ep = float(epoch) - 1. + ((float(i) + 1.) / n_samples)
-                        if opt.save_metrics in ['ppl', 'perplexity']:
-                            value = valid_ppl
-                        elif opt.save_metrics == "memory":
-                            if isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
-                                value = self.model.module.choose_best_epoch_by
-                            else:
-                                value = self.model.choose_best_epoch_by
-                        else:
-                            value = 1-valid_accuracy
-                        self.save(ep, value,
-                                  itr=data_iterator)
+                    ep = float(epoch) - 1. + ((float(i) + 1.) / n_samples)
+
+                    if self.background_validation and num_updates < opt.max_step:
+                        # the other processes continue training, the checkpoint is saved when the validation ends
+                        if self.is_main():
+                            self.start_background_validation(valid_data, ep, itr=data_iterator)
+                    else:
+                        valid_loss, valid_accuracy = self.eval(valid_data)
+                        valid_ppl = math.exp(min(valid_loss, 100))
+
+                        if self.is_main():
+                            print('Validation perplexity: %g' % valid_ppl)
+                            print('Validation accuracy: %g percent' % (100 * valid_accuracy))
+                            self.collect_background_validation(wait=True)
+                            self.save(ep, self.save_value(valid_ppl, valid_accuracy),
+                                      itr=data_iterator)
 
                     if num_updates >= opt.max_step:
                         print('[INFO] Max-training-step reached.')
+                        self.close()
                         exit(0)
 
             num_words = tgt_size
-            report_loss.add_(loss_data)
-            report_tgt_words.add_(num_words)
-            report_src_words.add_(src_size)
+            report.add('loss', loss_data)
+            report.add('tgt_words', num_words)
+            report.add('src_words', src_size)
+            report.add('sents', 1)
             total_loss.add_(loss_data)
             total_words.add_(num_words)
-            report_sents.add_(1)
             # total_tokens += batch.get('target_output').nelement()
             # total_non_pads += batch.get('target_output').ne(onmt.constants.PAD).sum().item()
             # batch_efficiency = total_non_pads / total_tokens
 
             if opt.reconstruct:
-                report_rec_loss.add_(rec_loss_data)
+                report.add('rec_loss', rec_loss_data)
 
             if opt.mirror_loss:
-                report_rev_loss.add_(rev_loss_data)
-                report_mirror_loss.add_(mirror_loss_data)
+                report.add('rev_loss', rev_loss_data)
+                report.add('mirror_loss', mirror_loss_data)
 
             if opt.ctc_loss > 0.0:
-                report_ctc_loss.add_(ctc_loss_data)
+                report.add('ctc_loss', ctc_loss_data)
 
             # control the index a little bit to ensure the log is always printed
             if i == 0 or ((i + 1) % opt.log_interval < self.world_size):
 
-                self.all_reduce(report_loss, op=dist.ReduceOp.SUM, group=self.group)
-                # self.all_reduce(report_ewc_loss, op=dist.ReduceOp.SUM, group=self.group)
-                self.all_reduce(report_tgt_words, op=dist.ReduceOp.SUM, group=self.group)
-                self.all_reduce(report_src_words, op=dist.ReduceOp.SUM, group=self.group)
-                # self.all_reduce(report_sents, op=dist.ReduceOp.SUM, group=self.group)
-                # self.all_reduce(report_contrastive_loss, op=dist.ReduceOp.SUM, group=self.group)
+                # one all_reduce and one transfer for all the metrics
+                stats = report.read(all_reduce=lambda buffer: self.all_reduce(buffer, op=dist.ReduceOp.SUM,
+                                                                               group=self.group))
 
                 if self.is_main():
                     log_string = ("Epoch %2d, %5d/%5d; ; ppl: %6.2f ; grad_norm: %6.4f " %
                                   (epoch, i + 1, len(data_iterator),
-                                   math.exp(report_loss.item() / report_tgt_words.item()),
+                                   math.exp(stats['loss'] / stats['tgt_words']),
                                    grad_norm))
 
                     # if opt.reconstruct:
-                    #     self.all_reduce(report_rec_loss, op=dist.ReduceOp.SUM, group=self.group)
-                    #     rec_ppl = math.exp(report_rec_loss.item() / report_src_words.item())
+                    #     rec_ppl = math.exp(stats['rec_loss'] / stats['src_words'])
                     #     log_string += (" rec_ppl: %6.2f ; " % rec_ppl)
 
                     if opt.mirror_loss:
-                        self.all_reduce(report_rev_loss, op=dist.ReduceOp.SUM, group=self.group)
-                        rev_ppl = math.exp(report_rev_loss.item() / report_tgt_words.item())
+                        rev_ppl = math.exp(stats['rev_loss'] / stats['tgt_words'])
                         log_string += (" rev_ppl: %6.2f ; " % rev_ppl)
-                        log_string += (" mir_loss: %6.2f ; " % (report_mirror_loss / report_tgt_words))
+                        log_string += (" mir_loss: %6.2f ; " % (stats['mirror_loss'] / stats['tgt_words']))
 
                     if opt.ctc_loss > 0.0:
-                        # if torch.isinf(report_ctc_loss):
-                        #     report_ctc_loss.zero_()
-                        # self.all_reduce(report_ctc_loss, op=dist.ReduceOp.SUM, group=self.group)
-                        ctc_loss = report_ctc_loss.item() / report_tgt_words.item()
+                        ctc_loss = stats['ctc_loss'] / stats['tgt_words']
                         log_string += (" ctcloss: %8.2f ; " % ctc_loss)
 
                     if opt.contrastive_loss_coeff > 0.0:
                         #
-                        ctv_loss = report_contrastive_loss.item() / report_tgt_words.item()
+                        ctv_loss = stats['contrastive_loss'] / stats['tgt_words']
                         log_string += (" ctv_loss: %8.2f ; " % ctv_loss)
 
                     if ewc_importance > 0.0:
                         try:
-                            _ewc_loss = report_ewc_loss.item() / report_ewc_count
+                            _ewc_loss = stats['ewc_loss'] / stats['ewc_count']
                         except ZeroDivisionError:
                             _ewc_loss =  float('nan')
                         log_string += (" ewcloss: %8.8f ; " % _ewc_loss)
 
                     if opt.predict_language > 0:
                         try:
-                            _enc_lid_loss = report_enc_lid_loss.item() / report_enc_lid_count
-                            _dec_lid_loss = report_dec_lid_loss.item() / report_dec_lid_count
+                            _enc_lid_loss = stats['enc_lid_loss'] / stats['enc_lid_count']
+                            _dec_lid_loss = stats['dec_lid_loss'] / stats['dec_lid_count']
                         except ZeroDivisionError:
                             _enc_lid_loss =  float('nan')
                             _dec_lid_loss = float('nan')
@@ -1038,31 +1178,25 @@ class Trainer(object):
                                     self.optim._step))
 
                     log_string += ("%5.0f src tok/s; %5.0f tgt tok/s; " %
-                                   (report_src_words.item() / (time.time() - start),
-                                    report_tgt_words.item() / (time.time() - start)))
+                                   (stats['src_words'] / (time.time() - start),
+                                    stats['tgt_words'] / (time.time() - start)))
 
                     log_string += ("%s elapsed" %
                                    str(datetime.timedelta(seconds=int(time.time() - self.start_time))))
 
                     self.print(log_string, flush=True)
 
-                report_loss.zero_()
-                report_tgt_words.zero_()
-                report_src_words.zero_()
-                report_rec_loss.zero_()
-                report_rev_loss.zero_()
-                report_mirror_loss.zero_()
-                report_ctc_loss.zero_()
-                report_ewc_loss.zero_()
-                report_ewc_count = 0
-                # report_sents.zero_()
-                if report_contrastive_loss is not None:
-                    report_contrastive_loss.zero_()
+                report.reset()
                 start = time.time()
 
             # increase i by world size
             i = i + self.world_size
 
+        if sum(file_cache) > 0:
+            self.print("[INFO] Audio file cache (data loader processes of the main rank): %d hits, %d misses, "
+                       "%.1f%% hit rate" % (file_cache[0], file_cache[1], 100.0 * file_cache[0] / sum(file_cache)),
+                       flush=True)
+
         return total_loss / total_words
 
     def estimate_fisher(self, data):
@@ -1556,6 +1690,7 @@ class Trainer(object):
                 if self.is_main():
                     self.save(0, valid_ppl if opt.save_metrics in ['ppl', 'perplexity'] else 1 - valid_accuracy)
 
+                self.close()
                 return
 
         self.start_time = time.time()
@@ -1580,16 +1715,9 @@ class Trainer(object):
                 print('[INFO] Validation perplexity: %g' % valid_ppl)
                 print('[INFO] Validation accuracy: %g percent' % (100 * valid_accuracy))
 
-                if opt.save_metrics in ['ppl', 'perplexity']:
-                    value = valid_ppl
-                elif opt.save_metrics == "memory":
-                    if isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
-                        value = self.model.module.choose_best_epoch_by
-                    else:
-                        value = self.model.choose_best_epoch_by
-                else:
-                    value = 1 - valid_accuracy
+                value = self.save_value(valid_ppl, valid_accuracy)
 
+                self.collect_background_validation(wait=True)
                 self.save(epoch, value)
 
                 if value < best_valid_ppl:
@@ -1600,3 +1728,5 @@ class Trainer(object):
 
             itr_progress = None
             resume = False
+
+        self.close()
@@ -10,6 +10,10 @@ def make_parser(parser):
     parser.add_argument('-data_cache_size', type=int, default=32,
                         help="""Caching for dataset (if implemented)""")
 
+    parser.add_argument('-cache_batches', action='store_true',
+                        help="""Save the sorted mini-batches next to the data (keyed by the data sizes and the batch
+                        options) so that the next runs and the other processes load them instead of sorting again""")
+
     parser.add_argument('-multi_dataset', action='store_true',
                         help='Reading multiple datasets (sharing the same dictionary)')
     parser.add_argument('-concat_dataset', action='store_true',
@@ -22,6 +26,12 @@ def make_parser(parser):
                         help="Sets of training data. For example 0 1 2")
     parser.add_argument('-valid_sets', default=[], nargs='+', type=int,
                         help="Sets of validation data.")
+    parser.add_argument('-data_sampling_temperature', type=float, default=1.0,
+                        help="""Multi-dataset: sample the datasets with probabilities proportional to
+                        size^(1/temperature). Values > 1 oversample the small datasets""")
+    parser.add_argument('-data_sampling_weights', default=[], nargs='+', type=float,
+                        help="""Multi-dataset: explicit sampling weights of the training datasets
+                        (one per dataset in -train_sets, overrides the temperature)""")
     parser.add_argument('-train_set_orders', default=[], nargs='+', type=int,
                         help="The order of the training data for gradient episodic memory. For example 0 0 1 1 (must match the number of datasets).")
     parser.add_argument('-run_validation_before_training', action='store_true',
@@ -287,10 +297,32 @@ def make_parser(parser):
 
     parser.add_argument('-log_interval', type=int, default=100,
                         help="Print stats at this interval.")
+    parser.add_argument('-loss_chunk_size', type=int, default=0,
+                        help="""Compute the projection to the vocabulary and the cross-entropy by chunks of this many
+                        tokens, so that the logits of the whole batch are never stored (large vocabularies).
+                        0: the model outputs the full logits""")
+    parser.add_argument('-sync_metrics', action='store_true',
+                        help="""Read the training metrics back from the GPU after every mini-batch instead of once
+                        per log interval (slower, for debugging)""")
     parser.add_argument('-save_every', type=int, default=-1,
                         help="Save every this interval.")
     parser.add_argument('-keep_save_files', type=int, default=5,
                         help="Save every this interval.")
+    parser.add_argument('-max_pending_saves', type=int, default=1,
+                        help="""Maximum number of checkpoints written in the background at the same time (each one
+                        keeps a copy of the model and optimizer states in pinned CPU memory). 0: synchronous saves""")
+    parser.add_argument('-background_validation', action='store_true',
+                        help="""Validate a copy of the weights on a side device in the background while the training
+                        continues (the checkpoint is saved when the validation ends). The validation at the end of
+                        each epoch and at max_step still stops the training""")
+    parser.add_argument('-background_validation_device', type=str, default='cpu',
+                        help="""Device of the copy of the model used by the background validation:
+                        'cpu' or the id of a spare GPU""")
+    parser.add_argument('-valid_batch_cache', type=str, default='',
+                        help="""Read and collate the validation batches only once: 'memory' keeps them in pinned
+                        memory, otherwise they are written to <valid_batch_cache>.rank<rank>.pt and memory-mapped
+                        (the file is reused by the next runs with the same validation data and number of GPUs).
+                        Empty: the validation data is read again at each evaluation""")
     parser.add_argument('-copy_generator', action='store_true',
                         help='Use the copy_generator')
     parser.add_argument('-verbose', action='store_true',
@@ -9,6 +9,7 @@ from onmt.data.binarizer import Binarizer
 from onmt.data.binarizer import SpeechBinarizer
 
 from onmt.data.indexed_dataset import IndexedDatasetBuilder
+from onmt.data.path_table import save_path_tables
 
 import numpy as np
 import warnings
@@ -250,7 +251,7 @@ def save_dataset(path, data, format, dicts, src_type):
     # for ASR only
     elif format in ['scp', 'scpmem', 'wav']:
         print('Saving target data to memory indexed data files. Source data is stored only as scp path.')
-        from onmt.data.mmap_indexed_dataset import MMapIndexedDatasetBuilder
+        from onmt.data.mmap_indexed_dataset import MMapIndexedDatasetBuilder, MMapColumnDataset
 
         assert opt.asr, "ASR data format is required for this memory indexed format"
 
@@ -267,6 +268,11 @@ def save_dataset(path, data, format, dicts, src_type):
             else:
                 dtype = np.int32
 
+            if set_ in ['src_lang', 'tgt_lang', 'src_atb', 'tgt_atb']:
+                # one id per sentence: stored as a flat (or run-length encoded) column
+                MMapColumnDataset.write(os.path.join(path, "data.%s" % set_), data[set_])
+                continue
+
             indexed_data = MMapIndexedDatasetBuilder(os.path.join(path, "data.%s.bin" % set_), dtype=dtype)
 
             # add item from training data to the indexed data
@@ -288,6 +294,7 @@ def save_dataset(path, data, format, dicts, src_type):
 
         # Finally save the audio path
         torch.save(data['src'], os.path.join(path, 'data.scp_path.pt'))
+        save_path_tables(os.path.join(path, 'data.scp_path.pt'), data['src'])
         if 'prev_src' in data and data['prev_src'] is not None:
             torch.save(data['prev_src'], os.path.join(path, 'data.prev_scp_path.pt'))
 
@@ -295,7 +302,7 @@ def save_dataset(path, data, format, dicts, src_type):
 
     elif opt.format in ['mmap', 'mmem']:
         print('Saving data to memory indexed data files')
-        from onmt.data.mmap_indexed_dataset import MMapIndexedDatasetBuilder
+        from onmt.data.mmap_indexed_dataset import MMapIndexedDatasetBuilder, MMapColumnDataset
 
         if opt.asr:
             print("ASR data format isn't compatible with memory indexed format")
@@ -314,6 +321,11 @@ def save_dataset(path, data, format, dicts, src_type):
             else:
                 dtype = np.int32
 
+            if set_ in ['src_lang', 'tgt_lang', 'src_atb', 'tgt_atb']:
+                # one id per sentence: stored as a flat (or run-length encoded) column
+                MMapColumnDataset.write(os.path.join(path, "data.%s" % set_), data[set_])
+                continue
+
             indexed_data = MMapIndexedDatasetBuilder(os.path.join(path, "data.%s.bin" % set_), dtype=dtype)
 
             # add item from training data to the indexed data
@@ -396,47 +408,38 @@ def make_translation_data(src_file, tgt_file, src_dicts, tgt_dicts, tokenizer, m
     if type(lang_list) is dict:
         lang_list = sorted(list(lang_list.keys()))
 
-    print("[INFO] Binarizing file %s ..." % src_file)
-    binarized_src = Binarizer.binarize_file(src_file, src_dicts, tokenizer,
-                                            bos_word=None, eos_word=None,
-                                            data_type=data_type,
-                                            num_workers=num_workers, verbose=verbose,
-                                            external_tokenizer=external_tokenizer,
-                                            lang=src_lang, lang_list=lang_list, target=False
-                                            )
-
     if early_save:
+        # the binarized sentences are written to the memory indexed dataset directly by the binarizer workers
         os.makedirs(savedir, exist_ok=True)
         if mirror:
             os.makedirs(mirror_savedir, exist_ok=True)
-        src_len = len(binarized_src['data'])
-        print("Saving source data to %s .... with %d entries" % (savedir, src_len))
         if data_type == 'int64':
             dtype = np.int64
         else:
             dtype = np.int32
+        src_prefix = os.path.join(savedir, "data.%s" % "src")
+    else:
+        dtype = None
+        src_prefix = None
 
+    print("[INFO] Binarizing file %s ..." % src_file)
+    binarized_src = Binarizer.binarize_file(src_file, src_dicts, tokenizer,
+                                            bos_word=None, eos_word=None,
+                                            data_type=data_type,
+                                            num_workers=num_workers, verbose=verbose,
+                                            external_tokenizer=external_tokenizer,
+                                            lang=src_lang, lang_list=lang_list, target=False,
+                                            out_prefix=src_prefix, out_dtype=dtype
+                                            )
 
+    if early_save:
+        src_len = len(binarized_src['sizes'])
+        print("Saved source data to %s .... with %d entries" % (savedir, src_len))
 
-        from onmt.data.mmap_indexed_dataset import MMapIndexedDatasetBuilder
-        indexed_data = MMapIndexedDatasetBuilder(os.path.join(savedir, "data.%s.bin" % "src"), dtype=dtype)
-
-        # add item from training data to the indexed data
-        for tensor in binarized_src['data']:
-            indexed_data.add_item(tensor)
-
-        indexed_data.finalize(os.path.join(savedir, "data.%s.idx" % "src"))
-
-        del binarized_src['data']
-        gc.collect()
-
-        np_array = np.asarray(binarized_src['sizes'])
-        np.save(os.path.join(savedir, "data.%s.npy" % "src_sizes"), np_array)
+        np.save(os.path.join(savedir, "data.%s.npy" % "src_sizes"), binarized_src['sizes'])
 
         del binarized_src
-        del indexed_data
-        del np_array
-        gc.collect() 
+        gc.collect()
 
         if mirror:
             print("Saving mirrrored target data to %s .... with %d entries" % (mirror_savedir, src_len))
@@ -464,39 +467,21 @@ def make_translation_data(src_file, tgt_file, src_dicts, tgt_dicts, tokenizer, m
                                             data_type=data_type,
                                             num_workers=num_workers, verbose=verbose,
                                             external_tokenizer=external_tokenizer,
-                                            lang=tgt_lang, lang_list=lang_list, target=True
+                                            lang=tgt_lang, lang_list=lang_list, target=True,
+                                            out_prefix=os.path.join(savedir, "data.%s" % "tgt") if early_save else None,
+                                            out_dtype=dtype
                                             )
 
     if early_save:
 
-        tgt_len = len(binarized_tgt['data'])
+        tgt_len = len(binarized_tgt['sizes'])
         assert tgt_len == src_len, "Number of samples doesn't match between source and target!!!"
 
-        print("Saving target data to %s .... with %d samples" % (savedir, tgt_len))
-
-        if data_type == 'int64':
-            dtype = np.int64
-        else:
-            dtype = np.int32
-
-        from onmt.data.mmap_indexed_dataset import MMapIndexedDatasetBuilder
-        indexed_data = MMapIndexedDatasetBuilder(os.path.join(savedir, "data.%s.bin" % "tgt"), dtype=dtype)
-
-        # add item from training data to the indexed data
-        for tensor in binarized_tgt['data']:
-            indexed_data.add_item(tensor)
-
-        indexed_data.finalize(os.path.join(savedir, "data.%s.idx" % "tgt"))
-
-        del binarized_tgt['data']
-        del indexed_data
-        gc.collect()
+        print("Saved target data to %s .... with %d samples" % (savedir, tgt_len))
 
-        np_array = np.asarray(binarized_tgt['sizes'])
-        np.save(os.path.join(savedir, "data.%s.npy" % "tgt_sizes"), np_array)
+        np.save(os.path.join(savedir, "data.%s.npy" % "tgt_sizes"), binarized_tgt['sizes'])
 
         del binarized_tgt
-        del np_array
         gc.collect()
 
         if mirror:
@@ -1264,7 +1249,7 @@ def main():
 
         elif opt.format in ['scp', 'scpmem', 'wav']:
             print('Saving target data to memory indexed data files. Source data is stored only as scp path.')
-            from onmt.data.mmap_indexed_dataset import MMapIndexedDatasetBuilder
+            from onmt.data.mmap_indexed_dataset import MMapIndexedDatasetBuilder, MMapColumnDataset
 
             assert opt.asr, "ASR data format is required for this memory indexed format"
 
@@ -1280,6 +1265,13 @@ def main():
                 else:
                     dtype = np.int32
 
+                if set_ in ['src_lang', 'tgt_lang']:
+                    # one id per sentence: stored as a flat (or run-length encoded) column
+                    MMapColumnDataset.write(opt.save_data + ".train.%s" % set_, train[set_])
+                    if valid[set_] is not None:
+                        MMapColumnDataset.write(opt.save_data + ".valid.%s" % set_, valid[set_])
+                    continue
+
                 train_data = MMapIndexedDatasetBuilder(opt.save_data + ".train.%s.bin" % set_, dtype=dtype)
 
                 # add item from training data to the indexed data
@@ -1347,14 +1339,16 @@ def main():
 
             if opt.format in ['wav']:
                 torch.save(save_data, opt.save_data + '.wav_path.pt')
+                save_path_tables(opt.save_data + '.wav_path.pt', save_data)
             else:
                 torch.save(save_data, opt.save_data + '.scp_path.pt')
+                save_path_tables(opt.save_data + '.scp_path.pt', save_data)
 
             print("Done")
 
         elif opt.format in ['mmap', 'mmem']:
             print('Saving data to memory indexed data files')
-            from onmt.data.mmap_indexed_dataset import MMapIndexedDatasetBuilder
+            from onmt.data.mmap_indexed_dataset import MMapIndexedDatasetBuilder, MMapColumnDataset
 
 
             # save dicts in this format
@@ -1370,6 +1364,13 @@ def main():
                 else:
                     dtype = np.int32
 
+                if set_ in ['src_lang', 'tgt_lang']:
+                    # one id per sentence: stored as a flat (or run-length encoded) column
+                    MMapColumnDataset.write(opt.save_data + ".train.%s" % set_, train[set_])
+                    if valid[set_] is not None:
+                        MMapColumnDataset.write(opt.save_data + ".valid.%s" % set_, valid[set_])
+                    continue
+
                 train_data = MMapIndexedDatasetBuilder(opt.save_data + ".train.%s.bin" % set_, dtype=dtype)
 
                 # add item from training data to the indexed data
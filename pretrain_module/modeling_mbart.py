@@ -646,12 +646,13 @@ class MBartCrossAttention(MBartAttention):
                         src_lang.size(0), _rank,
                         self.sm_kv.size(-1))
                 elif src_lang.ndim == 3:
-                    _len_src = src_lang.size(0)
-                    _src_lang = src_lang.view(_len_src * _bsz, src_lang.size(-1))
+                    # the source side can have fewer rows than the queries (context shared across beams)
+                    _len_src, _bsz_src = src_lang.size(0), src_lang.size(1)
+                    _src_lang = src_lang.view(_len_src * _bsz_src, src_lang.size(-1))
                     rm_kv = torch.mm(_src_lang, self.rm_kv.view(n_languages, _rank * self.rm_kv.size(-1))).view(
-                        _len_src, _bsz, _rank, self.rm_kv.size(-1))
+                        _len_src, _bsz_src, _rank, self.rm_kv.size(-1))
                     sm_kv = torch.mm(_src_lang, self.sm_kv.view(n_languages, _rank * self.sm_kv.size(-1))).view(
-                        _len_src, _bsz, _rank, self.sm_kv.size(-1))
+                        _len_src, _bsz_src, _rank, self.sm_kv.size(-1))
 
                 # if lang has size [T x B x L] we need to do a GEMM
 
@@ -663,7 +664,12 @@ class MBartCrossAttention(MBartAttention):
 
                     input_lin_q_results = factorize_linear(hidden_states, in_proj_weight_q, self.q_proj.bias, rm_q, sm_q)
 
-                    input_lin_kv_results = factorize_linear(key_value_states, in_proj_weight_kv, self.proj_bias_kv, rm_kv, sm_kv)
+                    if incremental and ('c_k' in incremental_cache and 'c_v' in incremental_cache):
+                        # the context is projected only at the first step, the attention reads the cached c_k/c_v
+                        input_lin_kv_results = incremental_cache['c_k']
+                    else:
+                        input_lin_kv_results = factorize_linear(key_value_states, in_proj_weight_kv,
+                                                                self.proj_bias_kv, rm_kv, sm_kv)
 
                     recompute = False
                     attn_output, coverage = encdec_attn_bias_compact_func(recompute, self.training, self.num_heads,
@@ -1885,6 +1891,29 @@ class MBartDecoder(MBartPreTrainedModel):
             layer.add_factorize(n_languages, rank=rank, multiplicative=multiplicative,
                                 fast=fast, dyrank=dyrank)
 
+    def per_row_language(self, lang, hidden_states):
+        """
+        Language ids given per sentence (heterogeneous batch) are converted to one-hot distributions
+        [1 x B x n_languages], the same form as the predicted languages, so that the fast factorized layers
+        select the weights of each row. Only the fast factorized layers can use different languages in a batch.
+        :param lang: LongTensor [B]
+        :param hidden_states: T x B x H
+        :return: the language input of the layers
+        """
+        layer = self.layers[-1]
+
+        if not layer.is_factorized:
+            return lang
+
+        if not layer.fast_factorize:
+            # FastTranslator.supports_mixed_languages keeps these batches out of the decoder
+            raise ValueError("Different languages in the same batch require fast factorized layers")
+
+        n_languages = layer.r_i.size(0)
+        lang = F.one_hot(lang.long(), n_languages).type_as(hidden_states)
+
+        return lang.unsqueeze(0)
+
     def forward(
             self,
             input_ids=None,
@@ -2163,6 +2192,12 @@ class MBartDecoder(MBartPreTrainedModel):
         max_len = None
         cu_seqlens = None
 
+        if getattr(decoder_state, 'per_row_tgt_lang', False):
+            lang = self.per_row_language(lang, hidden_states)
+
+        if getattr(decoder_state, 'per_row_src_lang', False):
+            src_lang = self.per_row_language(src_lang, hidden_states)
+
         for idx, decoder_layer in enumerate(self.layers):
 
             if buffering:
@@ -1,6 +1,18 @@
 #!/usr/bin/env python
 from setuptools import setup, find_packages
 
+try:
+    import numpy as np
+    from Cython.Build import cythonize
+
+    # the batch collation kernels, onmt.data.dataset falls back to the python code without them
+    ext_modules = cythonize("onmt/data/fast_collate.pyx", language_level=3)
+    for extension in ext_modules:
+        extension.include_dirs.append(np.get_include())
+except ImportError:
+    print("[WARNING] Cython or numpy is not installed, the fast collation kernels are not built")
+    ext_modules = []
+
 setup(name='NMTGMinor',
       version='0.1',
       author='quanpn90',
@@ -16,4 +28,5 @@ setup(name='NMTGMinor',
           'translate.py',
       ],
       packages=find_packages(),
+      ext_modules=ext_modules,
       install_requires=['torch', 'torchaudio', 'soundfile'])
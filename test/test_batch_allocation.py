@@ -0,0 +1,60 @@
+import time
+import numpy as np
+
+from onmt.data.batch_utils import allocate_batch, allocate_batch_slow, \
+    allocate_batch_unbalanced, allocate_batch_unbalanced_slow, _clean_indices
+
+# compare the vectorized batch allocation with the python loop and time it
+
+rng = np.random.RandomState(0)
+n_samples = 200000
+
+src_sizes = rng.randint(2, 300, n_samples)
+tgt_sizes = rng.randint(4, 300, n_samples)
+lengths = np.maximum(src_sizes, tgt_sizes - 1)
+sorted_order = np.lexsort((src_sizes, tgt_sizes))
+
+for multiplier in [1, 8]:
+    start = time.time()
+    batches = allocate_batch(sorted_order, lengths, src_sizes, tgt_sizes,
+                             4096, 128, multiplier, 256, 256, 1, 3)
+    fast_time = time.time() - start
+
+    start = time.time()
+    ref_batches = allocate_batch_slow(sorted_order, lengths, src_sizes, tgt_sizes,
+                                      4096, 128, multiplier, 256, 256, 1, 3)
+    slow_time = time.time() - start
+
+    result = list(batches) == [[int(i) for i in batch] for batch in ref_batches]
+    print("text multiplier %d: %d batches, equal: %s, vectorized %.3fs, python %.3fs"
+          % (multiplier, len(batches), result, fast_time, slow_time))
+    assert result
+
+audio_sizes = rng.randint(100, 4000, n_samples)
+sorted_order = np.lexsort((tgt_sizes, audio_sizes))
+
+for multiplier in [1, 8]:
+    start = time.time()
+    batches = allocate_batch_unbalanced(sorted_order, audio_sizes, audio_sizes, tgt_sizes,
+                                        60000, 4096, 96, multiplier, 3500, 256, 1, 3,
+                                        cut_off_size=2500, smallest_batch_size=4)
+    fast_time = time.time() - start
+
+    start = time.time()
+    ref_batches = allocate_batch_unbalanced_slow(sorted_order, audio_sizes, audio_sizes, tgt_sizes,
+                                                 60000, 4096, 96, multiplier, 3500, 256, 1, 3,
+                                                 cut_off_size=2500, smallest_batch_size=4)
+    slow_time = time.time() - start
+
+    result = list(batches) == [[int(i) for i in batch] for batch in ref_batches]
+    print("audio multiplier %d: %d batches, equal: %s, vectorized %.3fs, python %.3fs"
+          % (multiplier, len(batches), result, fast_time, slow_time))
+    assert result
+
+# the length filters are exclusive on both sides: min_len < size < max_len
+indices = np.arange(6)
+src_sizes = np.array([1, 2, 3, 255, 256, 3])
+tgt_sizes = np.array([4, 4, 3, 4, 4, 4])
+kept = _clean_indices(indices, src_sizes, tgt_sizes, 256, 256, 1, 3).tolist()
+print("cleaning min_src_len=1, min_tgt_len=3, max_len=256:", kept)
+assert kept == [1, 3, 5]
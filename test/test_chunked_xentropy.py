@@ -0,0 +1,87 @@
+import time
+import torch
+import torch.nn.functional as F
+
+from onmt.modules.optimized.chunked_xentropy import chunked_linear_cross_entropy
+
+# compare the chunked projection + cross entropy with the full logits (loss, predictions and gradients)
+
+torch.manual_seed(0)
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+n_tokens, hidden_size, vocab_size = 2048, 512, 32000
+
+
+def full_loss(hidden, weight, bias, labels, smoothing):
+    logits = F.linear(hidden, weight, bias)
+    losses = F.cross_entropy(logits.float(), labels, ignore_index=0, reduction='none', label_smoothing=smoothing)
+    return losses, logits.argmax(dim=-1)
+
+
+inputs = (torch.randn(n_tokens, hidden_size, device=device),
+          torch.randn(vocab_size, hidden_size, device=device) * 0.05,
+          torch.zeros(vocab_size, device=device))
+labels = torch.randint(0, vocab_size, (n_tokens,), device=device)
+
+for smoothing in [0.0, 0.1]:
+    results = []
+    for loss_function in [full_loss, chunked_linear_cross_entropy]:
+        hidden, weight, bias = [tensor.clone().requires_grad_() for tensor in inputs]
+
+        if device == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        start = time.time()
+        losses, predictions = loss_function(hidden, weight, bias, labels, smoothing)
+        losses.sum().backward()
+        elapsed = time.time() - start
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device == 'cuda' else float('nan')
+
+        results.append((losses.detach(), predictions, hidden.grad, weight.grad, bias.grad))
+        print("%s smoothing %.1f: %.3fs, peak memory %.0f MB" % (loss_function.__name__, smoothing, elapsed, peak))
+
+    ref, out = results
+    loss_error = (ref[0] - out[0]).abs().max().item()
+    grad_errors = [(a - b).abs().max().item() for a, b in zip(ref[2:], out[2:])]
+    print("smoothing %.1f: loss error %.2e, same predictions: %s, gradient errors %s"
+          % (smoothing, loss_error, torch.equal(ref[1], out[1]), ["%.2e" % e for e in grad_errors]))
+    assert loss_error < 1e-3 and max(grad_errors) < 1e-4
+
+# the loss function with the outputs of a model in chunked_loss mode (generator weights instead of the logits)
+# gives the same loss, loss data and number of correct predictions as with the logits of the generator
+
+from collections import defaultdict
+from onmt.modules.base_seq2seq import Generator
+from onmt.modules.loss import NMTLossFunc
+
+seq_length, batch_size, vocab_size = 24, 16, 1000
+generator = Generator(hidden_size, vocab_size).to(device)
+loss_function = NMTLossFunc(hidden_size, vocab_size, 0.1, chunk_size=64).to(device)
+hidden = torch.randn(seq_length, batch_size, hidden_size, device=device)
+targets = torch.randint(1, vocab_size, (seq_length, batch_size), device=device)
+targets[-5:, ::2] = 0  # padding
+
+for training in [True, False]:
+    loss_function.train(training)
+    outputs = []
+    for chunked in [False, True]:
+        model_outputs = defaultdict(lambda: None, {'hidden': hidden, 'target_mask': targets.ne(0)})
+        if chunked:
+            model_outputs['generator_weight'], model_outputs['generator_bias'] = generator.get_output_weights()
+        else:
+            model_outputs = generator(model_outputs)
+            model_outputs['logprobs'] = model_outputs['logits']
+        outputs.append(loss_function(model_outputs, targets))
+
+    ref, out = outputs
+    loss_error = abs(ref['loss'].item() - out['loss'].item()) / abs(ref['loss'].item())
+    data_error = abs(ref['data'].item() - out['data'].item()) / abs(ref['data'].item())
+    same_correct = ref['correct'].item() == out['correct'].item() and ref['total'] == out['total']
+    print("NMTLossFunc %s: relative loss error %.2e, relative loss data error %.2e, same correct: %s"
+          % ("training" if training else "eval", loss_error, data_error, same_correct))
+    assert loss_error < 1e-5 and data_error < 1e-5 and same_correct
+
+# the chunked path cannot apply a vocabulary mask
+try:
+    loss_function(model_outputs, targets, vocab_mask=torch.ones(vocab_size, dtype=torch.bool, device=device))
+    raise RuntimeError("The vocabulary mask is ignored by the chunked loss")
+except AssertionError as e:
+    print("chunked loss with a vocabulary mask:", e)
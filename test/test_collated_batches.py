@@ -0,0 +1,42 @@
+import os
+import tempfile
+import torch
+
+import onmt
+from onmt.data.dataset import Dataset
+from onmt.data.data_iterator import DataIterator
+from onmt.data.collated_batches import CollatedBatches
+
+# the cached validation batches are only reused for the same data:
+# changing only the target side (same sources, same number of batches) invalidates the cache
+
+
+def make_dataset(tgt_lengths):
+    src = [torch.randint(4, 100, (length,)) for length in [5, 7, 9, 11]]
+    tgt = [torch.randint(4, 100, (length,)) for length in tgt_lengths]
+
+    langs = [torch.LongTensor([0])]
+
+    return Dataset(src, tgt, src_langs=langs, tgt_langs=langs, batch_size_words=32, batch_size_sents=2,
+                   data_type='text', sorting=False)
+
+
+torch.manual_seed(0)
+datasets = [make_dataset([6, 8, 10, 12]), make_dataset([6, 8, 10, 13])]
+iterators = [DataIterator(dataset, dataset.get_collater(), dataset.get_batches(), num_workers=0)
+             for dataset in datasets]
+
+assert len(iterators[0]) == len(iterators[1])
+digests = [CollatedBatches.data_digest(iterator) for iterator in iterators]
+print("target sizes change the digest:", digests[0] != digests[1])
+assert digests[0] != digests[1]
+assert CollatedBatches.data_digest(iterators[0]) == digests[0]
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    file_name = os.path.join(tmp_dir, 'valid.rank0.pt')
+    CollatedBatches.from_iterator(iterators[0]).save(file_name, {'sizes': digests[0]})
+
+    assert CollatedBatches.load(file_name, {'sizes': digests[0]}) is not None
+    stale = CollatedBatches.load(file_name, {'sizes': digests[1]})
+    print("cache rejected for the other targets:", stale is None)
+    assert stale is None
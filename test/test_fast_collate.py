@@ -0,0 +1,44 @@
+import time
+import torch
+
+from onmt.data.dataset import collate_text, collate_audio, load_fast_collate
+
+# micro-benchmark of the batch collation: Cython kernels vs python loop
+
+torch.manual_seed(0)
+n_repeats = 20
+
+assert load_fast_collate() is not None, "The Cython kernels could not be compiled"
+
+text = [torch.randint(4, 30000, (length,)) for length in torch.randint(1, 128, (256,)).tolist()]
+audio = [torch.randn(length, 80) for length in torch.randint(100, 1500, (64,)).tolist()]
+wav = [torch.randn(length, 1) for length in torch.randint(16000, 160000, (16,)).tolist()]
+
+for name, collate, data, kwargs in [("text", collate_text, text, {"pad": 0}),
+                                    ("audio", collate_audio, audio, {}),
+                                    ("wav", collate_audio, wav, {})]:
+
+    for align_right in [False, True]:
+        fast_output, fast_lengths = collate(data, align_right=align_right, **kwargs)
+        ref_output, ref_lengths = collate(data, align_right=align_right, use_fast_collate=False, **kwargs)
+
+        result = torch.equal(fast_output, ref_output) and fast_lengths == ref_lengths
+        print(name, "align_right" if align_right else "align_left", "equal:", result)
+        assert result
+
+    timings = []
+    for use_fast_collate in [True, False]:
+        start = time.time()
+        for _ in range(n_repeats):
+            collate(data, use_fast_collate=use_fast_collate, **kwargs)
+        timings.append((time.time() - start) / n_repeats * 1000)
+
+    print("%s: cython %.3f ms, python %.3f ms per batch" % (name, timings[0], timings[1]))
+
+# a sample with another feature size must be rejected before the unchecked copies
+for use_fast_collate in [True, False]:
+    try:
+        collate_audio([torch.randn(10, 80), torch.randn(12, 81)], use_fast_collate=use_fast_collate)
+        raise AssertionError("The feature size mismatch is not detected")
+    except ValueError as e:
+        print("feature size mismatch:", e)
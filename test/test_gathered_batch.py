@@ -0,0 +1,55 @@
+import os
+import tempfile
+import torch
+
+from onmt.data.dataset import collate_fn, MergedData
+from onmt.data.mmap_indexed_dataset import MMapIndexedDataset, MMapIndexedDatasetBuilder, \
+    index_file_path, data_file_path
+
+# a batch gathered from the memory-mapped data (MergedData) gives the same tensors as the list of sequences,
+# also with the one-shot memory (use_memory) which reads the target sentences
+
+
+class WordTokenizer(object):
+    """ token i <-> word 'w<i>' (0, 1, 2: padding and special tokens) """
+
+    def decode(self, tokens):
+        return " ".join("w%d" % t for t in tokens.tolist())
+
+    def encode(self, sentence):
+        return [0] + [int(w[1:]) for w in sentence.split()] + [2]
+
+
+torch.manual_seed(0)
+pad = 1
+ids = [3, 0, 5, 2]
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    data = dict()
+    for side in ['src', 'tgt']:
+        prefix = os.path.join(tmp_dir, side)
+        builder = MMapIndexedDatasetBuilder(data_file_path(prefix))
+        for length in torch.randint(3, 12, (8,)).tolist():
+            # <s> words </s>, the words repeat so that the memory finds n-grams in several sentences
+            builder.add_item(torch.tensor([0] + torch.randint(3, 9, (length,)).tolist() + [2]))
+        builder.finalize(index_file_path(prefix))
+        data[side] = MMapIndexedDataset(prefix)
+
+    for align_right in [False, True]:
+        gathered = dict()
+        for side in ['src', 'tgt']:
+            merged = MergedData(*data[side].get_batch(ids, pad, align_right=align_right), align_right=align_right)
+            sequences = [data[side][i] for i in ids]
+            assert [s.tolist() for s in merged] == [s.tolist() for s in sequences]
+            gathered[side] = (merged, sequences)
+
+        outputs = []
+        for k in range(2):
+            batch = collate_fn(gathered['src'][k], gathered['tgt'][k], None, None, None, None,
+                               align_right, align_right, src_pad=pad, tgt_pad=pad,
+                               use_memory=WordTokenizer(), deterministic=True)
+            outputs.append(batch.tensors)
+
+        for key in ['source', 'target', 'memory_text_ids', 'label_mem']:
+            assert torch.equal(outputs[0][key], outputs[1][key]), key
+        print("align_right" if align_right else "align_left", "gathered batch equal: True")
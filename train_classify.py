@@ -7,9 +7,10 @@ import onmt.modules
 import argparse
 import torch
 import time, datetime
-from onmt.data.mmap_indexed_dataset import MMapIndexedDataset
+from onmt.data.mmap_indexed_dataset import MMapIndexedDataset, load_column_dataset, column_dataset_exists
 from onmt.data.scp_dataset import SCPIndexDataset
 from onmt.data.wav_dataset import WavDataset
+from onmt.data.path_table import load_path_tables
 from onmt.modules.loss import NMTLossFunc, NMTAndCTCLossFunc
 from options import make_parser
 from collections import defaultdict
@@ -145,9 +146,9 @@ def main():
             # onmt.constants = add_tokenidx(opt, onmt.constants, dicts)
 
             if opt.data_format in ['scp', 'scpmem']:
-                audio_data = torch.load(opt.data + ".scp_path.pt")
+                audio_data = load_path_tables(opt.data + ".scp_path.pt")
             elif opt.data_format in ['wav']:
-                audio_data = torch.load(opt.data + ".wav_path.pt")
+                audio_data = load_path_tables(opt.data + ".wav_path.pt")
 
             # allocate languages if not
             if 'langs' not in dicts:
@@ -173,10 +174,10 @@ def main():
             train_tgt = MMapIndexedDataset(train_path + '.tgt')
 
             # check the lang files if they exist (in the case of multi-lingual models)
-            if os.path.exists(train_path + '.src_lang.bin'):
+            if column_dataset_exists(train_path + '.src_lang'):
                 assert 'langs' in dicts
-                train_src_langs = MMapIndexedDataset(train_path + '.src_lang')
-                train_tgt_langs = MMapIndexedDataset(train_path + '.tgt_lang')
+                train_src_langs = load_column_dataset(train_path + '.src_lang')
+                train_tgt_langs = load_column_dataset(train_path + '.tgt_lang')
             else:
                 train_src_langs = list()
                 train_tgt_langs = list()
@@ -237,10 +238,10 @@ def main():
 
             valid_tgt = MMapIndexedDataset(valid_path + '.tgt')
 
-            if os.path.exists(valid_path + '.src_lang.bin'):
+            if column_dataset_exists(valid_path + '.src_lang'):
                 assert 'langs' in dicts
-                valid_src_langs = MMapIndexedDataset(valid_path + '.src_lang')
-                valid_tgt_langs = MMapIndexedDataset(valid_path + '.tgt_lang')
+                valid_src_langs = load_column_dataset(valid_path + '.src_lang')
+                valid_tgt_langs = load_column_dataset(valid_path + '.tgt_lang')
             else:
                 valid_src_langs = list()
                 valid_tgt_langs = list()
@@ -324,18 +325,18 @@ def main():
                 from onmt.data.scp_dataset import SCPIndexDataset
 
                 if opt.data_format in ['scp', 'scpmem']:
-                    audio_data = torch.load(os.path.join(data_dir, "data.scp_path.pt"))
+                    audio_data = load_path_tables(os.path.join(data_dir, "data.scp_path.pt"))
                     src_data = SCPIndexDataset(audio_data, concat=opt.concat)
                 elif opt.data_format in ['wav']:
-                    audio_data = torch.load(os.path.join(data_dir, "data.scp_path.pt"))
+                    audio_data = load_path_tables(os.path.join(data_dir, "data.scp_path.pt"))
                     src_data = WavDataset(audio_data)
                 else:
                     src_data = MMapIndexedDataset(os.path.join(data_dir, "data.src"))
 
                 tgt_data = MMapIndexedDataset(os.path.join(data_dir, "data.tgt"))
 
-                src_lang_data = MMapIndexedDataset(os.path.join(data_dir, 'data.src_lang'))
-                tgt_lang_data = MMapIndexedDataset(os.path.join(data_dir, 'data.tgt_lang'))
+                src_lang_data = load_column_dataset(os.path.join(data_dir, 'data.src_lang'))
+                tgt_lang_data = load_column_dataset(os.path.join(data_dir, 'data.tgt_lang'))
 
                 if os.path.exists(os.path.join(data_dir, 'data.src_sizes.npy')):
                     src_sizes = np.load(os.path.join(data_dir, 'data.src_sizes.npy'))
@@ -379,18 +380,18 @@ def main():
             elif opt.data_format in ['scp', 'scpmem', 'mmem', 'wav']:
 
                 if opt.data_format in ['scp', 'scpmem']:
-                    audio_data = torch.load(os.path.join(data_dir, "data.scp_path.pt"))
+                    audio_data = load_path_tables(os.path.join(data_dir, "data.scp_path.pt"))
                     src_data = SCPIndexDataset(audio_data, concat=opt.concat)
                 elif opt.data_format in ['wav']:
-                    audio_data = torch.load(os.path.join(data_dir, "data.scp_path.pt"))
+                    audio_data = load_path_tables(os.path.join(data_dir, "data.scp_path.pt"))
                     src_data = WavDataset(audio_data)
                 else:
                     src_data = MMapIndexedDataset(os.path.join(data_dir, "data.src"))
 
                 tgt_data = MMapIndexedDataset(os.path.join(data_dir, "data.tgt"))
 
-                src_lang_data = MMapIndexedDataset(os.path.join(data_dir, 'data.src_lang'))
-                tgt_lang_data = MMapIndexedDataset(os.path.join(data_dir, 'data.tgt_lang'))
+                src_lang_data = load_column_dataset(os.path.join(data_dir, 'data.src_lang'))
+                tgt_lang_data = load_column_dataset(os.path.join(data_dir, 'data.tgt_lang'))
 
                 if os.path.exists(os.path.join(data_dir, 'data.src_sizes.npy')):
                     src_sizes = np.load(os.path.join(data_dir, 'data.src_sizes.npy'))
@@ -9,9 +9,10 @@ import onmt.modules
 import argparse
 import torch
 import time, datetime
-from onmt.data.mmap_indexed_dataset import MMapIndexedDataset
+from onmt.data.mmap_indexed_dataset import MMapIndexedDataset, load_column_dataset, column_dataset_exists
 from onmt.data.scp_dataset import SCPIndexDataset
 from onmt.data.wav_dataset import WavDataset
+from onmt.data.path_table import load_path_tables
 from options import make_parser
 from collections import defaultdict
 from onmt.constants import add_tokenidx
@@ -146,6 +147,9 @@ def main(gpu, opt):
     # manager = MyManager()
     # manager.start()
 
+    # the sorted mini-batches are stored next to the data
+    cache_batches = hasattr(opt, "cache_batches") and opt.cache_batches
+
     if not opt.multi_dataset:
         if opt.data_format in ['bin', 'raw']:
             start = time.time()
@@ -292,9 +296,9 @@ def main(gpu, opt):
             onmt.constants = add_tokenidx(opt, onmt.constants, dicts)
 
             if opt.data_format in ['scp', 'scpmem']:
-                audio_data = torch.load(opt.data + ".scp_path.pt")
+                audio_data = load_path_tables(opt.data + ".scp_path.pt")
             elif opt.data_format in ['wav']:
-                audio_data = torch.load(opt.data + ".wav_path.pt")
+                audio_data = load_path_tables(opt.data + ".wav_path.pt")
                 # # TODO: maybe having another option like -past_context
                 # if os.path.exists(opt.data + '.prev_src_path.pt'):
                 #     prev_audio_data = torch.load(opt.data + '.prev_src_path.pt')
@@ -325,10 +329,10 @@ def main(gpu, opt):
             train_tgt = MMapIndexedDataset(train_path + '.tgt')
 
             # check the lang files if they exist (in the case of multi-lingual models)
-            if os.path.exists(train_path + '.src_lang.bin'):
+            if column_dataset_exists(train_path + '.src_lang'):
                 assert 'langs' in dicts
-                train_src_langs = MMapIndexedDataset(train_path + '.src_lang')
-                train_tgt_langs = MMapIndexedDataset(train_path + '.tgt_lang')
+                train_src_langs = load_column_dataset(train_path + '.src_lang')
+                train_tgt_langs = load_column_dataset(train_path + '.tgt_lang')
             else:
                 train_src_langs = list()
                 train_tgt_langs = list()
@@ -336,10 +340,10 @@ def main(gpu, opt):
                 train_src_langs.append(torch.Tensor([dicts['langs']['src']]))
                 train_tgt_langs.append(torch.Tensor([dicts['langs']['tgt']]))
 
-            if os.path.exists(train_path + '.src_atb.bin'):
+            if column_dataset_exists(train_path + '.src_atb'):
                 assert 'atbs' in dicts
-                train_src_atbs = MMapIndexedDataset(train_path + '.src_atb')
-                train_tgt_atbs = MMapIndexedDataset(train_path + '.tgt_atb')
+                train_src_atbs = load_column_dataset(train_path + '.src_atb')
+                train_tgt_atbs = load_column_dataset(train_path + '.tgt_atb')
             else:
                 dicts['atbs'] = {'nothingness': 0}
                 train_src_atbs = list()
@@ -388,6 +392,7 @@ def main(gpu, opt):
                                           max_src_len=opt.max_src_length,
                                           max_tgt_len=opt.max_tgt_length,
                                           constants=constants,
+                                          batch_cache=train_path if cache_batches else None,
                                           use_memory=hasattr(opt, "use_memory") and opt.use_memory, validation=False)
             else:
                 train_data = onmt.StreamDataset(train_src,
@@ -418,10 +423,10 @@ def main(gpu, opt):
 
             valid_tgt = MMapIndexedDataset(valid_path + '.tgt')
 
-            if os.path.exists(valid_path + '.src_lang.bin'):
+            if column_dataset_exists(valid_path + '.src_lang'):
                 assert 'langs' in dicts
-                valid_src_langs = MMapIndexedDataset(valid_path + '.src_lang')
-                valid_tgt_langs = MMapIndexedDataset(valid_path + '.tgt_lang')
+                valid_src_langs = load_column_dataset(valid_path + '.src_lang')
+                valid_tgt_langs = load_column_dataset(valid_path + '.tgt_lang')
             else:
                 valid_src_langs = list()
                 valid_tgt_langs = list()
@@ -430,10 +435,10 @@ def main(gpu, opt):
                 valid_src_langs.append(torch.Tensor([dicts['langs']['src']]))
                 valid_tgt_langs.append(torch.Tensor([dicts['langs']['tgt']]))
 
-            if os.path.exists(valid_path + '.src_atb.bin'):
+            if column_dataset_exists(valid_path + '.src_atb'):
                 assert 'atbs' in dicts
-                valid_src_atbs = MMapIndexedDataset(valid_path + '.src_atb')
-                valid_tgt_atbs = MMapIndexedDataset(valid_path + '.tgt_atb')
+                valid_src_atbs = load_column_dataset(valid_path + '.src_atb')
+                valid_tgt_atbs = load_column_dataset(valid_path + '.tgt_atb')
             else:
                 valid_src_atbs = list()
                 valid_tgt_atbs = list()
@@ -473,6 +478,7 @@ def main(gpu, opt):
                                           max_tgt_len=opt.max_tgt_length,
                                           min_src_len=1, min_tgt_len=3,
                                           constants=constants,
+                                          batch_cache=valid_path if cache_batches else None,
                                           use_memory=hasattr(opt, "use_memory") and opt.use_memory)
             else:
                 # for validation data, we have to go through sentences (very slow but to ensure correctness)
@@ -544,22 +550,22 @@ def main(gpu, opt):
                 from onmt.data.scp_dataset import SCPIndexDataset
 
                 if opt.data_format in ['scp', 'scpmem']:
-                    audio_data = torch.load(os.path.join(data_dir, "data.scp_path.pt"))
+                    audio_data = load_path_tables(os.path.join(data_dir, "data.scp_path.pt"))
                     src_data = SCPIndexDataset(audio_data, concat=opt.concat)
                 elif opt.data_format in ['wav']:
-                    audio_data = torch.load(os.path.join(data_dir, "data.scp_path.pt"))
+                    audio_data = load_path_tables(os.path.join(data_dir, "data.scp_path.pt"))
                     src_data = WavDataset(audio_data, cache_size=opt.data_cache_size, wav_path_replace=opt.wav_path_replace)
                 else:
                     src_data = MMapIndexedDataset(os.path.join(data_dir, "data.src"))
 
                 tgt_data = MMapIndexedDataset(os.path.join(data_dir, "data.tgt"))
 
-                src_lang_data = MMapIndexedDataset(os.path.join(data_dir, 'data.src_lang'))
-                tgt_lang_data = MMapIndexedDataset(os.path.join(data_dir, 'data.tgt_lang'))
+                src_lang_data = load_column_dataset(os.path.join(data_dir, 'data.src_lang'))
+                tgt_lang_data = load_column_dataset(os.path.join(data_dir, 'data.tgt_lang'))
 
-                if os.path.exists(os.path.join(data_dir, 'data.src_atb.bin')):
-                    src_atbs_data = MMapIndexedDataset(os.path.join(data_dir, 'data.src_atb'))
-                    tgt_atbs_data = MMapIndexedDataset(os.path.join(data_dir, 'data.tgt_atb'))
+                if column_dataset_exists(os.path.join(data_dir, 'data.src_atb')):
+                    src_atbs_data = load_column_dataset(os.path.join(data_dir, 'data.src_atb'))
+                    tgt_atbs_data = load_column_dataset(os.path.join(data_dir, 'data.tgt_atb'))
                 else:
                     src_atbs_data = list()
                     tgt_atbs_data = list()
@@ -602,6 +608,7 @@ def main(gpu, opt):
                                               input_size=opt.input_size,
                                               constants=constants,
                                               dataset_factor=dataset_factors.get(idx_),
+                                              batch_cache=os.path.join(data_dir, 'data') if cache_batches else None,
                                               use_memory=hasattr(opt, "use_memory") and opt.use_memory, validation=False)
 
                     if c == 1:
@@ -626,23 +633,23 @@ def main(gpu, opt):
             elif opt.data_format in ['scp', 'scpmem', 'mmem', 'wav']:
 
                 if opt.data_format in ['scp', 'scpmem']:
-                    audio_data = torch.load(os.path.join(data_dir, "data.scp_path.pt"))
+                    audio_data = load_path_tables(os.path.join(data_dir, "data.scp_path.pt"))
                     src_data = SCPIndexDataset(audio_data, concat=opt.concat)
                 elif opt.data_format in ['wav']:
-                    audio_data = torch.load(os.path.join(data_dir, "data.scp_path.pt"))
+                    audio_data = load_path_tables(os.path.join(data_dir, "data.scp_path.pt"))
                     src_data = WavDataset(audio_data, cache_size=opt.data_cache_size, wav_path_replace=opt.wav_path_replace)
                 else:
                     src_data = MMapIndexedDataset(os.path.join(data_dir, "data.src"))
 
                 tgt_data = MMapIndexedDataset(os.path.join(data_dir, "data.tgt"))
 
-                src_lang_data = MMapIndexedDataset(os.path.join(data_dir, 'data.src_lang'))
-                tgt_lang_data = MMapIndexedDataset(os.path.join(data_dir, 'data.tgt_lang'))
+                src_lang_data = load_column_dataset(os.path.join(data_dir, 'data.src_lang'))
+                tgt_lang_data = load_column_dataset(os.path.join(data_dir, 'data.tgt_lang'))
 
                 # load data attributes
-                if os.path.exists(os.path.join(data_dir, 'data.src_atb.bin')):
-                    src_atbs_data = MMapIndexedDataset(os.path.join(data_dir, 'data.src_atb'))
-                    tgt_atbs_data = MMapIndexedDataset(os.path.join(data_dir, 'data.tgt_atb'))
+                if column_dataset_exists(os.path.join(data_dir, 'data.src_atb')):
+                    src_atbs_data = load_column_dataset(os.path.join(data_dir, 'data.src_atb'))
+                    tgt_atbs_data = load_column_dataset(os.path.join(data_dir, 'data.tgt_atb'))
                 else:
                     src_atbs_data = list()
                     tgt_atbs_data = list()
@@ -679,6 +686,7 @@ def main(gpu, opt):
                                               input_size=opt.input_size,
                                               cleaning=True, verbose=True,
                                               constants=constants,
+                                              batch_cache=os.path.join(data_dir, 'data') if cache_batches else None,
                                               use_memory=hasattr(opt, "use_memory") and opt.use_memory)
 
                     valid_sets.append(valid_data)
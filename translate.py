@@ -10,6 +10,7 @@ import math
 import numpy
 import sys
 import os
+import time
 import numpy as np
 from onmt.inference.fast_translator import FastTranslator
 from onmt.inference.stream_translator import StreamTranslator
@@ -31,6 +32,15 @@ parser.add_argument('-vocab_list', default="",
                     help='A Vocabulary list (1 word per line). Only are these words generated during translation.')
 parser.add_argument('-vocab_id_list', default="",
                     help='A Vocabulary list (1 word per line). Only are these words generated during translation.')
+parser.add_argument('-lexical_table', default="",
+                    help='Lexical translation table for vocabulary shortlist decoding. One entry per line: '
+                         'source_word target_word [probability]. The output layer only computes the words '
+                         'of the table for the source words of the batch, plus the -shortlist_frequent words.')
+parser.add_argument('-lexical_table_topk', type=int, default=100,
+                    help='Number of target words kept for each source word of the lexical table.')
+parser.add_argument('-shortlist_frequent', type=int, default=0,
+                    help='Number of most frequent target words always in the vocabulary shortlist '
+                         '(0 and no lexical table: no shortlist)')
 parser.add_argument('-autoencoder', required=False,
                     help='Path to autoencoder .pt file')
 parser.add_argument('-input_type', default="word",
@@ -129,14 +139,33 @@ parser.add_argument('-print_nbest', action='store_true',
 parser.add_argument('-ensemble_op', default='mean', help="""Ensembling operator""")
 parser.add_argument('-normalize', action='store_true',
                     help='To normalize the scores based on output length')
+parser.add_argument('-early_stop_bound', action='store_true',
+                    help='Stop the beam search of a sentence once the best score that its active hypotheses '
+                         'can still reach (given -alpha) is below the score of its worst finalized hypothesis, '
+                         'instead of waiting for beam_size finalized hypotheses. The n-best list of these '
+                         'sentences is shorter (fast decoder only)')
 parser.add_argument('-no_buffering', action='store_true',
                     help='To remove buffering for transformer models (slower but more memory)')
+parser.add_argument('-share_encoder_context', action='store_true',
+                    help='Keep the encoder output at batch size during beam search and share it across the beams '
+                         'in the encoder-decoder attention instead of copying it for every beam. '
+                         'Requires the optimized encoder-decoder attention (fast_xattention, or the mbart/deltalm '
+                         'decoders): for the other models it is turned off with a warning.')
 parser.add_argument('-src_align_right', action='store_true',
                     help='To normalize the scores based on output length')
 parser.add_argument('-fp16', action='store_true',
                     help='To use floating point 16 in decoding')
 parser.add_argument('-dynamic_quantile', type=int, default=0,
                     help='To use int8 in decoding (for linear and LSTM layers only).')
+parser.add_argument('-sort_by_length', action='store_true',
+                    help='Sort the (text) input by source length and translate it in length-homogeneous batches. '
+                         'The outputs are written in the original order.')
+parser.add_argument('-sort_window', type=int, default=0,
+                    help='Number of sentences read and sorted together with -sort_by_length. '
+                         'Default 0 means the whole input.')
+parser.add_argument('-batch_size_words', type=int, default=0,
+                    help='Maximum number of source tokens in a batch with -sort_by_length, including the padding '
+                         '(0: only -batch_size sentences is used)')
 parser.add_argument('-gpu', type=int, default=-1,
                     help="Device to run on")
 parser.add_argument('-fast_translate', action='store_true',
@@ -182,6 +211,73 @@ def _is_oversized(batch, new_sent_size, batch_size):
     return False
 
 
+def make_sorted_batches(lengths, batch_size, batch_size_words=0):
+    """
+    Group the sentences by source length (longest first) into batches
+    :param lengths: list of source lengths
+    :param batch_size: maximum number of sentences in a batch
+    :param batch_size_words: maximum number of source tokens in a batch including the padding (0: no limit)
+    :return: list of batches, each batch is a list of sentence indices
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+    batches = list()
+    batch = list()
+
+    for i in order:
+        # the first sentence of a batch is the longest one, so it determines the size of the padded batch
+        if len(batch) > 0 and (len(batch) >= batch_size or
+                               (batch_size_words > 0 and lengths[batch[0]] * (len(batch) + 1) > batch_size_words)):
+            batches.append(batch)
+            batch = list()
+
+        batch.append(i)
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+
+class OrderedWriter(object):
+    """
+    Output file wrapper for the sorted batches: translate_batch writes the sentences in the order of the batch,
+    and they are written to the file in the original order as soon as all previous sentences are done.
+    """
+
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.indices = list()
+        self.pending = dict()
+        self.next_index = 0
+
+    def add_indices(self, indices):
+        """
+        :param indices: original positions of the sentences of the next batch
+        """
+        self.indices.extend(reversed(indices))
+
+    def write(self, text):
+        # one call per sentence
+        self.pending[self.indices.pop()] = text
+
+        while self.next_index in self.pending:
+            self.out_file.write(self.pending.pop(self.next_index))
+            self.next_index += 1
+
+    def flush(self):
+        self.out_file.flush()
+
+
+def report_throughput(n_sents, src_words, src_padded_words, pred_words, elapsed):
+
+    elapsed = max(elapsed, 1e-9)
+    print("[INFO] Translated %d sentences in %.2f seconds: %.2f sentences/s, %.2f source tokens/s, "
+          "%.2f target tokens/s, source padding ratio: %.2f%%" % (
+              n_sents, elapsed, n_sents / elapsed, src_words / elapsed, pred_words / elapsed,
+              100 * (1 - src_words / max(src_padded_words, 1))))
+
+
 def report_score(name, score_total, words_total):
 
     try:
@@ -666,6 +762,18 @@ def main():
     else:
         past_text_data = open(opt.past_src) if opt.past_src else None
 
+        sort_by_length = opt.sort_by_length and not opt.streaming and in_file is not sys.stdin
+        if sort_by_length:
+            # the sentences are read by window, then sorted and translated in batches of similar lengths
+            window_size = opt.sort_window if opt.sort_window > 0 else sys.maxsize
+            writer = OrderedWriter(outF)
+        else:
+            window_size = opt.batch_size
+            writer = outF
+
+        n_sents, src_words, src_padded_words, pred_words_count = 0, 0, 0, 0
+        start_time = time.time()
+
         for line in addone(in_file):
             if line is not None:
                 if opt.input_type == 'word':
@@ -703,40 +811,71 @@ def main():
                 if prefix is not None and prefix_reader is not None:
                     prefix.append(prefix_reader.readline().strip())
 
-                if len(src_batch) < opt.batch_size:
+                if len(src_batch) < window_size:
                     continue
             else:
                 # at the end of file, check last batch
                 if len(src_batch) == 0:
                     break
 
-            # actually done beam search from the model
-            pred_batch, pred_ids, pred_score, pred_length, \
-            gold_score, num_gold_words, all_gold_scores = translator.translate(
-                src_batch,
-                tgt_batch,
-                past_src_batch,
-                prefix=prefix, anti_prefix=anti_prefix)
-
-            # convert output tensor to words
-            count, pred_score, pred_words, gold_score, goldWords = translate_batch(opt, tgtF, count, outF, translator,
-                                                                                   src_batch, tgt_batch,
-                                                                                   pred_batch, pred_ids,
-                                                                                   pred_score, pred_length,
-                                                                                   gold_score, num_gold_words,
-                                                                                   all_gold_scores, opt.input_type,
-                                                                                   external_tokenizer=external_tokenizer)
-            pred_score_total += pred_score
-            pred_words_total += pred_words
-            gold_score_total += gold_score
-            gold_words_total += goldWords
+            if sort_by_length:
+                batches = make_sorted_batches([len(tokens) for tokens in src_batch], opt.batch_size,
+                                              opt.batch_size_words)
+            else:
+                batches = [list(range(len(src_batch)))]
+
+            for indices in batches:
+                _src_batch = [src_batch[i] for i in indices]
+                _tgt_batch = [tgt_batch[i] for i in indices] if tgtF else tgt_batch
+                _past_src_batch = [past_src_batch[i] for i in indices] if past_text_data else past_src_batch
+                if prefix is not None and prefix_reader is not None:
+                    _prefix = [prefix[i] for i in indices]
+                else:
+                    _prefix = prefix
+
+                if sort_by_length:
+                    writer.add_indices([n_sents + i for i in indices])
+
+                # actually done beam search from the model
+                pred_batch, pred_ids, pred_score, pred_length, \
+                gold_score, num_gold_words, all_gold_scores = translator.translate(
+                    _src_batch,
+                    _tgt_batch,
+                    _past_src_batch,
+                    prefix=_prefix, anti_prefix=anti_prefix)
+
+                # convert output tensor to words
+                count, pred_score, pred_words, gold_score, goldWords = translate_batch(opt, tgtF, count, writer,
+                                                                                       translator,
+                                                                                       _src_batch, _tgt_batch,
+                                                                                       pred_batch, pred_ids,
+                                                                                       pred_score, pred_length,
+                                                                                       gold_score, num_gold_words,
+                                                                                       all_gold_scores, opt.input_type,
+                                                                                       external_tokenizer=external_tokenizer)
+                pred_score_total += pred_score
+                pred_words_total += pred_words
+                gold_score_total += gold_score
+                gold_words_total += goldWords
+
+                lengths = [len(tokens) for tokens in _src_batch]
+                src_words += sum(lengths)
+                src_padded_words += max(lengths) * len(lengths)
+                pred_words_count += pred_words
+
+            n_sents += len(src_batch)
             src_batch, tgt_batch, past_src_batch = [], [], []
             if prefix is not None and prefix_reader is not None:
                 prefix = []
 
+        report_throughput(n_sents, src_words, src_padded_words, pred_words_count, time.time() - start_time)
+
     if opt.verbose:
         report_score('PRED', pred_score_total, pred_words_total)
         if tgtF: report_score('GOLD', gold_score_total, gold_words_total)
+        if getattr(translator, 'early_stop_bound', False):
+            print("[INFO] Bound-based early stopping: %d sentences stopped early, up to %d decoding steps saved"
+                  % (translator.early_stopped_sents, translator.early_stopped_steps))
 
     if tgtF:
         tgtF.close()
@@ -794,13 +933,15 @@ def translate_batch(opt, tgtF, count, outF, translator, src_batch, tgt_batch,
                 get_sentence_from_tokens(pred_batch[b][0], pred_ids[b][0], input_type, external_tokenizer) + '\n')
             outF.flush()
         else:
-            for n in range(opt.n_best):
+            # the n-best list of a sentence is written at once (one write per sentence)
+            out_strs = []
+            for n in range(len(pred_batch[b])):
                 idx = n
                 output_sent = get_sentence_from_tokens(pred_batch[b][idx], pred_ids[b][idx], input_type,
                                                        external_tokenizer)
-                out_str = "%s ||| %.4f" % (output_sent, pred_score[b][idx])
-                outF.write(out_str + '\n')
-                outF.flush()
+                out_strs.append("%s ||| %.4f\n" % (output_sent, pred_score[b][idx]))
+            outF.write("".join(out_strs))
+            outF.flush()
 
         if opt.verbose:
             if opt.encoder_type == "text":
@@ -811,7 +952,7 @@ def translate_batch(opt, tgtF, count, outF, translator, src_batch, tgt_batch,
             print("PRED SCORE: %.4f" % pred_score[b][0])
 
             if tgtF is not None:
-                tgt_sent = get_sentence_from_tokens(tgt_batch[b], input_type)
+                tgt_sent = get_sentence_from_tokens(tgt_batch[b], None, input_type)
                 if translator.tgt_dict.lower:
                     tgt_sent = tgt_sent.lower()
                 print('GOLD %d: %s ' % (count, tgt_sent))
@@ -819,7 +960,7 @@ def translate_batch(opt, tgtF, count, outF, translator, src_batch, tgt_batch,
                 print()
             if opt.print_nbest:
                 print('\n BEST HYP:')
-                for n in range(opt.n_best):
+                for n in range(len(pred_batch[b])):
                     idx = n
                     out_str = "%s ||| %.4f" % (" ".join(pred_batch[b][idx]), pred_score[b][idx])
                     print(out_str)
@@ -1,14 +1,32 @@
 #!/usr/bin/env python
 import sys
 import os
+import queue
 import tempfile
+import threading
+import traceback
 from itertools import islice
 from time import time
-from multiprocessing import Pool
+import multiprocessing as mp
+
+import torch
 
 from translate import main as translate_main
+from translate import parser, make_sorted_batches, OrderedWriter, translate_batch, report_score, report_throughput
 from onmt.utils import safe_readline
 
+parser.add_argument('-gpus', default='0',
+                    help='Comma separated list of devices, one worker process per device. '
+                         'Use cpu for CPU workers (for example cpu,cpu,cpu,cpu)')
+
+
+def parse_devices(gpus):
+    """
+    :param gpus: comma separated list of devices (gpu ids or cpu)
+    :return: list of device ids, -1 for cpu
+    """
+    return [-1 if gpu.strip() == 'cpu' else int(gpu) for gpu in gpus.split(',')]
+
 
 def find_offsets(filename, num_chunks):
     """
@@ -71,15 +89,6 @@ def distribute_to_tempfiles(srcfile, n):
     print("Lines per tmp files to be translated: ", lines_per_tf)
     assert (sum(lines_per_tf) == all_lines)
 
-    #     nlines = len(list(f))
-    #     f.seek(0)
-    #     # round up
-    #     linesperpart = int((nlines + n - 1) / n)
-    #     for tf in tmpfiles:
-    #         for line in islice(f, linesperpart):
-    #             tf.write(line)
-    #         tf.flush()
-
     return tmpfiles, lines_per_tf
 
 
@@ -113,42 +122,293 @@ def run_part(args):
     print('GPU {} done after {:.1f}s'.format(gpu, time() - start))
 
 
-srcfile = popopt('src')
-outfile = popopt('output')
-gpu_list = popopt('gpus').split(',')
-
-# (1) distribute input lines to N tempfiles
-inparts, lines_per_file = distribute_to_tempfiles(srcfile, len(gpu_list))
-if hasopt('tgt'):
-    goldfile = popopt('tgt')
-    goldparts = distribute_to_tempfiles_withlist(goldfile, len(gpu_list), lines_per_file)
-else:
-    goldparts = [None for _ in range(len(gpu_list))]
-
-if hasopt('sub_src'):
-    sub_src_file = popopt('sub_src')
-    sub_src_parts = distribute_to_tempfiles_withlist(sub_src_file, len(gpu_list), lines_per_file)
-else:
-    sub_src_parts = [None for _ in range(len(gpu_list))]
-
-if hasopt('past_src'):
-    past_src_file = popopt('past_src')
-    past_src_parts = distribute_to_tempfiles_withlist(past_src_file, len(gpu_list), lines_per_file)
-else:
-    past_src_parts = [None for _ in range(len(gpu_list))]
-
-# (2) run N processes translating one tempfile each
-outparts = [tempfile.NamedTemporaryFile('r', encoding='utf8') for _ in gpu_list]
-filenames = lambda tmpfiles: [tf.name if tf else None for tf in tmpfiles]
-with Pool(len(gpu_list)) as p:
-    p.map(run_part, zip(filenames(inparts),
-                        filenames(goldparts),
-                        filenames(sub_src_parts),
-                        filenames(past_src_parts),
-                        filenames(outparts),
-                        gpu_list))
-
-# (3) concatenate tempfiles into one output file
-with open(outfile, 'w', encoding='utf8') as f:
-    for outp in outparts:
-        f.write(outp.read())
+def translate_by_shards():
+    """
+    Split the input into one shard per device and run translate.py on each shard.
+    Only used for the inputs that the bulk translation does not support (audio, streaming).
+    """
+    srcfile = popopt('src')
+    outfile = popopt('output')
+    gpu_list = [str(gpu) for gpu in parse_devices(popopt('gpus'))]
+
+    # (1) distribute input lines to N tempfiles
+    inparts, lines_per_file = distribute_to_tempfiles(srcfile, len(gpu_list))
+    if hasopt('tgt'):
+        goldfile = popopt('tgt')
+        goldparts = distribute_to_tempfiles_withlist(goldfile, len(gpu_list), lines_per_file)
+    else:
+        goldparts = [None for _ in range(len(gpu_list))]
+
+    if hasopt('sub_src'):
+        sub_src_file = popopt('sub_src')
+        sub_src_parts = distribute_to_tempfiles_withlist(sub_src_file, len(gpu_list), lines_per_file)
+    else:
+        sub_src_parts = [None for _ in range(len(gpu_list))]
+
+    if hasopt('past_src'):
+        past_src_file = popopt('past_src')
+        past_src_parts = distribute_to_tempfiles_withlist(past_src_file, len(gpu_list), lines_per_file)
+    else:
+        past_src_parts = [None for _ in range(len(gpu_list))]
+
+    # (2) run N processes translating one tempfile each
+    outparts = [tempfile.NamedTemporaryFile('r', encoding='utf8') for _ in gpu_list]
+    filenames = lambda tmpfiles: [tf.name if tf else None for tf in tmpfiles]
+    with mp.Pool(len(gpu_list)) as p:
+        p.map(run_part, zip(filenames(inparts),
+                            filenames(goldparts),
+                            filenames(sub_src_parts),
+                            filenames(past_src_parts),
+                            filenames(outparts),
+                            gpu_list))
+
+    # (3) concatenate tempfiles into one output file
+    with open(outfile, 'w', encoding='utf8') as f:
+        for outp in outparts:
+            f.write(outp.read())
+
+
+class SentenceCollector(object):
+    """
+    Output "file" of translate_batch in the workers: keeps the output of each sentence
+    """
+
+    def __init__(self):
+        self.outputs = list()
+
+    def write(self, text):
+        # one call per sentence
+        self.outputs.append(text)
+
+    def flush(self):
+        pass
+
+
+def read_lines(filename, input_type):
+
+    if not filename:
+        return None
+
+    with open(filename, encoding='utf8') as f:
+        if input_type == 'word':
+            return [line.split() for line in f]
+        elif input_type == 'char':
+            return [list(line.strip()) for line in f]
+        else:
+            raise NotImplementedError("Input type unknown")
+
+
+def translate_worker(rank, gpu, opt, task_queue, result_queue, n_threads):
+    """
+    Load the model once, then translate the batches of the shared queue until the end signal (None)
+    :param rank: worker index
+    :param gpu: device id (-1 for CPU)
+    :param opt: options of translate.py
+    :param task_queue: batches to translate (indices, source, target, past source, prefix)
+    :param result_queue: (rank, indices, outputs, statistics) for each batch, then (rank, None, None, None)
+    :param n_threads: number of CPU threads of the worker
+    """
+    try:
+        from onmt.inference.fast_translator import FastTranslator
+
+        opt.gpu = gpu
+        opt.cuda = gpu > -1
+        if opt.cuda:
+            torch.cuda.set_device(gpu)
+        else:
+            torch.set_num_threads(n_threads)
+
+        # Always pick n_best
+        opt.n_best = opt.beam_size
+
+        translator = FastTranslator(opt)
+        external_tokenizer = getattr(translator, 'tgt_external_tokenizer', None)
+
+        start = time()
+        n_batches = 0
+
+        while True:
+            task = task_queue.get()
+
+            if task is None:
+                break
+
+            indices, src_batch, tgt_batch, past_src_batch, prefix = task
+
+            pred_batch, pred_ids, pred_score, pred_length, \
+            gold_score, num_gold_words, all_gold_scores = translator.translate(
+                src_batch,
+                tgt_batch,
+                past_src_batch,
+                prefix=prefix, anti_prefix=opt.anti_prefix_string if opt.anti_prefix_string else None)
+
+            collector = SentenceCollector()
+            # translate_batch only checks if there is a target file
+            tgt_file = opt.tgt if opt.tgt else None
+            _, pred_score, pred_words, gold_score, gold_words = translate_batch(opt, tgt_file, 0, collector,
+                                                                                translator, src_batch, tgt_batch,
+                                                                                pred_batch, pred_ids,
+                                                                                pred_score, pred_length,
+                                                                                gold_score, num_gold_words,
+                                                                                all_gold_scores, opt.input_type,
+                                                                                external_tokenizer=external_tokenizer)
+
+            result_queue.put((rank, indices, collector.outputs, (pred_score, pred_words, gold_score, gold_words)))
+            n_batches += 1
+
+        print('Worker {} (device {}) translated {} batches in {:.1f}s'.format(rank, gpu, n_batches, time() - start))
+
+    except Exception:
+        traceback.print_exc()
+        result_queue.put((rank, None, None, "error"))
+        return
+
+    result_queue.put((rank, None, None, None))
+
+
+def translate_bulk(opt):
+    """
+    Translate a text file with one worker process per device.
+    The input is sorted by length and cut into batches which are put in a shared queue,
+    so a worker takes a new batch as soon as it is done with the previous one (the fast workers take more batches).
+    The outputs are written in the original order.
+    """
+    gpu_list = parse_devices(opt.gpus)
+    n_workers = len(gpu_list)
+
+    src_data = read_lines(opt.src, opt.input_type)
+    tgt_data = read_lines(opt.tgt, opt.input_type)
+    past_src_data = read_lines(opt.past_src, opt.input_type)
+
+    if len(opt.prefix_string) > 0:
+        assert len(opt.prefix_tgt) <= 0
+        prefix_data = None
+        prefix = [opt.prefix_string]
+    elif len(opt.prefix_tgt) > 0:
+        prefix_data = [line.strip() for line in open(opt.prefix_tgt, encoding='utf8')]
+        prefix = None
+    else:
+        prefix_data, prefix = None, None
+
+    batches = make_sorted_batches([len(tokens) for tokens in src_data], opt.batch_size, opt.batch_size_words)
+
+    print("[INFO] Translating %d sentences in %d batches with %d workers" % (len(src_data), len(batches),
+                                                                               n_workers))
+
+    # spawn: the CUDA context cannot be forked
+    ctx = mp.get_context('spawn')
+    # a few batches per worker keep the workers busy, the rest of the corpus is only read when there is room
+    task_queue = ctx.Queue(maxsize=2 * n_workers)
+    result_queue = ctx.Queue()
+    stop_feeding = threading.Event()
+
+    def put_task(task):
+        while not stop_feeding.is_set():
+            try:
+                task_queue.put(task, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def feed_tasks():
+        # the longest batches are first in the queue, the short ones fill the gaps at the end
+        for indices in batches:
+            task = (indices,
+                    [src_data[i] for i in indices],
+                    [tgt_data[i] for i in indices] if tgt_data is not None else [],
+                    [past_src_data[i] for i in indices] if past_src_data is not None else [],
+                    [prefix_data[i] for i in indices] if prefix_data is not None else prefix)
+            if not put_task(task):
+                return
+
+        for _ in range(n_workers):
+            if not put_task(None):
+                return
+
+    n_threads = max(1, torch.get_num_threads() // n_workers)
+    workers = [ctx.Process(target=translate_worker, args=(rank, gpu, opt, task_queue, result_queue, n_threads))
+               for rank, gpu in enumerate(gpu_list)]
+
+    start = time()
+    for worker in workers:
+        worker.start()
+
+    feeder = threading.Thread(target=feed_tasks, daemon=True)
+    feeder.start()
+
+    pred_score_total, pred_words_total, gold_score_total, gold_words_total = 0, 0, 0, 0
+
+    out_file = sys.stdout if opt.output == "stdout" else open(opt.output, 'w', encoding='utf8')
+    writer = OrderedWriter(out_file)
+    n_finished = 0
+
+    try:
+        while n_finished < n_workers:
+            try:
+                rank, indices, outputs, stats = result_queue.get(timeout=10)
+            except queue.Empty:
+                for rank, worker in enumerate(workers):
+                    if not worker.is_alive() and worker.exitcode != 0:
+                        raise RuntimeError("Worker %d exited with code %s" % (rank, worker.exitcode))
+                continue
+
+            if indices is None:
+                if stats == "error":
+                    raise RuntimeError("Worker %d failed" % rank)
+                n_finished += 1
+                continue
+
+            writer.add_indices(indices)
+            for output in outputs:
+                writer.write(output)
+            writer.flush()
+
+            pred_score, pred_words, gold_score, gold_words = stats
+            pred_score_total += pred_score
+            pred_words_total += pred_words
+            gold_score_total += gold_score
+            gold_words_total += gold_words
+
+    except BaseException:
+        # the other workers would wait forever for batches that are never fed, stop them with the feeder
+        stop_feeding.set()
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            worker.join()
+        task_queue.cancel_join_thread()
+        raise
+
+    finally:
+        feeder.join()
+
+    for worker in workers:
+        worker.join()
+
+    assert writer.next_index == len(src_data), "Some sentences are not translated"
+
+    if out_file is not sys.stdout:
+        out_file.close()
+
+    if opt.verbose:
+        report_score('PRED', pred_score_total, pred_words_total)
+        if tgt_data is not None:
+            report_score('GOLD', gold_score_total, gold_words_total)
+
+    src_words = sum(len(tokens) for tokens in src_data)
+    src_padded_words = sum(len(src_data[indices[0]]) * len(indices) for indices in batches)
+    report_throughput(len(src_data), src_words, src_padded_words, pred_words_total, time() - start)
+
+
+if __name__ == "__main__":
+
+    opt = parser.parse_args()
+
+    is_text = not (opt.encoder_type == "audio" and opt.asr_format in ['scp', 'kaldi']) and opt.asr_format != 'wav'
+
+    if is_text and not opt.streaming and not opt.sub_src:
+        translate_bulk(opt)
+    else:
+        translate_by_shards()